@@ -1,26 +1,24 @@
 # airflow/airflow_automation.py
 
-from airflow import DAG
-from airflow.providers.standard.operators.python import PythonOperator
+from airflow.sdk import dag, task
 from datetime import datetime, timedelta
 import logging
+import shutil
 from pathlib import Path
 import sys
-from etl.extraction.extract_311 import extract_311
-from etl.extraction.extract_weather import extract_weather
-from etl.transformation.transform_311 import transform_311
-from etl.transformation.transform_combined import transform_combined
-from etl.loading.load_to_bigquery import load_to_bigquery
 from logger.etl_logger import ETLLogger
+from logger.stage_metrics import set_run_id
+from logger.profiling import enable_profiling
 
 
 # Add ETL modules to path
 project_root = Path(__file__).parent.parent
 sys.path.append(str(project_root))
 
-# Set up logging
+# Set up logging, the log file is only created once a task writes to it
+# The scheduler re-parses this file constantly, so the ETL modules and their heavy dependencies
+# (polars, scipy, frictionless, BigQuery) are imported inside the task callables instead of at the top
 logger = ETLLogger("airflow_dag").get()
-logger.info("Starting Airflow DAG script")
 
 # Default arguments for DAG
 default_args = {
@@ -31,58 +29,152 @@ default_args = {
     'retry_delay': timedelta(minutes=5),
 }
 
+# Each run only reads and writes the files of its own data interval, so catch-up runs can overlap
+# Only the merge into the master dataset and the load to BigQuery are serialized across runs
+max_active_runs = 4
+
+
+# Utility functions for logging, every task of a DAG run writes its stage metrics under the Airflow run_id
+# Stages can be profiled for a single run by triggering it with a conf, e.g.
+#   airflow dags trigger nyc_311_weather_etl_monthly --conf '{"profile": "transform_311,load_to_bigquery"}'
+def log_task_start(task_name):
+    from airflow.sdk import get_current_context
+    context = get_current_context()
+    set_run_id(context["run_id"])
+    conf = context["dag_run"].conf or {}
+    if conf.get("profile"):
+        enable_profiling(conf["profile"], conf.get("profile_mode"))
+    logger.info(f"Starting task: {task_name}")
+
+def log_task_end(task_name):
+    logger.info(f"Finished task: {task_name}")
+
+
+# Function to split a data interval into calendar month windows, as ISO strings that can travel through XCom
+def month_windows(start, end):
+    windows = []
+    window_start = start
+    while window_start < end:
+        next_month = (window_start.replace(day=1) + timedelta(days=32)).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        window_end = min(next_month, end)
+        windows.append({"start": window_start.isoformat(), "end": window_end.isoformat()})
+        window_start = window_end
+    return windows
+
+
+def parse_window(window):
+    return datetime.fromisoformat(window["start"]), datetime.fromisoformat(window["end"])
+
+
 # Define DAG
-with DAG(
-    'nyc_311_weather_etl_monthly',
+@dag(
+    dag_id='nyc_311_weather_etl_monthly',
     default_args=default_args,
     description='Monthly ETL pipeline for NYC 311 and weather data',
-    schedule_interval='@monthly',
+    schedule='@monthly',
     catchup=True,
-    max_active_runs=1,
+    max_active_runs=max_active_runs,
     tags=['nyc', '311', 'weather', 'etl']
-) as dag:
-
-    # Utility functions for logging
-    def log_task_start(task_name):
-        logger.info(f"Starting task: {task_name}")
-
-    def log_task_end(task_name):
-        logger.info(f"Finished task: {task_name}")
-
-    # Wrapper functions for each ETL step
-    def run_extract_311():
-        log_task_start("extract_311")
-        extract_311()
-        log_task_end("extract_311")
-
-    def run_extract_weather():
-        log_task_start("extract_weather")
-        extract_weather()
-        log_task_end("extract_weather")
-
-    def run_transform_311():
-        log_task_start("transform_311")
-        transform_311()
-        log_task_end("transform_311")
-
-    def run_transform_combined():
-        log_task_start("transform_combined")
-        transform_combined()
-        log_task_end("transform_combined")
-
-    def run_load_to_bigquery():
-        log_task_start("load_to_bigquery")
-        load_to_bigquery()
-        log_task_end("load_to_bigquery")
-
-    # Define tasks
-    extract_311_task = PythonOperator(task_id='extract_311', python_callable=run_extract_311)
-    extract_weather_task = PythonOperator(task_id='extract_weather', python_callable=run_extract_weather)
-    transform_311_task = PythonOperator(task_id='transform_311', python_callable=run_transform_311)
-    transform_combined_task = PythonOperator(task_id='transform_combined', python_callable=run_transform_combined)
-    load_to_bigquery_task = PythonOperator(task_id='load_to_bigquery', python_callable=run_load_to_bigquery)
-
-    # DAG dependencies
-    [extract_311_task, extract_weather_task] >> transform_311_task
-    transform_311_task >> transform_combined_task
-    transform_combined_task >> load_to_bigquery_task
\ No newline at end of file
+)
+def nyc_311_weather_etl_monthly():
+
+    # Month windows of this run, driven by its data interval instead of the high-water mark files
+    @task
+    def plan_windows(data_interval_start=None, data_interval_end=None):
+        windows = month_windows(data_interval_start, data_interval_end)
+        logger.info(f"Planned {len(windows)} month windows from {data_interval_start} to {data_interval_end}")
+        return windows
+
+    # One 311 partition per month window and borough, plus one for rows without a known borough
+    @task
+    def plan_partitions(windows):
+        from etl.extraction.extract_311 import partition_boroughs
+        return [{**window, "borough": borough} for window in windows for borough in partition_boroughs + [None]]
+
+    @task
+    def extract_311(partition):
+        from etl.extraction.extract_311 import extract_311_partition
+        log_task_start(f"extract_311 {partition}")
+        start, end = parse_window(partition)
+        path = extract_311_partition(start, end, partition["borough"], change_capture=True)
+        log_task_end(f"extract_311 {partition}")
+        return path
+
+    @task
+    def extract_weather(window):
+        from etl.extraction.extract_311 import window_folder
+        from etl.extraction.extract_weather import extract_weather_window
+        log_task_start(f"extract_weather {window}")
+        start, end = parse_window(window)
+        path = extract_weather_window(start, end, window_folder(start, end))
+        log_task_end(f"extract_weather {window}")
+        return path
+
+    # Reduce step, merging every partition of this run into the master dataset under the master lock
+    @task(max_active_tis_per_dag=1)
+    def merge_311(paths):
+        from etl.extraction.extract_311 import merge_partitions
+        log_task_start("merge_311")
+        paths = [path for path in paths if path]
+        merge_partitions(paths)
+        log_task_end("merge_311")
+        return paths
+
+    # Transforming only the rows extracted by this run, the star schema tables are staged in the run's folder
+    @task
+    def transform(paths_311, weather_paths, data_interval_start=None, data_interval_end=None):
+        import polars as pl
+        from etl.extraction.extract_311 import window_folder
+        from etl.transformation.transform_311 import transform_311
+        from etl.transformation.transform_combined import transform_combined
+        from etl.transformation.weather_cube import update_weather_cube
+        from etl.transformation.weather_features import add_weather_features
+        from etl.compact_schema import shared_categories
+        log_task_start("transform")
+        weather_paths = [path for path in weather_paths if path]
+        if not paths_311 or not weather_paths:
+            logger.info("No 311 or weather data in this data interval, nothing to transform")
+            return {}
+        # The partitions are read and combined under one string cache, so their categoricals can be concatenated
+        with shared_categories():
+            cases = pl.concat([pl.read_parquet(path) for path in paths_311], how="diagonal_relaxed")
+            weather = pl.concat([pl.read_parquet(path) for path in weather_paths], how="diagonal_relaxed")
+            # Weather features and the stored weather cube depend on the weather of earlier runs too, so they are added
+            # after the cached transformation
+            tables = update_weather_cube(add_weather_features(transform_combined(transform_311(cases), weather)))
+
+        tables_folder = window_folder(data_interval_start, data_interval_end) / "tables"
+        tables_folder.mkdir(parents=True, exist_ok=True)
+        table_paths = {}
+        for table_name, df in tables.items():
+            table_paths[table_name] = str(tables_folder / f"{table_name}.parquet")
+            df.write_parquet(table_paths[table_name])
+        log_task_end("transform")
+        return table_paths
+
+    # The loaded key index is shared by every run, so loads run one at a time
+    # The warehouse is BigQuery unless ETL_WAREHOUSE selects the local DuckDB database or Parquet lake
+    @task(max_active_tis_per_dag=1)
+    def load(table_paths, windows, data_interval_start=None, data_interval_end=None):
+        import polars as pl
+        from etl.extraction.extract_311 import window_folder
+        from etl.loading.warehouse_sink import load_to_warehouse
+        from etl.compact_schema import shared_categories
+        log_task_start("load_to_warehouse")
+        if table_paths:
+            with shared_categories():
+                load_to_warehouse({table_name: pl.read_parquet(path) for table_name, path in table_paths.items()})
+
+        # Releasing the staged files of this run once they are in the warehouse
+        for window in list(windows) + [{"start": data_interval_start.isoformat(), "end": data_interval_end.isoformat()}]:
+            shutil.rmtree(window_folder(*parse_window(window)), ignore_errors=True)
+        log_task_end("load_to_warehouse")
+
+    # DAG dependencies, with extraction fanned out over month windows and boroughs
+    windows = plan_windows()
+    paths_311 = merge_311(extract_311.expand(partition=plan_partitions(windows)))
+    weather_paths = extract_weather.expand(window=windows)
+    load(transform(paths_311, weather_paths), windows)
+
+
+nyc_311_weather_etl_monthly()
@@ -0,0 +1,138 @@
+# Benchmark of the month-partitioned process-pool backfill against the single-process transformation
+#   python -m benchmarks.bench_backfill [rows]
+# Scaling is measured from 1 worker up to the number of cores, and with 2 workers at least, so that the months are
+# always split across processes. Every backfill must give the same tables as the single process: surrogate keys are
+# assigned in whatever order the rows arrive, so rows are compared by the natural values their keys stand for
+# Any failed check fails the benchmark
+import polars as pl
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+from benchmarks.synthetic import synthetic_311, synthetic_weather, synthetic_boundaries, vocabulary_sizes
+from etl.extraction.extract_weather import borough_coords
+from etl.parquet_layout import write_profiled_parquet
+from etl import stage_cache
+from etl.compact_schema import to_compact, to_text
+from etl.transformation import spatial_imputation, weather_cube, weather_features
+from etl.transformation.transform_311 import transform_311
+from etl.transformation.transform_combined import transform_combined
+from etl.transformation.backfill import backfill
+
+
+# Settings for the benchmark
+n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 2_000_000
+worker_counts = sorted({1, 2} | ({4, 8, os.cpu_count() or 1} & set(range(1, (os.cpu_count() or 1) + 1))))
+
+# Every synthetic complaint type counts as relevant, and the city and borough mappings keep values as they are
+# so the row-by-row mapping stage still runs, as it does on the real data
+mappings = {
+    "relevant_complaints": [f"Complaint Type {i}" for i in range(vocabulary_sizes["complaint_type"])],
+    "city_mapping": {f"CITY {i}": f"CITY {i}" for i in range(vocabulary_sizes["city"])},
+    "borough_mapping": {name.upper(): name.upper() for name in borough_coords} | {"Unspecified": "Unspecified"},
+}
+
+# Surrogate keys of the star schema and the natural columns of their dimension that stand in for them
+dimension_keys = {
+    "location_id": ("dim_location", ["incident_zip", "borough", "city", "location_type", "latitude", "longitude", "incident_modzcta"]),
+    "agency_id": ("dim_agency", ["agency"]),
+    "complaint_type_id": ("dim_complaint_type", ["complaint_type", "complaint_descriptor", "complaint_category"]),
+    "borough_id": ("dim_borough", ["borough_name"]),
+}
+
+# Tables compared, with the columns that identify a row once the surrogate keys are resolved
+compared_tables = {
+    "fact_incidents": ["incident_id"],
+    "fact_weather": ["date_id", "grid_id"],
+    "fact_daily_summary": ["date_id", "borough_name"],
+    "dim_location": ["incident_zip", "borough", "city", "location_type", "latitude", "longitude", "incident_modzcta"],
+    "dim_agency": ["agency"],
+    "dim_complaint_type": ["complaint_type", "complaint_descriptor", "complaint_category"],
+    "dim_borough": ["borough_name"],
+    "dim_date": ["date_id"],
+}
+
+failures = []
+
+
+
+# Function to record a failed check
+def check(condition, message):
+    if not condition:
+        failures.append(message)
+        print(f"FAILED: {message}")
+
+
+# Function to replace the surrogate keys of a table by the natural columns they stand for, in a fixed row order
+# Rows are ordered by every column, since the identifying columns alone can repeat: an incident whose borough and
+# coordinates match several locations is joined to each of them
+def resolve_keys(tables, name) -> pl.DataFrame:
+    table = tables[name]
+    for key, (dimension, natural) in dimension_keys.items():
+        if key not in table.columns:
+            continue
+        if dimension != name:
+            table = table.join(
+                tables[dimension].select([key, *natural]), on = key, how = "left", suffix = "_dim", nulls_equal = True
+            )
+        table = table.drop(key)
+    table = table.drop([column for column in ["weather_id"] if column in table.columns])
+    table = to_text(table.select(sorted(table.columns)))
+    order = compared_tables[name] + [column for column in table.columns if column not in compared_tables[name]]
+    return table.sort(order, nulls_last = True)
+
+
+# Function to check a backfill gave the same tables as the single process
+def same_tables(serial, tables, message):
+    for name in compared_tables:
+        expected, actual = resolve_keys(serial, name), resolve_keys(tables, name)
+        check(expected.columns == actual.columns, f"{message}: same columns of {name}")
+        check(expected.height == actual.height, f"{message}: same rows of {name} ({expected.height} and {actual.height})")
+        if expected.columns == actual.columns and expected.height == actual.height:
+            check(expected.equals(actual), f"{message}: same values in {name}")
+
+
+
+def run_benchmark():
+    # Neither run may read the other's cached stages, nor the project's weather stores, also in the spawned workers
+    stage_cache.cache_enabled = False
+    os.environ["ETL_STAGE_CACHE"] = "0"
+    with tempfile.TemporaryDirectory() as tmp:
+        # Stand-in boundaries for the spatial imputation, in the spawned workers too
+        spatial_imputation.boundary_dir = synthetic_boundaries(Path(tmp) / "boundaries")
+        spatial_imputation.index_cache_dir = Path(tmp) / "spatial_index"
+        os.environ["ETL_BOUNDARY_DIR"] = str(spatial_imputation.boundary_dir)
+        os.environ["ETL_SPATIAL_INDEX_DIR"] = str(spatial_imputation.index_cache_dir)
+        cases_path = Path(tmp) / "nyc_311_full_preprocessed.parquet"
+        weather_path = Path(tmp) / "weather.parquet"
+        # complaint_category is normally filled from the complaint_categories mapping, stood in for by the type itself
+        cases = synthetic_311(n_rows).with_columns(pl.col("complaint_type").alias("complaint_category"))
+        write_profiled_parquet(to_compact(cases), cases_path)
+        synthetic_weather().write_parquet(weather_path)
+
+        start = time.perf_counter()
+        serial = transform_combined(
+            transform_311(pl.read_parquet(cases_path), mappings), pl.read_parquet(weather_path)
+        )
+        serial_time = time.perf_counter() - start
+
+        print(f"Rows: {n_rows:,}, cores: {os.cpu_count()}")
+        print(f"{'mode':>18} {'time (s)':>9} {'speedup':>8} {'fact_incidents':>15}")
+        print(f"{'single process':>18} {serial_time:>9.2f} {1.0:>8.2f} {serial['fact_incidents'].height:>15,}")
+        for workers in worker_counts:
+            weather_cube.cube_folder = Path(tmp) / f"weather_cube_{workers}"
+            weather_features.feature_store_folder = Path(tmp) / f"weather_features_{workers}"
+            start = time.perf_counter()
+            tables = backfill(cases_path, weather_path, mappings, workers, output_dir = Path(tmp) / "backfill")
+            elapsed = time.perf_counter() - start
+            print(f"{f'{workers} workers':>18} {elapsed:>9.2f} {serial_time / elapsed:>8.2f} {tables['fact_incidents'].height:>15,}")
+            same_tables(serial, tables, f"{workers} workers")
+    return bool(failures)
+
+
+
+
+# Entry point for the benchmark, exiting with status 1 when a check fails
+if __name__ == "__main__":
+    sys.exit(1 if run_benchmark() else 0)
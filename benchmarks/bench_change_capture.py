@@ -0,0 +1,82 @@
+# Benchmark of the :updated_at change capture of extract_311, against a Socrata stand-in edited between runs
+#   python -m benchmarks.bench_change_capture [rows] [edited rows]
+# Three extractions with change capture on: the initial load, a run with nothing edited, and a run after some
+# complaints were closed on the stand-in. Each run reports its wall time and the rows the stand-in served
+# The run with nothing edited must pull no row, the run after the edits must pull exactly the edited rows, and in the
+# master dataset only the edited rows may have a new row_hash. Any failed check fails the benchmark
+import sys
+import tempfile
+import time
+from datetime import datetime
+import numpy as np
+import polars as pl
+from benchmarks.bench_pipeline import pipeline_workspace
+from benchmarks.stand_ins import SocrataStandIn
+from benchmarks.synthetic import synthetic_311
+from etl.extraction import extract_311 as extract_311_module
+
+
+# Settings for the benchmark, complaints are created after the default high-water mark of extract_311
+n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+n_edited = int(sys.argv[2]) if len(sys.argv) > 2 else 1_000
+data_start = datetime(2025, 10, 1)
+data_days = 90
+edited_at = "2026-06-01T12:00:00.000"  # after every timestamp of the synthetic rows
+
+failures = []
+
+
+
+# Function to record a failed check
+def check(condition, message):
+    if not condition:
+        failures.append(message)
+        print(f"FAILED: {message}")
+
+
+# Function to run one extraction, returning the master dataset and the rows the stand-in served
+def run_extraction(socrata, name):
+    served = socrata.rows_served
+    start = time.perf_counter()
+    extract_311_module.extract_311(change_capture = True)
+    wall = time.perf_counter() - start
+    served = socrata.rows_served - served
+    print(f"{name:>16} {wall:>9.2f} {served:>12,}")
+    return pl.read_parquet(extract_311_module.main_parquet).select(["unique_key", "row_hash", "closed_date"]), served
+
+
+
+
+def run_benchmark():
+    raw = synthetic_311(n_rows, start = data_start, days = data_days)
+    edited_keys = np.random.default_rng(3).choice(raw["unique_key"].to_numpy(), size = n_edited, replace = False)
+    print(f"Rows: {raw.height:,}, edited between the last two runs: {n_edited:,}")
+    print(f"{'run':>16} {'wall (s)':>9} {'rows pulled':>12}")
+
+    with tempfile.TemporaryDirectory() as tmp, SocrataStandIn(raw) as socrata:
+        with pipeline_workspace(tmp, socrata.url, None, None):
+            initial, served = run_extraction(socrata, "initial load")
+            check(served == raw.height and initial.height == raw.height, "initial load: every row pulled once")
+
+            unchanged, served = run_extraction(socrata, "nothing edited")
+            check(served == 0, f"nothing edited: no row pulled, got {served:,}")
+            check(unchanged.sort("unique_key").equals(initial.sort("unique_key")), "nothing edited: master unchanged")
+
+            socrata.edit_rows(edited_keys, edited_at, closed_date = edited_at, resolution_action_updated_date = edited_at)
+            edited, served = run_extraction(socrata, "after edits")
+            check(served == n_edited, f"after edits: only the {n_edited:,} edited rows pulled, got {served:,}")
+
+    compared = initial.join(edited, on = "unique_key", how = "full", suffix = "_edited", coalesce = True)
+    rehashed = set(compared.filter(pl.col("row_hash") != pl.col("row_hash_edited"))["unique_key"].to_list())
+    check(edited.height == initial.height, "after edits: no row added or lost")
+    check(rehashed == set(edited_keys.tolist()), f"after edits: row_hash changed on the edited rows only, {len(rehashed):,} changed")
+    closed = compared.filter(pl.col("unique_key").is_in(edited_keys.tolist()))["closed_date_edited"]
+    check((closed.cast(pl.Utf8) == edited_at).all(), "after edits: edited rows hold the new closed_date")
+    return bool(failures)
+
+
+
+
+# Entry point for the benchmark, exiting with status 1 when a check fails
+if __name__ == "__main__":
+    sys.exit(1 if run_benchmark() else 0)
@@ -0,0 +1,43 @@
+# Benchmark of the in-memory and on-disk size of a synthetic year of 311 data, plain vs compact schema
+import polars as pl
+import sys
+import tempfile
+import time
+from pathlib import Path
+from benchmarks.synthetic import synthetic_311
+from etl.compact_schema import to_compact
+
+
+# Settings for the benchmark, about one year of NYC 311 requests
+n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 3_200_000
+
+
+
+def run_benchmark():
+    plain = synthetic_311(n_rows).with_columns(pl.col("unique_key").cast(pl.Utf8))
+    compact = to_compact(plain)
+
+    print(f"Rows: {n_rows:,}")
+    print(f"{'schema':>8} {'memory (MB)':>12} {'parquet (MB)':>13} {'write (s)':>10} {'read (s)':>9}")
+    sizes = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, df in [("plain", plain), ("compact", compact)]:
+            path = Path(tmp) / f"{name}.parquet"
+            start = time.perf_counter()
+            df.write_parquet(path)
+            write_time = time.perf_counter() - start
+            start = time.perf_counter()
+            pl.read_parquet(path)
+            read_time = time.perf_counter() - start
+            sizes[name] = (df.estimated_size("mb"), path.stat().st_size / 1e6)
+            print(f"{name:>8} {sizes[name][0]:>12.1f} {sizes[name][1]:>13.1f} {write_time:>10.2f} {read_time:>9.2f}")
+
+    print(f"Memory reduction:  {1 - sizes['compact'][0] / sizes['plain'][0]:.1%}")
+    print(f"On-disk reduction: {1 - sizes['compact'][1] / sizes['plain'][1]:.1%}")
+
+
+
+
+# Entry point for the benchmark
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,63 @@
+# Benchmark of the within-batch deduplication of 311 rows, keeping the earliest record of each unique_key
+#   python -m benchmarks.bench_dedupe [rows]
+# Three ways of keeping the earliest row of each key, on synthetic rows with re-reported complaints:
+#   group_by      a group per key, each sorted by created_date, taking its first row
+#   sort unique   one sort of the whole frame by key and created_date, then unique(keep = "first")
+#   dedupe        only the rows of keys seen more than once are sorted, the rest are kept as they are
+# Every way must keep the same rows, any difference fails the benchmark
+import sys
+import time
+import numpy as np
+import polars as pl
+from benchmarks.synthetic import synthetic_311, dirty_311
+from etl.compact_schema import to_compact
+from etl.transformation.transform_311 import dedupe
+
+
+# Settings for the benchmark
+n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 2_000_000
+repeats = 3
+
+
+
+# Functions keeping the earliest row of each unique_key
+def group_by_first(df: pl.DataFrame) -> pl.DataFrame:
+    return df.group_by("unique_key").agg(pl.all().sort_by("created_date").first()).select(df.columns)
+
+
+def sort_unique(df: pl.DataFrame) -> pl.DataFrame:
+    return df.sort(["unique_key", "created_date"]).unique(subset = "unique_key", keep = "first", maintain_order = True)
+
+
+dedupe_variants = {"group_by": group_by_first, "sort unique": sort_unique, "dedupe": dedupe}
+
+
+
+
+def run_benchmark():
+    df = to_compact(dirty_311(synthetic_311(n_rows)))
+    print(f"Rows: {df.height:,}, unique keys: {df['unique_key'].n_unique():,}")
+    print(f"{'variant':>12} {'median (s)':>11}")
+
+    outputs, failed = {}, False
+    for name, fn in dedupe_variants.items():
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            outputs[name] = fn(df)
+            times.append(time.perf_counter() - start)
+        print(f"{name:>12} {np.median(times):>11.3f}")
+
+    expected = outputs["group_by"].sort("unique_key")
+    for name, output in outputs.items():
+        if not output.sort("unique_key").equals(expected):
+            print(f"FAILED: {name} kept other rows than group_by")
+            failed = True
+    return failed
+
+
+
+
+# Entry point for the benchmark, exiting with status 1 when a check fails
+if __name__ == "__main__":
+    sys.exit(1 if run_benchmark() else 0)
@@ -0,0 +1,132 @@
+# Benchmark of hedged requests against stand-ins that inject random stragglers
+#   python -m benchmarks.bench_hedging [rows] [straggler rate] [straggler delay (s)]
+# The Socrata pages of download_all and the Open-Meteo windows of fetch_weather_window are fetched with hedging off
+# and on, from stand-ins where a random share of the requests waits straggler_delay seconds more. Each run reports
+# its wall time, hedge rate, tail latency and the requests the stand-in served (the load hedging added)
+# The hedged and unhedged runs must return the same rows, the hedges must stay within the budget, each request must
+# be measured as a single stage however many attempts it took, and a request to a stand-in slower than the deadline
+# must fail at the deadline. Any failed check fails the benchmark
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from benchmarks.bench_pipeline import pipeline_workspace
+from benchmarks.stand_ins import SocrataStandIn, OpenMeteoStandIn
+from benchmarks.synthetic import synthetic_311
+from etl.extraction import extract_311 as extract_311_module
+from etl.extraction import extract_weather as extract_weather_module
+from etl.extraction import hedging
+from etl.extraction.checkpoint import SliceManifest
+from etl.extraction.hedging import HedgingPolicy
+from logger import stage_metrics
+
+
+# Settings for the benchmark, pages and windows are kept small so a run makes a few hundred requests
+n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 400_000
+straggler_rate = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+straggler_delay = float(sys.argv[3]) if len(sys.argv) > 3 else 2.0
+latency = 0.05
+page_size = 2_000
+window_days = 3
+data_start = datetime(2025, 10, 1)
+data_days = 365
+created_where = "created_date > '2025-09-25T01:44:42'"
+request_stages = {"socrata": "download_chunk", "open_meteo": "fetch_weather"}
+
+failures = []
+
+
+
+# Function to record a failed check
+def check(condition, message):
+    if not condition:
+        failures.append(message)
+        print(f"FAILED: {message}")
+
+
+# Function to extract every page and every weather window once, with hedging on or off, returning the outputs and
+# the hedging report each extraction logged and the stage totals of the run. Fresh policies are used on every run,
+# so the hedged run learns its hedge delay from scratch
+def run_extraction(hedged):
+    hedging.hedging_enabled = hedged
+    stage_metrics.set_run_id(f"bench_hedging_{'on' if hedged else 'off'}_{time.time_ns()}")
+    extract_311_module.socrata_hedging = HedgingPolicy("socrata")
+    extract_weather_module.open_meteo_hedging = HedgingPolicy("open_meteo")
+
+    outputs, reports = {}, {}
+    start = time.perf_counter()
+    outputs["socrata"] = extract_311_module.download_all(created_where, SliceManifest(f"bench_hedging_{hedged}", created_where))
+    reports["socrata"] = (extract_311_module.socrata_hedging.last_report, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    manifest = SliceManifest(f"bench_hedging_weather_{hedged}", data_start)
+    last_day = data_start + timedelta(days = data_days - 1)
+    outputs["open_meteo"] = extract_weather_module.fetch_weather_window(data_start, last_day, manifest)
+    reports["open_meteo"] = (extract_weather_module.open_meteo_hedging.last_report, time.perf_counter() - start)
+    return outputs, reports, stage_metrics.stage_totals()
+
+
+# Function to check a request to a stand-in slower than the deadline fails at the deadline rather than when it answers
+def check_deadline(raw, deadline = 0.5):
+    with SocrataStandIn(raw.head(10), straggler_rate = 1.0, straggler_delay = 4 * deadline) as socrata:
+        extract_311_module.base_url = socrata.url
+        extract_311_module.socrata_hedging = HedgingPolicy("socrata", deadline = deadline)
+        start = time.perf_counter()
+        try:
+            extract_311_module.download_all(created_where, SliceManifest("bench_hedging_deadline", created_where))
+            raised = False
+        except RuntimeError:
+            raised = True
+        elapsed = time.perf_counter() - start
+    print(f"\nStand-in answering after {4 * deadline:.1f} s, deadline {deadline:.1f} s: failed after {elapsed:.2f} s")
+    check(raised, "deadline: the batch failed")
+    check(elapsed < 2 * deadline, "deadline: the batch failed at the deadline")
+
+
+
+
+def run_benchmark():
+    raw = synthetic_311(n_rows, start = data_start, days = data_days)
+    stragglers = {"straggler_rate": straggler_rate, "straggler_delay": straggler_delay}
+    print(f"Rows: {raw.height:,} in pages of {page_size:,}, {data_days} days of weather in windows of {window_days} days")
+    print(f"Stand-ins: {latency * 1000:.0f} ms per request, {straggler_rate:.0%} of requests {straggler_delay:.1f} s slower")
+    print(f"{'endpoint':>11} {'hedging':>8} {'wall (s)':>9} {'requests':>9} {'served':>7} {'hedges':>7} {'rate':>6} {'wins':>5} "
+          f"{'p50 (s)':>8} {'p95 (s)':>8} {'p99 (s)':>8} {'p99 unhedged (s)':>17}")
+
+    outputs = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for hedged in [False, True]:
+            with SocrataStandIn(raw, latency, seed = 1, **stragglers) as socrata, OpenMeteoStandIn(latency, seed = 2, **stragglers) as open_meteo:
+                with pipeline_workspace(tmp, socrata.url, open_meteo.url, None):
+                    extract_311_module.chunk_size, extract_weather_module.chunk_days = page_size, window_days
+                    outputs[hedged], reports, totals = run_extraction(hedged)
+                    served = {"socrata": socrata.requests, "open_meteo": open_meteo.requests}
+            for endpoint, (report, wall) in reports.items():
+                print(
+                    f"{endpoint:>11} {'on' if hedged else 'off':>8} {wall:>9.2f} {report['requests']:>9} {served[endpoint]:>7} "
+                    f"{report['hedges']:>7} {report['hedge_rate']:>6.1%} {report['hedge_wins']:>5} {report['p50_s']:>8.3f} "
+                    f"{report['p95_s']:>8.3f} {report['p99_s']:>8.3f} {report['p99_unhedged_s']:>17.3f}"
+                )
+                check(report["timeouts"] == 0, f"{endpoint}: no request timed out")
+                check(
+                    report["hedges"] <= hedging.hedge_budget * report["requests"] + hedging.hedge_burst,
+                    f"{endpoint}: hedges within the budget"
+                )
+                stage_calls = totals.get(request_stages[endpoint], {}).get("calls", 0)
+                check(stage_calls == report["requests"], f"{endpoint}: one {request_stages[endpoint]} stage per request")
+
+        sort_keys = {"socrata": ["unique_key"], "open_meteo": ["grid_id", "time"]}
+        for endpoint, keys in sort_keys.items():
+            check(outputs[False][endpoint].sort(keys).equals(outputs[True][endpoint].sort(keys)), f"{endpoint}: same rows with hedging")
+
+        with pipeline_workspace(tmp, None, None, None):
+            check_deadline(raw)
+    hedging.hedging_enabled = True
+    return bool(failures)
+
+
+
+
+# Entry point for the benchmark, exiting with status 1 when a check fails
+if __name__ == "__main__":
+    sys.exit(1 if run_benchmark() else 0)
@@ -0,0 +1,96 @@
+# Benchmark of open time and resident memory when reading the master dataset from Parquet vs the mmap IPC cache
+# Each measurement runs in a fresh process so RSS only reflects that one read
+# Each read ends in the compact schema, as extract_311 merges into it: the text cache written before is cast by
+# to_compact, while the compact cache needs no cast
+import json
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+
+# Settings for the benchmark
+n_rows = int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1].isdigit() else 3_200_000
+repeats = 3
+
+
+
+# Function to read the current resident set size of this process in MB (Linux)
+def rss_mb():
+    import resource
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 1e6
+
+
+
+
+# Function run inside the child process: open the dataset one way and report time and RSS growth
+def measure(mode, parquet_path):
+    import polars as pl
+    from etl.compact_schema import to_compact
+    from etl.ipc_cache import ipc_cache_path
+
+    rss_before = rss_mb()
+    start = time.perf_counter()
+    if mode == "parquet":
+        df = to_compact(pl.read_parquet(parquet_path))
+    elif mode == "ipc text":
+        df = to_compact(pl.read_ipc(Path(parquet_path).with_suffix(".text.arrow"), memory_map = True))
+    else:
+        df = to_compact(pl.read_ipc(ipc_cache_path(parquet_path), memory_map = True))
+    open_time = time.perf_counter() - start
+    rss_open = rss_mb() - rss_before
+
+    # Touching one numeric column, as a transform filtering on coordinates would
+    start = time.perf_counter()
+    df["latitude"].mean()
+    touch_time = time.perf_counter() - start
+    print(json.dumps({
+        "open_s": open_time, "touch_s": touch_time,
+        "rss_open_mb": rss_open, "rss_touch_mb": rss_mb() - rss_before
+    }))
+
+
+
+
+def run_benchmark():
+    from benchmarks.synthetic import synthetic_311
+    from etl.compact_schema import to_compact, to_text
+    from etl.parquet_layout import write_profiled_parquet
+    from etl.ipc_cache import refresh_ipc_cache, ipc_cache_path
+
+    with tempfile.TemporaryDirectory() as tmp:
+        parquet_path = Path(tmp) / "nyc_311_full_preprocessed.parquet"
+        df = to_compact(synthetic_311(n_rows))
+        write_profiled_parquet(df, parquet_path)
+        refresh_ipc_cache(df, parquet_path)
+        to_text(df).write_ipc(parquet_path.with_suffix(".text.arrow"), compression = "uncompressed")
+        del df
+
+        print(f"Rows: {n_rows:,}")
+        print(f"Parquet size: {parquet_path.stat().st_size / 1e6:,.1f} MB, IPC size: {ipc_cache_path(parquet_path).stat().st_size / 1e6:,.1f} MB")
+        print(f"{'mode':>8} {'open (ms)':>10} {'touch (ms)':>11} {'RSS open (MB)':>14} {'RSS touch (MB)':>15}")
+        for mode in ["parquet", "ipc text", "ipc"]:
+            runs = []
+            for _ in range(repeats):
+                output = subprocess.run(
+                    [sys.executable, "-m", "benchmarks.bench_ipc_cache", "--measure", mode, str(parquet_path)],
+                    capture_output = True, text = True, check = True
+                ).stdout
+                runs.append(json.loads(output.strip().splitlines()[-1]))
+            best = min(runs, key = lambda run: run["open_s"])
+            print(
+                f"{mode:>8} {best['open_s'] * 1e3:>10.1f} {best['touch_s'] * 1e3:>11.1f} "
+                f"{best['rss_open_mb']:>14.1f} {best['rss_touch_mb']:>15.1f}"
+            )
+
+
+
+
+# Entry point for the benchmark
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--measure"]:
+        measure(sys.argv[2], sys.argv[3])
+    else:
+        run_benchmark()
@@ -0,0 +1,68 @@
+# Benchmark of the persistent unique_key index: memory, open time and lookup time at 50M keys
+import numpy as np
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+from etl.loading.loaded_key_index import LoadedKeyIndex
+
+
+# Settings for the benchmark
+n_keys = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000_000
+batch_size = 1_000_000
+seed = 4400
+
+
+
+# Function to read the current resident set size of this process in MB (Linux), falling back to the peak
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1e6
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+
+
+def run_benchmark():
+    rng = np.random.default_rng(seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        index_path = Path(tmp) / "loaded_unique_keys.npy"
+
+        # Writing a sorted index of realistic, sparse 311 unique keys
+        keys = np.unique(rng.integers(10_000_000, 10_000_000 + n_keys * 3, size = n_keys, dtype = np.int64))
+        np.save(index_path, keys)
+        n_stored = len(keys)
+        del keys
+        print(f"Index keys:              {n_stored:,}")
+        print(f"Index file size:         {index_path.stat().st_size / 1e6:,.1f} MB")
+
+        rss_before = rss_mb()
+        start = time.perf_counter()
+        index = LoadedKeyIndex(index_path)
+        print(f"Open (mmap) time:        {(time.perf_counter() - start) * 1e3:,.2f} ms")
+
+        # Half of the batch already loaded, half new
+        batch = np.concatenate([
+            np.asarray(index.keys[rng.integers(0, n_stored, size = batch_size // 2)]),
+            rng.integers(10_000_000 + n_keys * 3, 10_000_000 + n_keys * 4, size = batch_size // 2, dtype = np.int64)
+        ])
+        start = time.perf_counter()
+        mask = index.contains(batch)
+        elapsed = time.perf_counter() - start
+        print(f"Lookup {batch_size:,} keys:     {elapsed * 1e3:,.1f} ms ({batch_size / elapsed / 1e6:,.1f}M keys/s)")
+        print(f"Already loaded in batch: {mask.sum():,}")
+
+        start = time.perf_counter()
+        added = index.add(batch[~mask])
+        print(f"Add {added:,} new keys:     {(time.perf_counter() - start):,.2f} s")
+        print(f"RSS growth:              {rss_mb() - rss_before:,.1f} MB")
+
+
+
+
+# Entry point for the benchmark
+if __name__ == "__main__":
+    run_benchmark()
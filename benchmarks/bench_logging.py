@@ -0,0 +1,70 @@
+# Benchmark of logging throughput from 8 threads, synchronous FileHandler vs the queued JSON writer of ETLLogger
+# Caller time is how long the logging threads were held up, total time also includes draining the queue to disk
+import logging
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from logger import etl_logger
+
+
+# Settings for the benchmark
+n_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+n_threads = 8
+
+
+
+# Function to log n_messages per thread, as the hot extraction and load loops do, and return the elapsed time
+def hammer(logger):
+    def worker(thread_index):
+        for i in range(n_messages):
+            logger.info(
+                f"Loaded rows {i * 10_000} to {(i + 1) * 10_000} into fact_incidents",
+                extra = {"stage": "load_chunk", "table": "fact_incidents", "offset": i * 10_000, "worker": thread_index}
+            )
+    threads = [threading.Thread(target = worker, args = (i,)) for i in range(n_threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start
+
+
+
+
+def run_benchmark():
+    total = n_messages * n_threads
+    with tempfile.TemporaryDirectory() as tmp:
+        # Previous handler, a synchronous FileHandler with the plain text format
+        sync_logger = logging.getLogger("bench_sync")
+        sync_logger.propagate = False
+        sync_logger.setLevel(logging.INFO)
+        handler = logging.FileHandler(Path(tmp) / "bench_sync.log")
+        handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+        sync_logger.addHandler(handler)
+        sync_time = hammer(sync_logger)
+        handler.close()
+
+        # Queued handler of ETLLogger, with JSON records written by the background listener
+        queued_logger = etl_logger.ETLLogger("bench_queued", log_folder = tmp).get()
+        queued_logger.propagate = False
+        start = time.perf_counter()
+        caller_time = hammer(queued_logger)
+        etl_logger.stop_logging()
+        queued_total = time.perf_counter() - start
+
+        lines = sum(sum(1 for _ in open(path)) for path in Path(tmp).glob("bench_queued.log*"))
+        print(f"Messages: {total:,} from {n_threads} threads")
+        print(f"{'handler':>22} {'caller (s)':>11} {'total (s)':>10} {'msgs/s (caller)':>16}")
+        print(f"{'sync FileHandler':>22} {sync_time:>11.2f} {sync_time:>10.2f} {total / sync_time:>16,.0f}")
+        print(f"{'queued JSON':>22} {caller_time:>11.2f} {queued_total:>10.2f} {total / caller_time:>16,.0f}")
+        print(f"Lines written by the queued writer: {lines:,}")
+
+
+
+
+# Entry point for the benchmark
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,38 @@
+# Benchmark of nearest weather grid point assignment throughput on synthetic incidents
+import sys
+import time
+from benchmarks.synthetic import nyc_points
+from etl.extraction.extract_weather import weather_grid
+from etl.transformation.nearest_weather import WeatherGridIndex
+
+
+# Settings for the benchmark
+n_points = int(sys.argv[1]) if len(sys.argv) > 1 else 5_000_000
+grid_steps = [0, 0.02, 0.01, 0.005]
+repeats = 3
+
+
+
+def run_benchmark():
+    lat, lon = nyc_points(n_points)
+    print(f"{'grid step':>10} {'grid points':>12} {'build (ms)':>11} {'query (s)':>10} {'points/s':>14}")
+    for step in grid_steps:
+        grid = weather_grid(step)
+
+        start = time.perf_counter()
+        index = WeatherGridIndex(grid)
+        build_time = time.perf_counter() - start
+
+        best = float("inf")
+        for _ in range(repeats):
+            start = time.perf_counter()
+            index.query(lat, lon)
+            best = min(best, time.perf_counter() - start)
+        print(f"{step:>10} {grid.height:>12,} {build_time * 1e3:>11.2f} {best:>10.3f} {n_points / best:>14,.0f}")
+
+
+
+
+# Entry point for the benchmark
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,79 @@
+# Benchmark of file size and scan time of the master dataset across candidate Parquet writer settings
+import polars as pl
+import sys
+import tempfile
+import time
+from pathlib import Path
+from benchmarks.synthetic import synthetic_311
+from etl.compact_schema import to_compact
+from etl.parquet_layout import parquet_profile, write_profiled_parquet, scan_profiled_parquet, key_exists
+
+
+# Settings for the benchmark
+n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 3_200_000
+repeats = 3
+
+# Candidate settings, the first one is the previous default layout
+candidates = {
+    "snappy, unsorted": ({"compression": "snappy", "row_group_size": 1_048_576, "write_statistics": True}, False),
+    "zstd-1, 128k, sorted": ({**parquet_profile, "compression_level": 1}, True),
+    "zstd-3, 128k, sorted": (parquet_profile, True),
+    "zstd-3, 32k, sorted": ({**parquet_profile, "row_group_size": 32_768}, True),
+    "zstd-3, 512k, sorted": ({**parquet_profile, "row_group_size": 524_288}, True),
+    "zstd-9, 128k, sorted": ({**parquet_profile, "compression_level": 9}, True),
+}
+
+
+
+# Function returning the best wall time of a callable over a few repeats
+def best_time(fn):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+
+
+def run_benchmark():
+    df = to_compact(synthetic_311(n_rows)).sample(fraction = 1.0, shuffle = True, seed = 1)
+    last_month = df["created_date"].max()[:7]
+    probe_key = int(df["unique_key"][n_rows // 2])
+    # A key dropped from the data: inside the key range of the unsorted layout's row groups, only bloom filters
+    # rule it out there without reading the column
+    missing_key = probe_key + 1
+    df = df.filter(pl.col("unique_key") != missing_key)
+
+    failed = False
+    print(f"Rows: {n_rows:,}, queries: month {last_month} in Brooklyn, unique_key == {probe_key}, unique_key == {missing_key} (absent)")
+    print(f"{'settings':>22} {'size (MB)':>10} {'write (s)':>10} {'full read (s)':>14} {'month+borough (s)':>18} {'key lookup (s)':>15} {'absent key (s)':>15}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, (profile, sort) in candidates.items():
+            path = Path(tmp) / "master.parquet"
+            start = time.perf_counter()
+            write_profiled_parquet(df, path, profile, sort = sort)
+            write_time = time.perf_counter() - start
+
+            full_read = best_time(lambda: pl.read_parquet(path))
+            month_scan = best_time(lambda: scan_profiled_parquet(
+                path, start = last_month, borough = "BROOKLYN"
+            ).collect())
+            key_scan = best_time(lambda: key_exists(path, probe_key))
+            absent_scan = best_time(lambda: key_exists(path, missing_key))
+            if not key_exists(path, probe_key) or key_exists(path, missing_key):
+                print(f"FAILED: {name}: key_exists answered wrongly")
+                failed = True
+            print(
+                f"{name:>22} {path.stat().st_size / 1e6:>10.1f} {write_time:>10.2f} "
+                f"{full_read:>14.3f} {month_scan:>18.3f} {key_scan:>15.3f} {absent_scan:>15.3f}"
+            )
+    return failed
+
+
+
+
+# Entry point for the benchmark, exiting with status 1 when a lookup answers wrongly
+if __name__ == "__main__":
+    sys.exit(1 if run_benchmark() else 0)
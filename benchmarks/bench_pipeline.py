@@ -0,0 +1,252 @@
+# End-to-end benchmark of the pipeline on synthetic data, against local stand-ins for Socrata, Open-Meteo and BigQuery
+# A scenario times extract_311, extract_weather, transform_311, transform_combined, weather_features, the weather cube
+# and the load into a warehouse sink (BigQuery stand-in, local DuckDB or Parquet lake) on dirty synthetic rows, and
+# saves the timings with the per-stage metrics of the run as JSON
+# The compare command flags every stage that got slower than a threshold between two result files
+#
+#   python -m benchmarks.bench_pipeline run 100k
+#   python -m benchmarks.bench_pipeline run 1m --sink duckdb
+#   python -m benchmarks.bench_pipeline compare benchmarks/results/100k_<before>.json benchmarks/results/100k_<after>.json
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import polars as pl
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from benchmarks.synthetic import synthetic_311, dirty_311, synthetic_mappings, synthetic_boundaries
+from benchmarks.stand_ins import SocrataStandIn, OpenMeteoStandIn, FakeBigQueryClient
+from logger import stage_metrics
+from logger.profiling import enable_profiling, profile_folder
+from etl import quality_profile, stage_cache
+from etl.extraction import checkpoint
+from etl.extraction import extract_311 as extract_311_module
+from etl.extraction import extract_weather as extract_weather_module
+from etl.loading import warehouse_sink
+from etl.transformation.transform_311 import transform_311
+from etl.transformation import spatial_imputation, weather_cube, weather_features
+from etl.transformation.transform_combined import transform_combined
+
+# The load stage needs the BigQuery client library for its job configs, without it the stage is reported as skipped
+try:
+    from etl.loading import load_to_bigquery as load_module
+    load_skipped_reason = None
+except ImportError as e:
+    load_module = None
+    load_skipped_reason = str(e)
+
+
+# Settings for the scenarios, the synthetic complaints start after the default high-water mark of extract_311
+project_root = Path(__file__).resolve().parents[1]
+results_folder = project_root / "benchmarks" / "results"
+scenarios = {"100k": 100_000, "1m": 1_000_000, "10m": 10_000_000}
+data_start = datetime(2025, 10, 1)
+data_days = 365
+
+# Settings for the comparison, stages that move by less than min_regression_seconds are left out as noise
+default_threshold = 0.10
+min_regression_seconds = 0.05
+
+
+
+# Context manager pointing the pipeline at the stand-ins, with every file it writes under folder
+@contextmanager
+def pipeline_workspace(folder, socrata_url, open_meteo_url, client):
+    folder = Path(folder)
+    patches = [
+        (extract_311_module, "base_url", socrata_url),
+        (extract_311_module, "main_parquet", folder / "data" / "nyc_311_full_preprocessed.parquet"),
+        (extract_311_module, "metadata_folder", folder / "metadata"),
+        (extract_311_module, "partition_folder", folder / "data" / "partitions"),
+        (extract_311_module, "master_lock_file", folder / "metadata" / "nyc_311_master.lock"),
+        (checkpoint, "staging_folder", folder / "data" / "staging"),
+        (checkpoint, "metadata_folder", folder / "metadata"),
+        (extract_weather_module, "base_url", open_meteo_url),
+        (extract_weather_module, "metadata_folder", folder / "metadata"),
+        (extract_weather_module, "metadata_file", folder / "metadata" / "weather_last_date.json"),
+        (extract_weather_module, "end_date", data_start + timedelta(days = data_days - 1)),
+        (stage_metrics, "metrics_folder", folder / "metrics"),
+        (warehouse_sink, "key_index_folder", folder / "metadata"),
+        (stage_cache, "cache_folder", folder / "cache" / "stages"),
+        (quality_profile, "profile_folder", folder / "metadata" / "quality"),
+        (weather_features, "feature_store_folder", folder / "metadata" / "weather_features"),
+        (weather_cube, "cube_folder", folder / "data" / "weather_cube"),
+        (spatial_imputation, "boundary_dir", synthetic_boundaries(folder / "mappings" / "boundaries")),
+        (spatial_imputation, "index_cache_dir", folder / "data" / "spatial_index"),
+    ]
+    if load_module is not None:
+        patches.append((load_module, "get_client", lambda: client))
+    previous = [(module, name, getattr(module, name)) for module, name, _ in patches]
+    for module, name, value in patches:
+        setattr(module, name, value)
+    try:
+        yield folder
+    finally:
+        for module, name, value in previous:
+            setattr(module, name, value)
+
+
+
+
+# Function to run one stage, recording its wall time, output size and the peak RSS of the process after it
+def timed(stages, name, fn, *args):
+    start = time.perf_counter()
+    output = fn(*args)
+    wall = time.perf_counter() - start
+    rows, size = stage_metrics.frame_size(output)
+    stages[name] = {
+        "status": "ok", "wall_s": round(wall, 3), "rows_out": rows, "bytes_out": size,
+        "peak_rss_bytes": stage_metrics.peak_rss()
+    }
+    print(f"{name:>20} {wall:>9.2f} s {rows or 0:>12,} rows")
+    return output
+
+
+
+
+# Function to describe the code and machine a result was measured on
+def environment():
+    commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd = project_root, capture_output = True, text = True)
+    return {
+        "commit": commit.stdout.strip() or None,
+        "python": platform.python_version(),
+        "polars": pl.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+
+
+# Function to load the tables into the chosen sink, the local sinks write under the workspace folder
+def load(tables, sink, folder):
+    if sink == "duckdb":
+        from etl.loading.load_to_duckdb import load_to_duckdb
+        return load_to_duckdb(tables, folder / "data" / "warehouse.duckdb")
+    if sink == "lake":
+        from etl.loading.load_to_lake import load_to_lake
+        return load_to_lake(tables, folder / "data" / "lake")
+    return load_module.load_to_bigquery(tables)
+
+
+
+
+# Function to run a scenario end to end and return its results
+# latency adds a delay in seconds to every stand-in request and BigQuery job, 0 measures the pipeline alone
+def run_scenario(name, latency = 0.0, sink = "bigquery"):
+    n_rows = scenarios[name]
+    started_at = datetime.now(timezone.utc)
+    raw = dirty_311(synthetic_311(n_rows, start = data_start, days = data_days))
+    result = {
+        "scenario": name, "rows": n_rows, "rows_served": raw.height, "latency_s": latency, "sink": sink,
+        "created_at": started_at.isoformat(), **environment(), "stages": {}
+    }
+    stages = result["stages"]
+    print(f"Scenario {name}: {raw.height:,} raw 311 rows, {data_days} days of weather")
+
+    with tempfile.TemporaryDirectory() as tmp, SocrataStandIn(raw, latency) as socrata, OpenMeteoStandIn(latency) as open_meteo:
+        client = FakeBigQueryClient(latency = latency)
+        with pipeline_workspace(tmp, socrata.url, open_meteo.url, client) as folder:
+            stage_metrics.set_run_id(f"bench_{name}_{started_at:%Y%m%dT%H%M%S}")
+            (folder / "metadata").mkdir(parents = True)
+            with open(folder / "metadata" / "weather_last_date.json", "w") as f:
+                json.dump({"last_date": (data_start - timedelta(days = 1)).isoformat()}, f)
+
+            cases = timed(stages, "extract_311", extract_311_module.extract_311)
+            weather = timed(stages, "extract_weather", extract_weather_module.extract_weather)
+            # complaint_category is normally filled from the complaint_categories mapping, stood in for by the type itself
+            cases = cases.with_columns(pl.col("complaint_type").alias("complaint_category"))
+            cases = timed(stages, "transform_311", transform_311, cases, synthetic_mappings())
+            tables = timed(stages, "transform_combined", transform_combined, cases, weather)
+            tables = timed(stages, "weather_features", weather_features.add_weather_features, tables)
+            tables = timed(stages, "weather_cube", weather_cube.update_weather_cube, tables)
+            if sink == "bigquery" and load_module is None:
+                stages["load_to_bigquery"] = {"status": "skipped", "reason": load_skipped_reason}
+                print(f"{'load_to_bigquery':>20} skipped ({load_skipped_reason})")
+            else:
+                timed(stages, f"load_to_{sink}", load, tables, sink, folder)
+                if sink == "bigquery":
+                    result["rows_loaded"] = client.rows_loaded()
+
+            result["requests"] = {"socrata": socrata.requests, "open_meteo": open_meteo.requests}
+            result["sub_stages"] = stage_metrics.stage_totals()
+    return result
+
+
+
+
+# Function to save results as JSON, by default under benchmarks/results named by scenario and time
+def save_results(result, output = None):
+    output = Path(output) if output else results_folder / f"{result['scenario']}_{result['created_at'][:19].replace(':', '')}.json"
+    output.parent.mkdir(parents = True, exist_ok = True)
+    with open(output, "w") as f:
+        json.dump(result, f, indent = 2, default = str)
+    return output
+
+
+
+
+# Function to compare two result files, returning the stages whose wall time grew by more than threshold
+# Both the pipeline stages and the sub-stages recorded by the stage metrics are compared
+def compare(baseline, candidate, threshold = default_threshold):
+    if baseline["scenario"] != candidate["scenario"]:
+        print(f"Warning: comparing scenario {baseline['scenario']} with {candidate['scenario']}")
+    regressions = []
+    print(f"{'stage':>32} {'before (s)':>11} {'after (s)':>10} {'change':>8}")
+    for group, key in [("stages", "wall_s"), ("sub_stages", "wall_seconds")]:
+        for name, before in baseline.get(group, {}).items():
+            after = candidate.get(group, {}).get(name)
+            if after is None or key not in before or key not in after or (group == "sub_stages" and name in baseline["stages"]):
+                continue
+            change = (after[key] - before[key]) / before[key] if before[key] > 0 else 0.0
+            regressed = change > threshold and after[key] - before[key] >= min_regression_seconds
+            if regressed:
+                regressions.append({"group": group, "stage": name, "before": before[key], "after": after[key], "change": change})
+            print(f"{name:>32} {before[key]:>11.3f} {after[key]:>10.3f} {change:>+8.1%}{'  REGRESSION' if regressed else ''}")
+    print(f"{len(regressions)} stages slower by more than {threshold:.0%}")
+    return regressions
+
+
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "End-to-end pipeline benchmark on synthetic data")
+    commands = parser.add_subparsers(dest = "command", required = True)
+    run_parser = commands.add_parser("run", help = "run a scenario and save its results as JSON")
+    run_parser.add_argument("scenario", choices = list(scenarios))
+    run_parser.add_argument("--latency", type = float, default = 0.0, help = "seconds added to every stand-in request")
+    run_parser.add_argument("--sink", choices = ["bigquery", "duckdb", "lake"], default = "bigquery",
+                            help = "warehouse to load into, bigquery uses the BigQuery client stand-in")
+    run_parser.add_argument("--output", help = "results file, defaults to benchmarks/results/<scenario>_<time>.json")
+    run_parser.add_argument("--profile", help = "comma-separated stages to profile, as ETL_PROFILE")
+    run_parser.add_argument("--profile-mode", choices = ["sample", "cprofile"], help = "as ETL_PROFILE_MODE")
+    compare_parser = commands.add_parser("compare", help = "flag stages that regressed between two result files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument("--threshold", type = float, default = default_threshold, help = "allowed slowdown, 0.1 = 10%%")
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        if args.profile:
+            enable_profiling(args.profile, args.profile_mode)
+        print(f"Results saved to {save_results(run_scenario(args.scenario, args.latency, args.sink), args.output)}")
+        if args.profile:
+            print(f"Profiles saved to {profile_folder()}")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    return 1 if compare(baseline, candidate, args.threshold) else 0
+
+
+
+
+# Entry point for the benchmark, exiting with 1 when the comparison found regressions
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,161 @@
+# Benchmark of the streaming data-quality profiles against exact statistics computed by rescanning the full frame
+#   python -m benchmarks.bench_quality_profile [rows]
+# A year of dirty raw 311 rows is profiled chunk by chunk, as download_all does, and checked against the exact
+# statistics of the full frame: distinct counts within 4 standard errors of the HyperLogLog, exact counts within the
+# Misra-Gries bounds, and quantiles within the accuracy of their sketch. The profiles stored month by month are
+# combined into the yearly profile, which must equal the single-pass one. Every clean month must raise no drift
+# alert, and a month with an unmapped complaint type spike and missing coordinates must raise both alerts
+import json
+import math
+import sys
+import tempfile
+import time
+import numpy as np
+import polars as pl
+from datetime import datetime
+from pathlib import Path
+from benchmarks.synthetic import synthetic_311, dirty_311, synthetic_mappings
+from etl import quality_profile
+from etl.compact_schema import to_compact, categorical_columns
+from etl.quality_profile import MonthlyProfiles, QualityProfile, ProfileStore, publish_profiles
+
+
+# Settings for the benchmark
+n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1_200_000
+chunk_size = 100_000
+data_start = datetime(2025, 1, 1)
+data_days = 365
+anomaly = {"complaint_type": "Illegal Drone Landing", "share": 0.06, "missing_latitude": 0.2}
+
+failures = []
+
+
+
+# Function to record a failed check
+def check(condition, message):
+    if not condition:
+        failures.append(message)
+        print(f"FAILED: {message}")
+
+
+# Function to profile a frame chunk by chunk, in the compact types download_chunk returns
+def stream_profile(df, profile):
+    for chunk in df.iter_slices(chunk_size):
+        profile.update(to_compact(chunk))
+    return profile
+
+
+# Function to compute the statistics of the profile exactly, by rescanning the full frame in the compact types
+def exact_statistics(df):
+    df = to_compact(df)
+    measures = quality_profile.measures(df)
+    return {
+        "nulls": {name: df[name].null_count() for name in df.columns},
+        "distinct": {name: df[name].n_unique() - (df[name].null_count() > 0) for name in df.columns},
+        "counts": {name: dict(df[name].drop_nulls().value_counts(sort = False).rows()) for name in categorical_columns if name in df.columns},
+        "quantiles": {
+            name: {q: values.drop_nulls().filter(values.drop_nulls().is_finite()).quantile(q, "lower") for q in [0.05, 0.5, 0.95]}
+            for name, values in measures.items()
+        },
+    }
+
+
+
+
+# Function to check a profile against the exact statistics
+def check_accuracy(profile, exact):
+    check(profile.nulls == exact["nulls"], "null counts are exact")
+    worst = max(abs(profile.distinct[name].count() / exact["distinct"][name] - 1) for name in exact["distinct"])
+    print(f"Largest distinct count error: {worst:.2%}")
+    check(worst < 4 * 1.04 / math.sqrt(1 << quality_profile.hll_precision), "distinct counts within 4 standard errors")
+
+    for name, counts in exact["counts"].items():
+        sketch = profile.top_values[name]
+        within = all(sketch.counts.get(value, 0) <= count <= sketch.counts.get(value, 0) + sketch.error for value, count in counts.items())
+        check(within, f"{name}: every exact count within the Misra-Gries bounds")
+        exact_top = sorted(counts.items(), key = lambda item: -item[1])[:3]
+        check([entry["value"] for entry in sketch.top(3)] == [value for value, _ in exact_top], f"{name}: same top 3 values")
+
+    for name, quantiles in exact["quantiles"].items():
+        sketch = profile.quantiles[name]
+        for q, value in quantiles.items():
+            estimate = sketch.quantile(q)
+            tolerance = abs(value) * sketch.parameter * 1.01 if sketch.kind == "relative" else sketch.parameter
+            check(abs(estimate - value) <= tolerance, f"{name}: p{round(q * 100)} {estimate:.4f} within {tolerance:.4f} of {value:.4f}")
+
+
+# Function to check the profile combined from the stored months equals the single-pass one
+def check_merge(combined, single):
+    check(combined.rows == single.rows and combined.nulls == single.nulls, "combined: same rows and null counts")
+    check(all(np.array_equal(combined.distinct[name].registers, sketch.registers) for name, sketch in single.distinct.items()), "combined: same HyperLogLog registers")
+    check(all(combined.quantiles[name].buckets == sketch.buckets for name, sketch in single.quantiles.items()), "combined: same quantile buckets")
+    check(all(combined.top_values[name].total == sketch.total for name, sketch in single.top_values.items()), "combined: same top value totals")
+
+
+
+
+# Function to build the anomalous month: an unmapped complaint type spike and coordinates missing from some rows
+def anomalous_month():
+    df = dirty_311(synthetic_311(n_rows // 12, seed = 7, start = datetime(2026, 1, 1), days = 31))
+    rng = np.random.default_rng(7)
+    return df.with_columns([
+        pl.when(pl.Series(rng.random(df.height)) < anomaly["share"]).then(pl.lit(anomaly["complaint_type"])).otherwise(pl.col("complaint_type")).alias("complaint_type"),
+        pl.when(pl.Series(rng.random(df.height)) < anomaly["missing_latitude"]).then(None).otherwise(pl.col("latitude")).alias("latitude"),
+    ])
+
+
+
+
+def run_benchmark():
+    df = dirty_311(synthetic_311(n_rows, start = data_start, days = data_days))
+    print(f"Rows: {df.height:,} raw 311 rows over {data_days} days, profiled in chunks of {chunk_size:,}")
+
+    start = time.perf_counter()
+    single = stream_profile(df, QualityProfile())
+    profile_time = time.perf_counter() - start
+    start = time.perf_counter()
+    exact = exact_statistics(df)
+    exact_time = time.perf_counter() - start
+    print(f"Streaming profile: {profile_time:.2f} s, exact statistics by rescanning the full frame: {exact_time:.2f} s")
+    check_accuracy(single, exact)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        mapping_folder = Path(tmp) / "mappings"
+        mapping_folder.mkdir()
+        for name, mapping in synthetic_mappings().items():
+            with open(mapping_folder / f"{name}.json", "w") as f:
+                json.dump(mapping, f)
+        quality_profile.mapping_folder = mapping_folder
+        store = ProfileStore(Path(tmp) / "quality")
+
+        # Each month is extracted as its own batch and compared with the months before it
+        clean_alerts = []
+        months = df.with_columns(pl.col("created_date").str.slice(0, 7).alias("batch_month")).partition_by("batch_month", as_dict = False)
+        start = time.perf_counter()
+        for month in sorted(months, key = lambda part: part["batch_month"][0]):
+            clean_alerts += publish_profiles(stream_profile(month.drop("batch_month"), MonthlyProfiles()), store)
+        print(f"Profiled and published {len(months)} monthly batches in {time.perf_counter() - start:.2f} s, {len(clean_alerts)} drift alerts")
+        for alert in clean_alerts:
+            print(f"  {alert}")
+        check(not clean_alerts, "no drift alert on clean months")
+
+        combined = store.combine(store.months())
+        check_merge(combined, single)
+        sizes = [store.path(month).stat().st_size for month in store.months()]
+        print(f"Stored monthly profiles: {len(sizes)}, {np.mean(sizes) / 1e3:.0f} kB each")
+
+        alerts = publish_profiles(stream_profile(anomalous_month(), MonthlyProfiles()), store)
+        print(f"Anomalous month: {len(alerts)} drift alerts")
+        for alert in alerts:
+            print(f"  {alert}")
+        kinds = {(alert["kind"], alert["column"]) for alert in alerts}
+        check(("unmapped_value", "complaint_type") in kinds, "anomalous month: unmapped complaint type spike alert")
+        check(("null_rate", "latitude") in kinds, "anomalous month: latitude null rate alert")
+    return bool(failures)
+
+
+
+
+# Entry point for the benchmark, exiting with status 1 when a check fails
+if __name__ == "__main__":
+    sys.exit(1 if run_benchmark() else 0)
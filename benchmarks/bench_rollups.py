@@ -0,0 +1,90 @@
+# Benchmark of the incremental rollup update as the history grows, checked against full recomputation
+#   python -m benchmarks.bench_rollups [months] [rows per month]
+# Each simulated monthly run loads the month's new incidents plus a reloaded version of some of the previous
+# month's incidents (closed since), the way change capture delivers them. The update merges that delta into the
+# rollups, and is timed against recomputing every rollup from the full history; at each checkpoint the rollups are
+# compared with the recomputation, and any difference fails the benchmark
+import sys
+import tempfile
+import time
+import numpy as np
+import polars as pl
+from datetime import datetime
+from benchmarks.synthetic import synthetic_fact_incidents, default_seed
+from etl.loading.rollups import RollupStore, recompute_rollups
+
+
+# Settings for the benchmark
+n_months = int(sys.argv[1]) if len(sys.argv) > 1 else 24
+rows_per_month = int(sys.argv[2]) if len(sys.argv) > 2 else 200_000
+reload_fraction = 0.05  # share of the previous month's incidents reloaded with a changed closed date
+first_month = datetime(2024, 1, 1)
+n_categories = 12
+
+
+
+# Function to generate the new incidents of a month, with the agency and complaint category names of the
+# transformation output
+def month_incidents(index):
+    start = datetime(first_month.year + (first_month.month - 1 + index) // 12, (first_month.month - 1 + index) % 12 + 1, 1)
+    df = synthetic_fact_incidents(rows_per_month, seed = default_seed + index, start = start, days = 28)
+    return df.with_columns([
+        (pl.col("incident_id") + index * rows_per_month).alias("incident_id"),
+        ("AG" + pl.col("agency_id").cast(pl.Utf8)).alias("agency"),
+        ("Category " + (pl.col("complaint_type_id") % n_categories).cast(pl.Utf8)).alias("complaint_category"),
+    ])
+
+
+# Function to reload part of a month's incidents as closed later, never on their created day
+def reloaded_incidents(df, index):
+    rng = np.random.default_rng(default_seed + 1_000 + index)
+    reloaded = df.filter(pl.Series(rng.random(df.height) < reload_fraction))
+    return reloaded.with_columns([
+        (pl.col("created_date_id") + 1).alias("closed_date_id"),
+        pl.lit(0, dtype = pl.Int64).alias("is_resolved_same_day"),
+    ])
+
+
+
+
+def run_benchmark():
+    checkpoints = {1, 2, n_months} | set(range(4, n_months + 1, 4))
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp:
+        store = RollupStore(tmp)
+        history, previous = [], None
+        print(f"Months: {n_months}, new incidents per month: {rows_per_month:,}, reloaded: {reload_fraction:.0%} of the previous month")
+        print(f"{'month':>5} {'history rows':>13} {'delta rows':>11} {'update (s)':>11} {'recompute (s)':>14} {'rollup rows':>12} {'differences':>12}")
+        for index in range(n_months):
+            delta = month_incidents(index)
+            if previous is not None:
+                delta = pl.concat([reloaded_incidents(previous, index), delta])
+            previous = delta.tail(rows_per_month)
+            history.append(delta)
+
+            start = time.perf_counter()
+            rollups = store.update(delta)
+            update_time = time.perf_counter() - start
+
+            if index + 1 not in checkpoints:
+                continue
+            facts = pl.concat(history)
+            start = time.perf_counter()
+            recompute_rollups(facts)
+            recompute_time = time.perf_counter() - start
+            differences = store.verify(facts)
+            failed = failed or any(differences.values())
+            print(
+                f"{index + 1:>5} {facts.n_unique('incident_id'):>13,} {delta.height:>11,} {update_time:>11.3f} "
+                f"{recompute_time:>14.3f} {sum(df.height for df in rollups.values()):>12,} {sum(differences.values()):>12}"
+            )
+    if failed:
+        print("FAILED: incremental rollups differ from the full recomputation")
+    return failed
+
+
+
+
+# Entry point for the benchmark, exiting with status 1 when the rollups are wrong
+if __name__ == "__main__":
+    sys.exit(1 if run_benchmark() else 0)
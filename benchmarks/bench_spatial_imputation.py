@@ -0,0 +1,49 @@
+# Benchmark of the point-in-polygon grid index used for borough and ZIP imputation
+import numpy as np
+import sys
+import time
+from benchmarks.synthetic import nyc_points, tiled_polygons
+from etl.transformation.spatial_imputation import PolygonGridIndex, points_in_polygon
+
+
+# Settings for the benchmark
+n_points = int(sys.argv[1]) if len(sys.argv) > 1 else 2_000_000
+cell_sizes = [0.02, 0.01, 0.005, 0.0025]
+n_side = 14  # 196 polygons, close to the number of NYC ZIP code areas
+
+
+
+def run_benchmark():
+    polygons = tiled_polygons(n_side)
+    lat, lon = nyc_points(n_points)
+    print(f"Polygons: {len(polygons)}, vertices per polygon: {len(polygons[0][1][0])}, points: {n_points:,}")
+
+    # Brute force reference on a sample, testing every polygon for every point
+    sample = 20_000
+    start = time.perf_counter()
+    reference = np.full(sample, -1)
+    for i, (_, rings) in enumerate(polygons):
+        reference[points_in_polygon(lon[:sample], lat[:sample], rings)] = i
+    brute_rate = sample / (time.perf_counter() - start)
+    print(f"Brute force: {brute_rate:,.0f} points/s")
+
+    print(f"{'cell size':>10} {'build (s)':>10} {'interior':>9} {'lookup (s)':>11} {'points/s':>13} {'matches':>8}")
+    for cell_size in cell_sizes:
+        start = time.perf_counter()
+        index = PolygonGridIndex(polygons, cell_size)
+        build_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        result = index.lookup_index(lon, lat)
+        elapsed = time.perf_counter() - start
+
+        interior = (index.cell_owner >= 0).mean()
+        matches = (result[:sample] == reference).mean()
+        print(f"{cell_size:>10} {build_time:>10.2f} {interior:>9.1%} {elapsed:>11.3f} {n_points / elapsed:>13,.0f} {matches:>8.2%}")
+
+
+
+
+# Entry point for the benchmark
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,123 @@
+# Benchmark of the stage cache on a re-run of an unchanged month: transform_311 and transform_combined run uncached,
+# on a cold cache (computed, hashed and stored) and on a warm cache (returned from the cache)
+#   python -m benchmarks.bench_stage_cache [rows]
+# An edited mapping must miss transform_311, and the LRU eviction must keep the cache under its size limit
+# transform_311 outputs are compared with the uncached run by content; the star schema is compared between the cold
+# and warm runs, since its dimension ids are assigned in a different order on every run, and by row counts with the
+# uncached run. Any difference fails the benchmark
+import json
+import sys
+import tempfile
+import time
+import polars as pl
+from datetime import datetime
+from pathlib import Path
+from benchmarks.synthetic import synthetic_311, synthetic_weather, dirty_311, synthetic_mappings, synthetic_boundaries
+from etl import stage_cache
+from etl.transformation import spatial_imputation
+from etl.transformation.transform_311 import transform_311
+from etl.transformation.transform_combined import transform_combined
+
+
+# Settings for the benchmark
+n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 300_000
+data_start = datetime(2025, 10, 1)
+
+
+
+# Function to run both transformation stages, returning their outputs and wall time
+def run_transform(cases, weather, mappings):
+    start = time.perf_counter()
+    transformed = transform_311(cases, mappings)
+    tables = transform_combined(transformed, weather)
+    return transformed, tables, time.perf_counter() - start
+
+
+# Function to check two runs produced the same transform_311 rows and star schema tables of the same sizes
+def same_outputs(left, right):
+    return stage_cache.frame_digest(left[0]) == stage_cache.frame_digest(right[0]) and all(
+        left[1][name].shape == right[1][name].shape for name in left[1]
+    )
+
+
+# Function to get the number of entries and the size of the cache, as counted by the eviction
+def cache_size(folder):
+    manifests = [json.loads(path.read_text()) for path in Path(folder).glob(f"*/*/{stage_cache.manifest_name}")]
+    return len(manifests), sum(manifest["bytes"] for manifest in manifests)
+
+
+# Function to get the number of entries of each stage in the cache
+def stage_entries(folder) -> dict:
+    return {
+        stage.name: len(list(stage.glob(f"*/{stage_cache.manifest_name}"))) for stage in Path(folder).iterdir() if stage.is_dir()
+    }
+
+
+
+
+def run_benchmark():
+    cases = dirty_311(synthetic_311(n_rows, start = data_start, days = 31))
+    # complaint_category is normally filled from the complaint_categories mapping, stood in for by the type itself
+    cases = cases.with_columns(pl.col("complaint_type").alias("complaint_category"))
+    weather = synthetic_weather(start = data_start, days = 31)
+    mappings = synthetic_mappings()
+    failed = False
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = stage_cache.cache_folder = Path(tmp) / "stages"
+        spatial_imputation.boundary_dir = synthetic_boundaries(Path(tmp) / "boundaries")
+        spatial_imputation.index_cache_dir = Path(tmp) / "spatial_index"
+        print(f"Rows: {cases.height:,} raw 311 rows, {weather.height:,} weather rows")
+        print(f"{'run':>26} {'time (s)':>9} {'entries':>8} {'cache (MB)':>11}")
+
+        stage_cache.cache_enabled = False
+        uncached = run_transform(cases, weather, mappings)
+        print(f"{'uncached':>26} {uncached[2]:>9.2f} {0:>8} {0:>11.1f}")
+
+        stage_cache.cache_enabled = True
+        runs = {}
+        for run in ["cold cache", "warm cache (re-run)"]:
+            runs[run] = run_transform(cases, weather, mappings)
+            entries, size = cache_size(cache)
+            print(f"{run:>26} {runs[run][2]:>9.2f} {entries:>8} {size / 1e6:>11.1f}")
+            if not same_outputs(uncached, runs[run]):
+                print(f"FAILED: {run} outputs differ from the uncached run")
+                failed = True
+        cold, warm = runs.values()
+        if not all(cold[1][name].equals(warm[1][name]) for name in cold[1]):
+            print("FAILED: the warm run did not return the tables of the cold run")
+            failed = True
+
+        # A mapping entry no row uses: transform_311 misses, and transform_combined hits again on the same output
+        before = stage_entries(cache)
+        edited = {**mappings, "city_mapping": {**mappings["city_mapping"], "UNUSED CITY": "UNUSED CITY"}}
+        outputs = run_transform(cases, weather, edited)
+        entries, size = cache_size(cache)
+        after = stage_entries(cache)
+        print(f"{'edited mapping':>26} {outputs[2]:>9.2f} {entries:>8} {size / 1e6:>11.1f}")
+        print(f"{'':>26} entries per stage before {before}, after {after}")
+        if after.get("transform_311") != before.get("transform_311", 0) + 1:
+            print("FAILED: the edited mapping did not miss transform_311")
+            failed = True
+        if after.get("transform_combined") != before.get("transform_combined"):
+            print("FAILED: the edited mapping missed transform_combined, whose input did not change")
+            failed = True
+        if not same_outputs(uncached, outputs):
+            print("FAILED: the edited mapping changed the outputs")
+            failed = True
+
+        # Evicting down to half the cache keeps the most recently used entries
+        stage_cache.evict(cache, max_bytes = size // 2)
+        entries_after, size_after = cache_size(cache)
+        print(f"{'evicted to half':>26} {'':>9} {entries_after:>8} {size_after / 1e6:>11.1f}")
+        if size_after > size // 2:
+            print("FAILED: eviction left the cache over its limit")
+            failed = True
+    return failed
+
+
+
+
+# Entry point for the benchmark, exiting with status 1 when a check fails
+if __name__ == "__main__":
+    sys.exit(1 if run_benchmark() else 0)
@@ -0,0 +1,191 @@
+# Check of the schema manager against the BigQuery stand-in, and estimate of the scan reduction the partitioning and
+# clustering of the fact tables bring, measured on a DuckDB mirror of fact_incidents
+#   python -m benchmarks.bench_warehouse_layout [rows]
+# The check migrates an empty dataset, a dataset created by the previous table script (unpartitioned, without the
+# columns added since) and the migrated dataset again, which must need no migration; no statement may drop data
+# The estimate writes the mirror twice as Parquet with DuckDB: one unpartitioned file in arrival order, and one
+# file per month with rows sorted by the clustering columns. A dashboard query scans the columns it reads in the
+# row groups whose min/max statistics match its filters, which is how BigQuery prunes partitions and clustered
+# blocks, while the unpartitioned table is scanned in full. Scanned bytes are counted the way BigQuery bills them:
+# 8 bytes per INT64, FLOAT64 and DATE value, 2 bytes plus the UTF-8 length per STRING value
+import re
+import sys
+import tempfile
+import time
+import duckdb
+import polars as pl
+from datetime import date, datetime
+from pathlib import Path
+from benchmarks.stand_ins import FakeBigQueryClient
+from benchmarks.synthetic import synthetic_fact_incidents
+from etl.loading.schema_manager import migrate, plan_migrations
+from etl.loading.warehouse_schema import warehouse_schema, table_clustering, conform
+
+
+# Settings for the benchmark
+n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 2_000_000
+dataset_id = "benchmark_dataset"
+data_start = datetime(2025, 10, 1)
+data_days = 365
+row_group_size = 122_880  # DuckDB's own row group size
+
+# Columns the fact tables did not have when the previous table script created them
+added_columns = {"fact_incidents": ["borough_id", "created_date"], "fact_weather": ["date"], "fact_daily_summary": ["date"]}
+
+# Statements that would lose stored rows, none of which the schema manager may send
+destructive_statement = re.compile(r"^\s*(DROP|DELETE|TRUNCATE|CREATE OR REPLACE)\b", re.I)
+
+# Dashboard queries on fact_incidents: filters as column -> (low, high), and the columns grouped by
+dashboard_queries = {
+    "one borough, one month": ({"created_date": (date(2026, 3, 1), date(2026, 3, 31)), "borough_id": (3, 3)}, ["complaint_type_id"]),
+    "one type, one quarter": ({"created_date": (date(2026, 1, 1), date(2026, 3, 31)), "complaint_type_id": (40, 40)}, ["created_date"]),
+    "one agency, last month": ({"created_date": (date(2026, 9, 1), date(2026, 9, 30)), "agency_id": (5, 5)}, ["resolution_status"]),
+    "all boroughs, full year": ({"created_date": (date(2025, 10, 1), date(2026, 9, 30))}, ["borough_id"]),
+}
+
+failures = []
+
+
+
+# Function to record a failed check
+def check(condition, message):
+    if not condition:
+        failures.append(message)
+        print(f"FAILED: {message}")
+
+
+
+
+# Function to check the migrations of an empty dataset, of the previous tables, and of an up-to-date dataset
+def check_schema_manager():
+    client = FakeBigQueryClient()
+    applied = migrate(client, dataset_id)
+    check([m["action"] for m in applied] == ["create"] * len(warehouse_schema), "empty dataset: every table created")
+    check(plan_migrations(client, dataset_id) == [], "empty dataset: nothing left to migrate")
+    print("DDL of the fact tables:")
+    for statement in client.queries:
+        if "fact_" in statement:
+            print(f"  {statement}")
+
+    client = FakeBigQueryClient()
+    for table_name, columns in warehouse_schema.items():
+        previous = [column for column in columns if column[0] not in added_columns.get(table_name, [])]
+        client.add_table(f"{client.project}.{dataset_id}.{table_name}", previous)
+    applied = migrate(client, dataset_id)
+    check(
+        sorted((m["table"], m["action"]) for m in applied) == sorted((table, "add") for table in added_columns),
+        "previous tables: only columns added without rebuilds"
+    )
+    remaining = plan_migrations(client, dataset_id)
+    check(sorted(m["table"] for m in remaining if m["action"] == "rebuild") == sorted(added_columns), "previous tables: rebuilds pending")
+    migrate(client, dataset_id, allow_rebuild = True)
+    check(plan_migrations(client, dataset_id) == [], "previous tables: nothing left to migrate after the rebuilds")
+    backups = [ref for ref in client.tables if "__backup_" in ref]
+    check(len(backups) == len(added_columns), "previous tables: originals kept as backups")
+    print("Migration of the previous tables:")
+    for statement in client.queries:
+        print(f"  {statement}")
+    check(not any(destructive_statement.match(statement) for statement in client.queries), "no destructive statement sent")
+
+
+
+
+# Function to write the unpartitioned and the partitioned and clustered mirrors of fact_incidents
+def write_mirrors(connection, df, folder):
+    connection.register("incidents", df.to_arrow())
+    flat = folder / "flat.parquet"
+    connection.execute(f"COPY incidents TO '{flat}' (FORMAT PARQUET, ROW_GROUP_SIZE {row_group_size})")
+
+    clustering = ", ".join(table_clustering["fact_incidents"])
+    months = connection.execute("SELECT DISTINCT strftime(created_date, '%Y%m') FROM incidents ORDER BY 1").fetchall()
+    for (month,) in months:
+        path = folder / "partitioned" / f"month={month}" / "data.parquet"
+        path.parent.mkdir(parents = True)
+        connection.execute(
+            f"COPY (SELECT * FROM incidents WHERE strftime(created_date, '%Y%m') = '{month}' ORDER BY {clustering}) "
+            f"TO '{path}' (FORMAT PARQUET, ROW_GROUP_SIZE {row_group_size})"
+        )
+    connection.unregister("incidents")
+    return str(flat), str(folder / "partitioned" / "*" / "*.parquet")
+
+
+
+
+# Function to get the bytes per row BigQuery bills for each column of a table
+def billed_widths(df, table_name):
+    return {
+        name: 2 + df[name].str.len_bytes().mean() if field_type == "STRING" else 8
+        for name, field_type, _ in warehouse_schema[table_name]
+    }
+
+
+# Function to estimate the bytes a query scans and the row groups it reads, from the Parquet statistics
+def scanned_bytes(connection, source, filters, widths, prune = True):
+    metadata = pl.from_arrow(connection.execute(
+        f"SELECT file_name, row_group_id, row_group_num_rows, path_in_schema, stats_min_value, stats_max_value "
+        f"FROM parquet_metadata('{source}')"
+    ).arrow())
+    total_bytes, row_groups, read_groups = 0, 0, 0
+    for _, group in metadata.group_by(["file_name", "row_group_id"]):
+        row_groups += 1
+        stats = {row["path_in_schema"]: row for row in group.iter_rows(named = True)}
+        if prune and any(
+            stats[name]["stats_max_value"] < str(low) or stats[name]["stats_min_value"] > str(high)
+            if isinstance(low, date) else int(stats[name]["stats_max_value"]) < low or int(stats[name]["stats_min_value"]) > high
+            for name, (low, high) in filters.items()
+        ):
+            continue
+        read_groups += 1
+        total_bytes += group["row_group_num_rows"][0] * sum(widths.values())
+    return total_bytes, read_groups, row_groups
+
+
+# Function to build the SQL of a dashboard query over a Parquet source
+def query_sql(source, filters, group_by):
+    where = " AND ".join(
+        f"{name} BETWEEN DATE '{low}' AND DATE '{high}'" if isinstance(low, date) else f"{name} BETWEEN {low} AND {high}"
+        for name, (low, high) in filters.items()
+    )
+    return f"SELECT {', '.join(group_by)}, count(*) AS incidents FROM read_parquet('{source}') WHERE {where} GROUP BY ALL ORDER BY ALL"
+
+
+# Function returning the best wall time and the result of a query over a few repeats
+def timed_query(connection, sql, repeats = 3):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = connection.execute(sql).fetchall()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+
+
+def run_scan_estimate():
+    df = conform(synthetic_fact_incidents(n_rows, start = data_start, days = data_days), "fact_incidents")
+    widths = billed_widths(df, "fact_incidents")
+    connection = duckdb.connect()
+    with tempfile.TemporaryDirectory() as tmp:
+        flat, partitioned = write_mirrors(connection, df, Path(tmp))
+        print(f"\nRows: {n_rows:,}, clustering: {', '.join(table_clustering['fact_incidents'])}, row groups of {row_group_size:,} rows")
+        print(f"{'query':>24} {'flat (MB)':>10} {'layout (MB)':>12} {'reduction':>10} {'row groups':>11} {'flat (s)':>9} {'layout (s)':>11}")
+        for name, (filters, group_by) in dashboard_queries.items():
+            columns = {name: widths[name] for name in [*filters, *group_by]}
+            flat_bytes, _, _ = scanned_bytes(connection, flat, filters, columns, prune = False)
+            layout_bytes, read_groups, row_groups = scanned_bytes(connection, partitioned, filters, columns)
+            flat_time, flat_result = timed_query(connection, query_sql(flat, filters, group_by))
+            layout_time, layout_result = timed_query(connection, query_sql(partitioned, filters, group_by))
+            check(flat_result == layout_result, f"{name}: same result on both layouts")
+            print(
+                f"{name:>24} {flat_bytes / 1e6:>10.1f} {layout_bytes / 1e6:>12.1f} {1 - layout_bytes / flat_bytes:>10.0%} "
+                f"{read_groups:>5}/{row_groups:<5} {flat_time:>9.3f} {layout_time:>11.3f}"
+            )
+
+
+
+
+# Entry point for the benchmark, exiting with status 1 when a check fails
+if __name__ == "__main__":
+    check_schema_manager()
+    run_scan_estimate()
+    sys.exit(1 if failures else 0)
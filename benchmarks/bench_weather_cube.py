@@ -0,0 +1,148 @@
+# Benchmark of enriching incidents with the weather of their day and borough, hash join against the weather cube
+#   python -m benchmarks.bench_weather_cube [incidents] [years]
+# Years of synthetic fact_weather over a grid of several points per borough are aggregated to the daily weather of
+# each borough and written into a stored cube. Synthetic fact_incidents, some created on days without weather, are
+# then enriched with it twice: with a left join of the daily weather on (created_date_id, borough_id), and with the
+# stored cube memory-mapped and looked up by day offset and borough
+# Both must give the same weather and the same nulls, the flags derived from the cube must equal the flags of the
+# grid points as fact_daily_summary aggregated them, and appending a day must write the stored cube in place
+# Any failed check fails the benchmark
+import sys
+import tempfile
+import time
+import numpy as np
+import polars as pl
+from datetime import datetime, timedelta
+from benchmarks.synthetic import synthetic_weather, synthetic_fact_incidents
+from etl.transformation.dim_date import date_id_expr
+from etl.transformation.weather_cube import (
+    WeatherCubeStore, cube_variables, daily_borough_weather, weather_flags, weather_summary
+)
+
+
+# Settings for the benchmark
+n_incidents = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000_000
+years = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+data_start = datetime(2016, 1, 1)
+grid_step = 0.05
+days_without_weather = 30  # incidents are created up to this many days past the last day of weather
+tolerance = 1e-5  # relative, the cube holds float32
+
+failures = []
+
+
+
+# Function to record a failed check
+def check(condition, message):
+    if not condition:
+        failures.append(message)
+        print(f"FAILED: {message}")
+
+
+# Function to build fact_weather rows the way transform_combined does, from synthetic Open-Meteo rows
+def synthetic_fact_weather(start, days) -> pl.DataFrame:
+    boroughs = pl.DataFrame({
+        "borough": ["Manhattan", "Brooklyn", "Queens", "Bronx", "Staten Island"],
+        "borough_id": [1, 2, 3, 4, 5],
+    })
+    return synthetic_weather(start = start, days = days, step = grid_step).rename({
+        "temperature_2m_max": "temperature_max",
+        "temperature_2m_min": "temperature_min",
+        "precipitation_sum": "precipitation_total",
+        "rain_sum": "rain_total",
+        "showers_sum": "showers_total",
+        "snowfall_sum": "snowfall_total",
+        "windspeed_10m_max": "windspeed_max",
+        "windgusts_10m_max": "windgust_max",
+    }).with_columns([
+        date_id_expr(pl.col("time").str.strptime(pl.Date, "%Y-%m-%d")).alias("date_id"),
+        # Some dry days, so the flags are not all set
+        pl.when(pl.col("rain_total") < 8).then(0.0).otherwise(pl.col("rain_total")).alias("rain_total"),
+        pl.when(pl.col("snowfall_total") < 20).then(0.0).otherwise(pl.col("snowfall_total")).alias("snowfall_total"),
+    ]).join(boroughs, on = "borough", how = "left").with_columns([
+        (pl.col("rain_total") > 0).cast(pl.Int64).alias("rain_flag"),
+        (pl.col("showers_total") > 0).cast(pl.Int64).alias("showers_flag"),
+        (pl.col("snowfall_total") > 0).cast(pl.Int64).alias("snow_flag"),
+        ((pl.col("windspeed_max") > 15) | (pl.col("windgust_max") > 20)).cast(pl.Int64).alias("high_wind_flag"),
+    ])
+
+
+# Function to enrich incidents with a left join of the daily weather, as fact_daily_summary was built before the cube
+def join_weather(incidents: pl.DataFrame, daily: pl.DataFrame) -> pl.DataFrame:
+    return incidents.join(
+        daily, left_on = ["created_date_id", "borough_id"], right_on = ["date_id", "borough_id"], how = "left"
+    )
+
+
+# Function to check two enrichments of the same rows hold the same weather
+def same_weather(joined: pl.DataFrame, enriched: pl.DataFrame, message):
+    for name in cube_variables:
+        a, b = joined[name].cast(pl.Float64), enriched[name].cast(pl.Float64)
+        same_nulls = (a.is_null() == b.is_null()).all()
+        error = ((a - b).abs() / a.abs().clip(1e-3)).max()
+        check(same_nulls and (error is None or error <= tolerance), f"{message}: same {name}")
+
+
+
+
+def run_benchmark():
+    weather_days = 365 * years
+    fact_weather = synthetic_fact_weather(data_start, weather_days)
+    start = time.perf_counter()
+    daily = daily_borough_weather(fact_weather)
+    print(f"Weather: {years} years, {fact_weather.height:,} fact_weather rows aggregated to {daily.height:,} borough days in {time.perf_counter() - start:.2f} s")
+    incidents = synthetic_fact_incidents(n_incidents, start = data_start, days = weather_days + days_without_weather)
+    print(f"Incidents: {incidents.height:,}, {days_without_weather} days created after the last day of weather")
+
+    # Flags derived from the cube against the flags of the grid points, aggregated as fact_daily_summary did
+    grid_flags = fact_weather.group_by(["date_id", "borough_id"]).agg([
+        pl.col(name).max() for name in ["rain_flag", "showers_flag", "snow_flag", "high_wind_flag"]
+    ]).with_columns((pl.col("date_id") * 10 + pl.col("borough_id")).alias("key")).sort("key")
+    derived = weather_summary(daily).with_columns((pl.col("date_id") * 10 + pl.col("borough_id")).alias("key")).sort("key")
+    for name in [name for name in weather_flags if name.endswith("_flag")]:
+        check(derived[name].equals(grid_flags[name]), f"{name}: same as the flags of the grid points")
+    check(0 < derived["snow_flag"].mean() < 1, "snow_flag: both snowy and dry days")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = WeatherCubeStore(tmp)
+        start = time.perf_counter()
+        store.update(daily)
+        print(f"Cube written: {time.perf_counter() - start:.3f} s, {store.path.stat().st_size / 1e6:.1f} MB on disk "
+              f"against {daily.estimated_size() / 1e6:.1f} MB for the daily weather frame")
+
+        start = time.perf_counter()
+        joined = join_weather(incidents, daily)
+        join_time = time.perf_counter() - start
+        start = time.perf_counter()
+        cube = store.open()
+        enriched = cube.enrich(incidents, "created_date_id", "borough_id")
+        cube_time = time.perf_counter() - start
+        print(f"Enrichment of {incidents.height:,} incidents: hash join {join_time:.2f} s, cube {cube_time:.2f} s ({join_time / cube_time:.1f}x)")
+        check(joined.height == enriched.height, "same number of rows")
+        same_weather(joined, enriched, "join against cube")
+        check(enriched["temperature_max"].null_count() > 0, "incidents without weather are null")
+
+        # Days past the end of the cube are written in place, into the room the file was allocated with
+        inode = store.path.stat().st_ino
+        last_day = data_start + timedelta(days = weather_days)
+        new_days = daily_borough_weather(synthetic_fact_weather(last_day, days_without_weather))
+        appends = []
+        for day in new_days.partition_by("date_id", maintain_order = True):
+            start = time.perf_counter()
+            store.update(day)
+            appends.append(time.perf_counter() - start)
+        print(f"Appending a day: {np.median(appends) * 1000:.2f} ms, {len(appends)} days")
+        check(store.path.stat().st_ino == inode, "days appended in place")
+        same_weather(
+            join_weather(incidents, pl.concat([daily, new_days])), store.open().enrich(incidents, "created_date_id", "borough_id"),
+            "after appending"
+        )
+        del cube
+    return bool(failures)
+
+
+
+
+# Entry point for the benchmark, exiting with status 1 when a check fails
+if __name__ == "__main__":
+    sys.exit(1 if run_benchmark() else 0)
@@ -0,0 +1,161 @@
+# Benchmark of the incremental weather features against recomputing them from the full history
+#   python -m benchmarks.bench_weather_features [years] [daily batches]
+# Years of synthetic fact_weather, with a few days missing, are loaded into the feature store, then each following
+# day is added as its own batch the way the daily DAG run does, and a past window is extracted again with new values
+# Every incremental update is timed against a full recompute of the history. The features loaded so far (the latest
+# row of each feature_id) must equal the full recompute, and the full recompute must equal the features computed
+# with one self-join per feature in DuckDB, the way they would be queried from fact_weather. Any failed check fails
+# the benchmark
+import sys
+import tempfile
+import time
+import duckdb
+import numpy as np
+import polars as pl
+from datetime import datetime, timedelta
+from benchmarks.synthetic import synthetic_weather
+from etl.transformation.dim_date import date_id_expr
+from etl.transformation.weather_features import (
+    WeatherFeatureStore, compute_features, daily_weather, derived_columns, feature_key, weather_features
+)
+
+
+# Settings for the benchmark
+years = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+n_batches = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+data_start = datetime(2020, 1, 1)
+missing_days = 12  # days without weather in the history, as when an Open-Meteo window failed
+tolerance = 1e-6  # features are rounded to 6 decimals
+weather_columns = ["temperature_max", "temperature_min", "precipitation_total", "rain_total", "snowfall_total", "windgust_max"]
+
+failures = []
+
+
+
+# Function to record a failed check
+def check(condition, message):
+    if not condition:
+        failures.append(message)
+        print(f"FAILED: {message}")
+
+
+# Function to build fact_weather rows shaped like transform_combined's, from synthetic Open-Meteo rows
+# Temperatures are moved down so that winters have freeze-thaw days
+def synthetic_fact_weather(start, days, seed = 0) -> pl.DataFrame:
+    weather = synthetic_weather(seed = seed, start = start, days = days)
+    return weather.rename({
+        "temperature_2m_max": "temperature_max",
+        "temperature_2m_min": "temperature_min",
+        "precipitation_sum": "precipitation_total",
+        "rain_sum": "rain_total",
+        "snowfall_sum": "snowfall_total",
+        "windgusts_10m_max": "windgust_max",
+    }).with_columns([
+        date_id_expr(pl.col("time").str.strptime(pl.Date, "%Y-%m-%d")).alias("date_id"),
+        pl.col("borough").rank("dense").cast(pl.Int64).alias("borough_id"),
+        (pl.col("temperature_max") - 8).alias("temperature_max"),
+        (pl.col("temperature_min") - 12).alias("temperature_min"),
+    ]).select(["date_id", "borough_id", "grid_id", *weather_columns])
+
+
+
+
+# Function to compute the features of every day with one self-join per feature, as a reference
+def self_join_features(daily: pl.DataFrame) -> pl.DataFrame:
+    daily = daily.with_columns([expr.alias(name) for name, expr in derived_columns.items()])
+    connection = duckdb.connect()
+    connection.register("daily", daily.to_arrow())
+    features = daily.select(["date", "borough_id"])
+    for name, (kind, column, days) in weather_features.items():
+        if kind == "lag":
+            query = f"""
+                SELECT d.date, d.borough_id, p.{column} AS {name}
+                FROM daily d LEFT JOIN daily p ON p.borough_id = d.borough_id AND p.date = d.date - {days}
+            """
+        else:
+            aggregate = {"sum": "SUM", "mean": "AVG", "min": "MIN", "max": "MAX"}[kind]
+            query = f"""
+                SELECT d.date, d.borough_id, CASE WHEN COUNT(p.{column}) = {days} THEN {aggregate}(p.{column}) END AS {name}
+                FROM daily d JOIN daily p ON p.borough_id = d.borough_id AND p.date BETWEEN d.date - {days - 1} AND d.date
+                GROUP BY d.date, d.borough_id
+            """
+        result = pl.from_arrow(connection.execute(query).arrow())
+        features = features.join(result.with_columns(pl.col("date").cast(pl.Date)), on = ["date", "borough_id"], how = "left")
+    connection.close()
+    return features.with_columns(
+        (date_id_expr("date") * 100 + pl.col("borough_id")).alias(feature_key)
+    ).drop(["date", "borough_id"])
+
+
+# Function to check two frames of features hold the same values for the same keys
+def same_features(left: pl.DataFrame, right: pl.DataFrame, message):
+    check(left.height == right.height, f"{message}: same rows ({left.height} and {right.height})")
+    joined = left.join(right, on = feature_key, how = "inner", suffix = "_right")
+    check(joined.height == left.height, f"{message}: same keys")
+    for name in weather_features:
+        a, b = joined[name].cast(pl.Float64), joined[f"{name}_right"].cast(pl.Float64)
+        same_nulls = (a.is_null() == b.is_null()).all()
+        difference = (a - b).abs().max()
+        check(same_nulls and (difference is None or difference <= tolerance), f"{message}: same {name}")
+
+
+
+
+def run_benchmark():
+    history_days = 365 * years
+    batch_start = data_start + timedelta(days = history_days)
+    fact_weather = synthetic_fact_weather(data_start, history_days + n_batches)
+    rng = np.random.default_rng(3)
+    dropped = [int((data_start + timedelta(days = int(offset))).strftime("%Y%m%d")) for offset in rng.choice(history_days, missing_days, replace = False)]
+    fact_weather = fact_weather.filter(~pl.col("date_id").is_in(dropped))
+    batch_ids = date_id_expr(pl.lit(batch_start).cast(pl.Date))
+    history, batches = fact_weather.filter(pl.col("date_id") < batch_ids), fact_weather.filter(pl.col("date_id") >= batch_ids)
+    print(f"History: {years} years of fact_weather ({history.height:,} rows, {missing_days} days missing), {n_batches} daily batches")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = WeatherFeatureStore(tmp)
+        start = time.perf_counter()
+        loaded = [store.update(daily_weather(history))]
+        print(f"Initial load of the history: {time.perf_counter() - start:.3f} s, {loaded[0].height:,} borough days")
+
+        incremental, full, full_rows = [], [], 0
+        for batch in batches.partition_by("date_id", maintain_order = True):
+            start = time.perf_counter()
+            loaded.append(store.update(daily_weather(batch)))
+            incremental.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            daily = store.read()
+            full_rows = compute_features(daily, daily["date"].min(), daily["date"].max()).height
+            full.append(time.perf_counter() - start)
+        # The rows a batch returns are the rows the load hashes and compares against the key index
+        print(f"Daily batch: {np.median(incremental) * 1000:.1f} ms and {np.mean([df.height for df in loaded[1:]]):.0f} rows incremental, "
+              f"{np.median(full) * 1000:.1f} ms and {full_rows:,} rows full recompute")
+
+        # A past window extracted again with different values, whose later days must change with it
+        window = synthetic_fact_weather(batch_start - timedelta(days = 40), 10, seed = 9)
+        start = time.perf_counter()
+        loaded.append(store.update(daily_weather(window)))
+        print(f"Re-extracted window of 10 days: {time.perf_counter() - start:.3f} s, {loaded[-1].height} rows recomputed")
+
+        latest = pl.concat(loaded).unique(subset = [feature_key], keep = "last")
+        daily = store.read()
+        start = time.perf_counter()
+        rebuilt = compute_features(daily, daily["date"].min(), daily["date"].max())
+        print(f"Full recompute: {time.perf_counter() - start:.3f} s")
+        same_features(latest, rebuilt, "incremental against full recompute")
+        hashes = latest.join(rebuilt, on = feature_key, suffix = "_rebuilt")
+        check((hashes["row_hash"] == hashes["row_hash_rebuilt"]).all(), "incremental against full recompute: same row hashes")
+
+        start = time.perf_counter()
+        reference = self_join_features(daily)
+        print(f"Self-join per feature in DuckDB: {time.perf_counter() - start:.3f} s")
+        same_features(rebuilt, reference, "full recompute against the self-joins")
+        check(rebuilt["freeze_thaw_days_7d"].max() > 0, "history has freeze-thaw days")
+    return bool(failures)
+
+
+
+
+# Entry point for the benchmark, exiting with status 1 when a check fails
+if __name__ == "__main__":
+    sys.exit(1 if run_benchmark() else 0)
@@ -0,0 +1,324 @@
+# Local stand-ins for the services the pipeline talks to, so every stage can be benchmarked without the network
+# The Socrata and Open-Meteo stand-ins are HTTP servers speaking the subset of each API the extraction uses,
+# and the BigQuery stand-in is a client object with the methods load_to_bigquery and the schema manager call
+import io
+import json
+import re
+import threading
+import time
+import urllib.parse
+import numpy as np
+import polars as pl
+import pyarrow as pa
+import pyarrow.parquet as pq
+from collections import OrderedDict, namedtuple
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# SoQL query shape sent by download_chunk
+soql_pattern = re.compile(r"SELECT\s+(?P<select>.+?)\s+WHERE\s+(?P<where>.+?)\s+ORDER BY\s+:id\s+LIMIT\s+(?P<limit>\d+)\s+OFFSET\s+(?P<offset>\d+)", re.S)
+
+# Socrata system fields are prefixed with ":", which the SQL engine does not accept in identifiers
+system_fields = {":updated_at": "_updated_at"}
+
+
+
+# Base class running a request handler on a local port in a background thread, used as a context manager
+# Every response waits latency seconds first, to mimic the round trip to the real service, and a random share of
+# the requests (straggler_rate) waits straggler_delay seconds more, to mimic the slow pages of a loaded service
+class StandInServer:
+    path = "/"
+
+    def __init__(self, latency = 0.0, straggler_rate = 0.0, straggler_delay = 0.0, seed = 0):
+        self.latency = latency
+        self.straggler_rate = straggler_rate
+        self.straggler_delay = straggler_delay
+        self.rng = np.random.default_rng(seed)
+        self.rng_lock = threading.Lock()
+        self.requests = 0
+        self.stragglers = 0
+        self.server = None
+
+    # Function to get the delay of a request, drawn on every request so a retried straggler is usually fast
+    def delay(self):
+        with self.rng_lock:
+            straggler = self.straggler_rate > 0 and self.rng.random() < self.straggler_rate
+            self.stragglers += straggler
+        return self.latency + (self.straggler_delay if straggler else 0.0)
+
+    def respond(self, query):
+        raise NotImplementedError
+
+    def start(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stand_in.requests += 1
+                delay = stand_in.delay()
+                if delay:
+                    time.sleep(delay)
+                try:
+                    status, content_type, body = stand_in.respond(urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query))
+                except Exception as e:
+                    status, content_type, body = 400, "text/plain", str(e).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}{self.path}"
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+
+
+# Stand-in for the Socrata CSV endpoint of the 311 dataset, serving the rows of a frame in :id (row) order
+# Where clauses are evaluated with the Polars SQL engine, and the matching rows of the last few clauses are kept
+# so that paging through one clause filters the frame once instead of once per offset
+# Rows can be edited between two extractions with edit_rows, and rows_served counts the rows of every page served
+class SocrataStandIn(StandInServer):
+    path = "/resource/erm2-nwe9.csv"
+
+    def __init__(self, df: pl.DataFrame, latency = 0.0, cached_queries = 4, **stragglers):
+        super().__init__(latency, **stragglers)
+        if "_updated_at" not in df.columns:
+            df = df.with_columns(pl.coalesce(["resolution_action_updated_date", "created_date"]).alias("_updated_at"))
+        self.df = df
+        self.context = pl.SQLContext(socrata = df)
+        self.cached_queries = cached_queries
+        self.matches = OrderedDict()
+        self.lock = threading.Lock()
+        self.rows_served = 0
+
+    # Function to edit the rows of some unique keys the way the city updates a complaint (e.g. closing it): the
+    # columns passed are set to their new value and :updated_at to updated_at, a Socrata timestamp string
+    def edit_rows(self, keys, updated_at, **values):
+        edited = pl.col("unique_key").is_in(list(keys))
+        values["_updated_at"] = updated_at
+        with self.lock:
+            self.df = self.df.with_columns([
+                pl.when(edited).then(pl.lit(value, dtype = self.df.schema[column])).otherwise(pl.col(column)).alias(column)
+                for column, value in values.items()
+            ])
+            self.context = pl.SQLContext(socrata = self.df)
+            self.matches.clear()
+
+    def select(self, select, where):
+        with self.lock:
+            if (select, where) not in self.matches:
+                self.matches[(select, where)] = self.context.execute(f"SELECT {select} FROM socrata WHERE {where}", eager = True)
+                if len(self.matches) > self.cached_queries:
+                    self.matches.popitem(last = False)
+            return self.matches[(select, where)]
+
+    def respond(self, query):
+        soql = query["$query"][0]
+        for field, column in system_fields.items():
+            soql = soql.replace(field, column)
+        match = soql_pattern.search(soql)
+        if match is None:
+            raise ValueError(f"Unsupported query: {soql}")
+
+        rows = self.select(" ".join(match["select"].split()), " ".join(match["where"].split()))
+        page = rows.slice(int(match["offset"]), int(match["limit"]))
+        with self.lock:
+            self.rows_served += page.height
+        page = page.rename({column: field for field, column in system_fields.items() if column in page.columns})
+        buffer = io.BytesIO()
+        page.write_csv(buffer)
+        return 200, "text/csv", buffer.getvalue()
+
+
+
+
+# Stand-in for the Open-Meteo archive endpoint, generating daily values for any coordinates and dates
+# Values are seeded by the coordinates and the day, so every request for the same point and day returns the same data
+class OpenMeteoStandIn(StandInServer):
+    path = "/v1/archive"
+
+    def daily_values(self, latitude, longitude, days, variables):
+        values = {}
+        for day_index, day in enumerate(days):
+            rng = np.random.default_rng([int(abs(latitude) * 1e4), int(abs(longitude) * 1e4), day.toordinal()])
+            for variable, value in zip(variables, rng.gamma(2.0, 5.0, size = len(variables)).round(1)):
+                values.setdefault(variable, []).append(float(value))
+        return values
+
+    def respond(self, query):
+        latitudes = [float(value) for value in query["latitude"][0].split(",")]
+        longitudes = [float(value) for value in query["longitude"][0].split(",")]
+        variables = query["daily"][0].split(",")
+        start, end = date.fromisoformat(query["start_date"][0]), date.fromisoformat(query["end_date"][0])
+        days = [start + timedelta(days = i) for i in range((end - start).days + 1)]
+
+        locations = [
+            {
+                "latitude": latitude,
+                "longitude": longitude,
+                "daily": {"time": [day.isoformat() for day in days], **self.daily_values(latitude, longitude, days, variables)},
+            }
+            for latitude, longitude in zip(latitudes, longitudes)
+        ]
+        # One location is returned as an object, several as a list, as the real API does
+        body = locations[0] if len(locations) == 1 else locations
+        return 200, "application/json", json.dumps(body).encode()
+
+
+
+
+# Stand-in for the BigQuery client, keeping every loaded chunk in memory as an Arrow table
+# Chunks are serialized to Parquet as the real client does before uploading, so the load stage pays the same cost
+# Queries are recorded, and the DDL the schema manager sends is applied to the tables' schema and layout
+FakeField = namedtuple("FakeField", ["name", "field_type", "mode"], defaults = ["NULLABLE"])
+FakePartitioning = namedtuple("FakePartitioning", ["field", "type_"])
+
+# DDL statement shapes sent by etl/loading/schema_manager.py
+ddl_patterns = {
+    "create": re.compile(r"CREATE TABLE IF NOT EXISTS `(?P<ref>[^`]+)` \((?P<columns>[^()]+)\)(?P<layout>.*)$"),
+    "create_as": re.compile(r"CREATE TABLE `(?P<ref>[^`]+)` (?P<layout>.*) AS SELECT \* FROM `(?P<source>[^`]+)`$"),
+    "add_column": re.compile(r"ALTER TABLE `(?P<ref>[^`]+)` ADD COLUMN IF NOT EXISTS (?P<name>\w+) (?P<type>\w+)$"),
+    "drop_not_null": re.compile(r"ALTER TABLE `(?P<ref>[^`]+)` ALTER COLUMN (?P<name>\w+) DROP NOT NULL$"),
+    "rename": re.compile(r"ALTER TABLE `(?P<ref>[^`]+)` RENAME TO (?P<name>\w+)$"),
+}
+partition_clause = re.compile(r"PARTITION BY DATE_TRUNC\((?P<field>\w+), (?P<type>\w+)\)")
+cluster_clause = re.compile(r"CLUSTER BY (?P<fields>\w+(?:, \w+)*)")
+
+
+class FakeJob:
+    def __init__(self, latency = 0.0):
+        self.latency = latency
+
+    def result(self):
+        if self.latency:
+            time.sleep(self.latency)
+        return self
+
+
+class FakeTable:
+    def __init__(self, table_ref, arrow_table = None, schema = None, time_partitioning = None, clustering_fields = None):
+        self.table_ref = table_ref
+        self.schema = schema or [FakeField(field.name, str(field.type)) for field in arrow_table.schema]
+        self.chunks = [arrow_table] if arrow_table is not None else []
+        self.time_partitioning = time_partitioning
+        self.clustering_fields = clustering_fields
+
+    @property
+    def num_rows(self):
+        return sum(chunk.num_rows for chunk in self.chunks)
+
+
+class FakeRowIterator:
+    def __init__(self, table, columns):
+        self.table = table
+        self.columns = columns
+
+    def to_dataframe(self):
+        if not self.table.chunks:
+            return pa.table({column: pa.array([], pa.int64()) for column in self.columns}).to_pandas()
+        return pa.concat_tables(self.table.chunks, promote_options = "default").select(self.columns).to_pandas()
+
+
+class FakeBigQueryClient:
+    def __init__(self, project = "benchmark", latency = 0.0):
+        self.project = project
+        self.latency = latency
+        self.tables = {}
+        self.queries = []
+        self.bytes_loaded = 0
+
+    def get_table(self, table_ref):
+        if table_ref not in self.tables:
+            raise LookupError(f"Not found: Table {table_ref}")
+        return self.tables[table_ref]
+
+    def list_rows(self, table, selected_fields = None):
+        return FakeRowIterator(table, [field.name for field in selected_fields or table.schema])
+
+    def load_table_from_dataframe(self, dataframe, table_ref, job_config = None):
+        arrow_table = pa.Table.from_pandas(dataframe, preserve_index = False)
+        buffer = pa.BufferOutputStream()
+        pq.write_table(arrow_table, buffer)
+        self.bytes_loaded += buffer.getvalue().size
+        if table_ref in self.tables and getattr(job_config, "write_disposition", None) == "WRITE_TRUNCATE":
+            self.tables[table_ref].chunks = [arrow_table]
+        elif table_ref in self.tables:
+            self.tables[table_ref].chunks.append(arrow_table)
+        else:
+            self.tables[table_ref] = FakeTable(table_ref, arrow_table)
+        return FakeJob(self.latency)
+
+    def query(self, sql, job_config = None):
+        self.queries.append(sql)
+        self.apply_ddl(sql)
+        return FakeJob(self.latency)
+
+    # Function to add an empty table with a given schema, e.g. one created by an older version of the table script
+    def add_table(self, table_ref, columns, partitioning = None, clustering = None):
+        self.tables[table_ref] = FakeTable(
+            table_ref, schema = [FakeField(*column) for column in columns],
+            time_partitioning = FakePartitioning(*partitioning) if partitioning else None,
+            clustering_fields = list(clustering) if clustering else None
+        )
+
+    # Function to apply a DDL statement to the in-memory tables, other statements (DML, SELECT) are only recorded
+    def apply_ddl(self, sql):
+        kind, match = next(((kind, pattern.match(sql)) for kind, pattern in ddl_patterns.items() if pattern.match(sql)), (None, None))
+        if match is None:
+            return
+        ref = match["ref"]
+        if kind in ("create", "create_as"):
+            if ref in self.tables:
+                return
+            if kind == "create":
+                columns = []
+                for column in match["columns"].split(", "):
+                    name, field_type, *constraint = column.split(" ")
+                    columns.append((name, field_type, "REQUIRED" if constraint else "NULLABLE"))
+            else:
+                columns = [tuple(field) for field in self.tables[match["source"]].schema]
+            partitioning = partition_clause.search(match["layout"])
+            clustering = cluster_clause.search(match["layout"])
+            self.add_table(
+                ref, columns, (partitioning["field"], partitioning["type"]) if partitioning else None,
+                clustering["fields"].split(", ") if clustering else None
+            )
+            if kind == "create_as":
+                self.tables[ref].chunks = list(self.tables[match["source"]].chunks)
+        elif kind == "add_column":
+            if all(field.name != match["name"] for field in self.tables[ref].schema):
+                self.tables[ref].schema.append(FakeField(match["name"], match["type"]))
+        elif kind == "drop_not_null":
+            self.tables[ref].schema = [
+                field._replace(mode = "NULLABLE") if field.name == match["name"] else field for field in self.tables[ref].schema
+            ]
+        elif kind == "rename":
+            table = self.tables.pop(ref)
+            table.table_ref = f"{ref.rsplit('.', 1)[0]}.{match['name']}"
+            self.tables[table.table_ref] = table
+
+    def rows_loaded(self):
+        return {table_ref.rsplit(".", 1)[-1]: table.num_rows for table_ref, table in self.tables.items()}
@@ -0,0 +1,268 @@
+# Generators for synthetic data used by the benchmarks
+import json
+import numpy as np
+import polars as pl
+from datetime import datetime, timedelta
+from pathlib import Path
+from etl.extraction.extract_weather import nyc_bounds, borough_coords, variables, weather_grid
+
+
+# Default seed so every benchmark run sees the same data
+default_seed = 4400
+
+
+
+# Function to generate uniformly distributed incident coordinates over the NYC bounding box
+def nyc_points(n, seed = default_seed):
+    rng = np.random.default_rng(seed)
+    lat = rng.uniform(nyc_bounds["min_lat"], nyc_bounds["max_lat"], size = n)
+    lon = rng.uniform(nyc_bounds["min_lon"], nyc_bounds["max_lon"], size = n)
+    return lat, lon
+
+
+
+
+# Function to generate a tiling of the NYC bounding box into irregular polygons, a stand-in for ZIP boundaries
+# Shared vertices and edge midpoints are jittered identically on both sides, so neighbouring polygons fit exactly
+def tiled_polygons(n_side = 14, points_per_edge = 8, seed = default_seed):
+    rng = np.random.default_rng(seed)
+    xs = np.linspace(nyc_bounds["min_lon"], nyc_bounds["max_lon"], n_side + 1)
+    ys = np.linspace(nyc_bounds["min_lat"], nyc_bounds["max_lat"], n_side + 1)
+    step = min(xs[1] - xs[0], ys[1] - ys[0])
+    corners = np.stack(np.meshgrid(xs, ys, indexing = "ij"), axis = -1)
+    corners[1:-1, 1:-1] += rng.uniform(-0.2, 0.2, size = corners[1:-1, 1:-1].shape) * step
+
+    edge_points = {}
+    def edge(a, b):
+        lo, hi = min(a, b), max(a, b)
+        if (lo, hi) not in edge_points:
+            start, end = corners[lo], corners[hi]
+            t = np.linspace(0, 1, points_per_edge + 2)[1:-1]
+            points = start + t[:, None] * (end - start)
+            # Keep the outer box straight so the tiling covers the bounding box exactly
+            on_border = (lo[0] == hi[0] and lo[0] in (0, n_side)) or (lo[1] == hi[1] and lo[1] in (0, n_side))
+            if not on_border:
+                normal = np.array([-(end - start)[1], (end - start)[0]])
+                normal /= np.linalg.norm(normal)
+                points = points + rng.uniform(-0.05, 0.05, size = points_per_edge)[:, None] * step * normal
+            edge_points[(lo, hi)] = points
+        return edge_points[(lo, hi)] if a < b else edge_points[(lo, hi)][::-1]
+
+    polygons = []
+    for i in range(n_side):
+        for j in range(n_side):
+            loop = [(i, j), (i + 1, j), (i + 1, j + 1), (i, j + 1)]
+            ring = []
+            for a, b in zip(loop, loop[1:] + loop[:1]):
+                ring.append(corners[a][None, :])
+                ring.append(edge(a, b))
+            ring = np.vstack(ring)
+            polygons.append((f"{10000 + i * n_side + j:05d}", [np.vstack([ring, ring[:1]])]))
+    return polygons
+
+
+
+
+
+# Function to write stand-in boundary GeoJSON files in the layout scripts/fetch_boundaries.py writes, into folder
+# Boroughs are vertical strips of the NYC bounding box, ZIP code areas the tiling of tiled_polygons
+def synthetic_boundaries(folder, seed = default_seed):
+    from etl.transformation.spatial_imputation import boundary_layers
+
+    folder = Path(folder)
+    folder.mkdir(parents = True, exist_ok = True)
+    xs = np.linspace(nyc_bounds["min_lon"], nyc_bounds["max_lon"], len(borough_coords) + 1)
+    min_y, max_y = nyc_bounds["min_lat"], nyc_bounds["max_lat"]
+    layers = {
+        "borough": [
+            (name, [np.array([[x0, min_y], [x1, min_y], [x1, max_y], [x0, max_y], [x0, min_y]])])
+            for name, x0, x1 in zip(borough_coords, xs[:-1], xs[1:])
+        ],
+        "modzcta": tiled_polygons(seed = seed),
+    }
+    for layer, polygons in layers.items():
+        settings = boundary_layers[layer]
+        features = [
+            {
+                "type": "Feature",
+                "properties": {settings["property"]: value},
+                "geometry": {"type": "Polygon", "coordinates": [ring.tolist() for ring in rings]},
+            }
+            for value, rings in polygons
+        ]
+        with open(folder / settings["file"], "w") as f:
+            json.dump({"type": "FeatureCollection", "features": features}, f)
+    return folder
+
+
+
+
+
+# Approximate number of distinct values of each text column in the real 311 dataset
+vocabulary_sizes = {
+    "agency": 20, "complaint_type": 250, "descriptor": 1_200, "location_type": 150,
+    "city": 100, "status": 8
+}
+statuses = ["Closed", "Open", "In Progress", "Pending", "Assigned", "Started", "Unspecified", "Email Sent"]
+
+
+# Function to get Zipf-like probabilities of size values, the first being the most frequent
+def zipf_weights(size, exponent = 1.1):
+    weights = 1 / np.arange(1, size + 1) ** exponent
+    return weights / weights.sum()
+
+
+# Function to draw n values from a vocabulary with a Zipf-like frequency, as in the real categorical columns
+def zipf_choice(rng, vocabulary, n, exponent = 1.1):
+    index = rng.choice(len(vocabulary), size = n, p = zipf_weights(len(vocabulary), exponent))
+    return pl.Series(vocabulary, dtype = pl.Utf8).gather(index)
+
+
+
+
+# Function to format datetimes the way Socrata returns them
+def socrata_timestamps(values):
+    return pl.Series(values.astype("datetime64[ms]")).dt.strftime("%Y-%m-%dT%H:%M:%S.000")
+
+
+
+
+# Function to generate raw 311 rows shaped like the Socrata extraction output
+def synthetic_311(n, seed = default_seed, start = datetime(2024, 1, 1), days = 365):
+    rng = np.random.default_rng(seed)
+    agencies = pl.Series([f"AG{i:02d}" for i in range(vocabulary_sizes["agency"])])
+    agency_names = pl.Series([f"Department Of Agency {i}" for i in range(vocabulary_sizes["agency"])])
+    agency_index = rng.choice(len(agencies), size = n)
+    created = np.datetime64(start, "s") + rng.integers(0, days * 86_400, size = n).astype("timedelta64[s]")
+    closed = created + rng.exponential(3 * 86_400, size = n).astype("timedelta64[s]")
+    lat, lon = nyc_points(n, seed)
+
+    return pl.DataFrame({
+        # Socrata keys increase with the creation time of the request
+        "unique_key": 60_000_000 + np.argsort(np.argsort(created, kind = "stable")).astype(np.int64),
+        "created_date": socrata_timestamps(created),
+        "closed_date": socrata_timestamps(closed),
+        "agency": agencies.gather(agency_index),
+        "agency_name": agency_names.gather(agency_index),
+        "complaint_type": zipf_choice(rng, [f"Complaint Type {i}" for i in range(vocabulary_sizes["complaint_type"])], n),
+        "descriptor": zipf_choice(rng, [f"Descriptor {i}" for i in range(vocabulary_sizes["descriptor"])], n),
+        "location_type": zipf_choice(rng, [f"Location Type {i}" for i in range(vocabulary_sizes["location_type"])], n),
+        "incident_zip": pl.Series(rng.integers(10001, 11698, size = n)).cast(pl.Utf8),
+        "city": zipf_choice(rng, [f"CITY {i}" for i in range(vocabulary_sizes["city"])], n),
+        "status": zipf_choice(rng, statuses, n),
+        "resolution_action_updated_date": socrata_timestamps(closed),
+        "borough": zipf_choice(rng, [b.upper() for b in borough_coords] + ["Unspecified"], n, exponent = 0.3),
+        "latitude": lat,
+        "longitude": lon,
+    }).with_columns(
+        # About one complaint in ten is still open
+        pl.when(pl.Series(rng.random(n)) < 0.1).then(None).otherwise(pl.col("closed_date")).alias("closed_date")
+    )
+
+
+
+
+# Function to generate daily weather rows shaped like the Open-Meteo extraction output, for every grid point
+def synthetic_weather(seed = default_seed, start = datetime(2024, 1, 1), days = 365, step = 0):
+    rng = np.random.default_rng(seed)
+    grid = weather_grid(step)
+    dates = pl.date_range(start, start + timedelta(days = days - 1), "1d", eager = True).dt.strftime("%Y-%m-%d")
+    df = grid.join(pl.DataFrame({"time": dates}), how = "cross")
+    return df.with_columns([
+        pl.Series(variable, rng.gamma(2.0, 5.0, size = df.height)).round(1) for variable in variables
+    ])
+
+
+
+
+# Settings for the data quality problems of the real 311 extract, as the share of rows affected
+dirty_rates = {"typo": 0.03, "odd_zip": 0.02, "missing": 0.02, "duplicate": 0.01}
+odd_zips = ["1001", "10001-1234", "100011", "0", "N/A", "00000"]
+missing_columns = ["descriptor", "location_type", "city", "incident_zip", "borough"]
+
+
+# Function to build three misspellings of each complaint type: a dropped, a swapped and a doubled letter
+# The variants only use characters the relevance filter accepts, so they reach the mapping stage as on the real data
+def complaint_typos() -> dict:
+    typos = {}
+    for i in range(vocabulary_sizes["complaint_type"]):
+        value = f"Complaint Type {i}"
+        typos[value] = [value[:3] + value[4:], value[:4] + value[5] + value[4] + value[6:], value[:6] + value[6] + value[6:]]
+    return typos
+
+
+
+
+# Function to add the data quality problems of the real 311 extract to synthetic_311 rows
+# Misspelled complaint types, malformed ZIPs, literal "missing" strings and re-reported keys with a later created_date
+def dirty_311(df: pl.DataFrame, seed = default_seed, rates = dirty_rates) -> pl.DataFrame:
+    rng = np.random.default_rng(seed + 1)
+    n = df.height
+    typos = {f"{value}|{k}": variant for value, variants in complaint_typos().items() for k, variant in enumerate(variants)}
+    typo_keys = pl.col("complaint_type") + "|" + pl.Series(rng.integers(0, 3, size = n)).cast(pl.Utf8)
+
+    df = df.with_columns(
+        pl.when(pl.Series(rng.random(n)) < rates["typo"])
+        .then(typo_keys.replace(typos))
+        .otherwise(pl.col("complaint_type"))
+        .alias("complaint_type"),
+        pl.when(pl.Series(rng.random(n)) < rates["odd_zip"])
+        .then(pl.Series(odd_zips).gather(rng.integers(0, len(odd_zips), size = n)))
+        .otherwise(pl.col("incident_zip"))
+        .alias("incident_zip"),
+    ).with_columns([
+        pl.when(pl.Series(rng.random(n)) < rates["missing"]).then(pl.lit("missing")).otherwise(pl.col(col)).alias(col)
+        for col in missing_columns
+    ])
+
+    # Re-reported complaints come back later in the feed with the same key, a few hours after the original
+    duplicates = df.sample(fraction = rates["duplicate"], seed = seed)
+    duplicates = duplicates.with_columns(
+        (pl.col("created_date").str.strptime(pl.Datetime, "%Y-%m-%dT%H:%M:%S%.f")
+         + pl.duration(hours = pl.Series(rng.integers(1, 48, size = duplicates.height))))
+        .dt.strftime("%Y-%m-%dT%H:%M:%S.000")
+        .alias("created_date")
+    )
+    return pl.concat([df, duplicates])
+
+
+
+
+# Function to build mappings for dirty_311 rows, in the shape of the JSON files in mappings/
+# Every complaint type and misspelling is relevant, the first misspelling of each type is mapped explicitly and the
+# other two are left to the fuzzy matching fallback; city and borough mappings keep values as they are
+def synthetic_mappings() -> dict:
+    typos = complaint_typos()
+    return {
+        "relevant_complaints": [value for value, variants in typos.items() for value in [value] + variants],
+        "complaint_mapping": {value: value for value in typos} | {variants[0]: value for value, variants in typos.items()},
+        "city_mapping": {f"CITY {i}": f"CITY {i}" for i in range(vocabulary_sizes["city"])},
+        "borough_mapping": {name.upper(): name.upper() for name in borough_coords} | {"Unspecified": "Unspecified"},
+    }
+
+
+
+
+# Function to generate fact_incidents rows as the star schema holds them, in arrival (created date) order
+# Ids follow the dimension sizes of the real data, with Zipf-like complaint types and agencies
+def synthetic_fact_incidents(n, seed = default_seed, start = datetime(2024, 1, 1), days = 365):
+    rng = np.random.default_rng(seed)
+    created = np.sort(np.datetime64(start, "D") + rng.integers(0, days, size = n).astype("timedelta64[D]"))
+    resolve_days = rng.exponential(3, size = n).astype(np.int64)
+    closed = created + resolve_days.astype("timedelta64[D]")
+    n_agencies, n_types = vocabulary_sizes["agency"], vocabulary_sizes["complaint_type"]
+    return pl.DataFrame({
+        "incident_id": 60_000_000 + np.arange(n, dtype = np.int64),
+        "date_id": pl.Series(created).dt.strftime("%Y%m%d").cast(pl.Int64),
+        "location_id": rng.integers(1, 200_001, size = n),
+        "weather_grid_id": rng.integers(0, 25, size = n),
+        "agency_id": rng.choice(n_agencies, size = n, p = zipf_weights(n_agencies)) + 1,
+        "complaint_type_id": rng.choice(n_types, size = n, p = zipf_weights(n_types)) + 1,
+        "created_date_id": pl.Series(created).dt.strftime("%Y%m%d").cast(pl.Int64),
+        "closed_date_id": pl.Series(closed).dt.strftime("%Y%m%d").cast(pl.Int64),
+        "resolution_status": zipf_choice(rng, statuses, n),
+        "time_to_resolve_interval": pl.Series(resolve_days).cast(pl.Utf8) + " days",
+        "is_resolved_same_day": (resolve_days == 0).astype(np.int64),
+        "complaint_count": np.ones(n, dtype = np.int64),
+        "borough_id": rng.choice(5, size = n, p = zipf_weights(5, 0.3)) + 1,
+    })
@@ -0,0 +1,81 @@
+# Compact canonical schema shared by every stage, from extraction through load
+import contextlib
+import polars as pl
+
+
+# Polars before 1.32 encodes each categorical against its own dictionary unless a string cache is active, and can only
+# join or concatenate categoricals built under the same cache. Later versions share global categories and need none
+string_cache_required = tuple(int(part) for part in pl.__version__.split(".")[:2]) < (1, 32)
+
+# Low-cardinality text columns (a few dozen to a few thousand distinct values) stored dictionary-encoded
+categorical_columns = [
+    "agency", "agency_name", "complaint_type", "descriptor", "city", "status",
+    "borough", "location_type", "complaint_category"
+]
+
+# Coordinates and weather measures, for which float32 precision (~1m at NYC latitudes) is enough
+float32_columns = [
+    "latitude", "longitude",
+    "temperature_2m_max", "temperature_2m_min", "precipitation_sum", "precipitation_hours",
+    "rain_sum", "showers_sum", "snowfall_sum", "windspeed_10m_max", "windgusts_10m_max",
+    "temperature_max", "temperature_min", "precipitation_total", "rain_total",
+    "showers_total", "snowfall_total", "windspeed_max", "windgust_max"
+]
+
+# Integer keys
+key_columns = {"unique_key": pl.UInt64, "incident_id": pl.UInt64}
+
+
+
+# Scope sharing one string cache between the categoricals built inside it, used as a context manager or a decorator
+# around the stages that combine frames compacted separately (downloaded chunks, partitions, the master dataset)
+# A nested scope joins the cache of the enclosing one, and with global categories the scope does nothing
+class shared_categories(contextlib.ContextDecorator):
+    def __enter__(self):
+        self.cache = pl.StringCache() if string_cache_required else contextlib.nullcontext()
+        self.cache.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self.cache.__exit__(*exc)
+
+    # Each decorated call gets its own scope, so concurrent calls do not share one
+    def _recreate_cm(self):
+        return type(self)()
+
+
+
+
+# Function to cast every column of the canonical schema present in the frame to its compact type
+def to_compact(df: pl.DataFrame) -> pl.DataFrame:
+    casts = []
+    for col, dtype in df.schema.items():
+        if col in categorical_columns and dtype != pl.Categorical:
+            casts.append(pl.col(col).cast(pl.Utf8).cast(pl.Categorical))
+        elif col in float32_columns and dtype.is_numeric() and dtype != pl.Float32:
+            casts.append(pl.col(col).cast(pl.Float32))
+        elif col in key_columns and dtype != key_columns[col]:
+            casts.append(pl.col(col).cast(key_columns[col], strict = False))
+    return df.with_columns(casts) if casts else df
+
+
+
+
+# Function to decode categorical columns back to plain strings, for the string cleaning stages
+def to_text(df: pl.DataFrame) -> pl.DataFrame:
+    return df.with_columns([
+        pl.col(col).cast(pl.Utf8) for col, dtype in df.schema.items() if dtype == pl.Categorical
+    ])
+
+
+
+
+# Function to convert compact types to ones the warehouse accepts, applied per chunk right before sending
+def to_warehouse(df: pl.DataFrame) -> pl.DataFrame:
+    casts = []
+    for col, dtype in df.schema.items():
+        if dtype == pl.Categorical:
+            casts.append(pl.col(col).cast(pl.Utf8))
+        elif dtype in (pl.UInt64, pl.UInt32):
+            casts.append(pl.col(col).cast(pl.Int64))
+    return df.with_columns(casts) if casts else df
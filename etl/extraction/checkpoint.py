@@ -0,0 +1,74 @@
+# Per-slice completion manifest so an interrupted extraction resumes from the first incomplete slice
+import polars as pl
+import json
+import os
+import shutil
+from pathlib import Path
+from etl.parquet_layout import write_profiled_parquet
+
+
+# Settings for file path locations
+project_root = Path(__file__).resolve().parents[2]
+staging_folder = project_root / "data" / "staging"
+metadata_folder = project_root / "metadata"
+
+
+
+# Class recording every completed slice of an extraction run, with each slice durably staged as Parquet
+# The run_key identifies the extraction (e.g. its query window), a manifest left by a different run is discarded
+class SliceManifest:
+    def __init__(self, name, run_key):
+        self.name = name
+        self.run_key = str(run_key)
+        self.staging_dir = staging_folder / name
+        self.path = metadata_folder / f"{name}_manifest.json"
+        self.slices = {}
+
+        if self.path.exists():
+            with open(self.path) as f:
+                manifest = json.load(f)
+            if manifest.get("run_key") == self.run_key:
+                self.slices = manifest.get("slices", {})
+            else:
+                self.clear()
+
+    def is_done(self, slice_id):
+        return str(slice_id) in self.slices
+
+    def rows(self, slice_id):
+        return self.slices.get(str(slice_id), {}).get("rows", 0)
+
+    # Function to stage a completed slice and atomically record it in the manifest
+    def record(self, slice_id, df):
+        slice_id = str(slice_id)
+        entry = {"rows": 0, "file": None}
+        if df is not None and df.height > 0:
+            self.staging_dir.mkdir(parents = True, exist_ok = True)
+            file_name = f"{slice_id.replace('/', '_')}.parquet"
+            write_profiled_parquet(df, self.staging_dir / file_name)
+            entry = {"rows": df.height, "file": file_name}
+        self.slices[slice_id] = entry
+
+        self.path.parent.mkdir(parents = True, exist_ok = True)
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"run_key": self.run_key, "slices": self.slices}, f)
+        os.replace(tmp_path, self.path)
+
+    # Function to read one staged slice back, None for an empty slice
+    def load_slice(self, slice_id):
+        entry = self.slices.get(str(slice_id), {})
+        return pl.read_parquet(self.staging_dir / entry["file"]) if entry.get("file") else None
+
+    # Function to read every staged slice back into a single frame
+    def load_all(self):
+        files = [self.staging_dir / entry["file"] for entry in self.slices.values() if entry["file"]]
+        if not files:
+            return None
+        return pl.concat([pl.read_parquet(file) for file in files], how = "diagonal_relaxed", rechunk = True)
+
+    # Function to remove the staged slices and the manifest once the run has been committed
+    def clear(self):
+        shutil.rmtree(self.staging_dir, ignore_errors = True)
+        self.path.unlink(missing_ok = True)
+        self.slices = {}
@@ -3,18 +3,28 @@ import polars as pl
 import pyarrow as pa 
 import pyarrow.parquet as pq 
 import urllib.parse
+import urllib.request
 import json
 import os
+import sys
+import fcntl
+from contextlib import contextmanager
 from datetime import datetime 
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from frictionless import Resource, Schema, Field
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeoutError
 from logger.etl_logger import ETLLogger
+from logger.stage_metrics import instrument_stage
+from etl.extraction.checkpoint import SliceManifest
+from etl.extraction.hedging import HedgingPolicy, request_deadline
+from etl.quality_profile import MonthlyProfiles, publish_profiles
+from etl.compact_schema import to_compact, shared_categories
+from etl.parquet_layout import write_profiled_parquet
+from etl.stable_hash import hash_rows
+from etl.ipc_cache import read_cached, refresh_ipc_cache
 from pathlib import Path
 
 
 # Setting logging for extraction
 extract_logger = ETLLogger("extract").get()
-extract_logger.info("Starting 311 data extraction")
 
 # Paths for project root, metadata, and full data
 project_root = Path(__file__).resolve().parents[2]
@@ -36,166 +46,399 @@ slowly_changing_dimensions = [
     "resolution_action_updated_date"
 ]
 
-# Frictionless schema for validation
-schema = Schema(fields = [
-    Field(name = "unique_key", type = "string"),
-    Field(name = "created_date", type = "datetime"),
-    Field(name = "closed_date", type = "datetime"),
-    Field(name = "agency", type = "string"),
-    Field(name = "agency_name", type = "string"),
-    Field(name = "complaint_type", type = "string"),
-    Field(name = "descriptor", type = "string"),
-    Field(name = "location_type", type = "string"),
-    Field(name = "incident_zip", type = "string"),
-    Field(name = "city", type = "string"),
-    Field(name = "status", type = "string"),
-    Field(name = "resolution_action_updated_date", type ="datetime"),
-    Field(name = "borough", type = "string"),
-    Field(name = "latitude", type = "number"),
-    Field(name = "longitude", type = "number"),
-])
+# Fixed seed for the row hash over the SCD columns, the hashes are persisted with the master data
+row_hash_seed = 4400
+
+# Frictionless field types for validation, the schema itself is built on first use since frictionless is slow to import
+schema_fields = {
+    "unique_key": "integer",
+    "created_date": "datetime",
+    "closed_date": "datetime",
+    "agency": "string",
+    "agency_name": "string",
+    "complaint_type": "string",
+    "descriptor": "string",
+    "location_type": "string",
+    "incident_zip": "string",
+    "city": "string",
+    "status": "string",
+    "resolution_action_updated_date": "datetime",
+    "borough": "string",
+    "latitude": "number",
+    "longitude": "number",
+}
+
+# Socrata system field holding the last modification time of each row, used for change capture
+updated_at_field = ":updated_at"
 
 # Settings for extraction
-base_url = r"https://data.cityofnewyork.us/resource/erm2-nwe9.csv"
+base_url = os.environ.get("NYC_311_BASE_URL", r"https://data.cityofnewyork.us/resource/erm2-nwe9.csv")
 chunk_size = 100_000
 max_workers = 4
 
+# Boroughs each extraction window is partitioned by, as spelled in the 311 dataset
+# Rows with any other borough or none form one more partition, so the partitions cover every row
+partition_boroughs = ["MANHATTAN", "BROOKLYN", "QUEENS", "BRONX", "STATEN ISLAND"]
+
+# Hedging of the page downloads, a page still downloading after the recent p95 page latency is requested again
+socrata_hedging = HedgingPolicy("socrata")
 
+# Settings for window-scoped extraction, each window stages its partitions in its own folder
+partition_folder = project_root / "data" / "partitions"
+master_lock_file = metadata_folder / "nyc_311_master.lock"
 
-# Frictionless schema for validation upon extraction
-schema = Schema(fields = [
-    Field(name = "unique_key", type = "string"),
-    Field(name = "created_date", type = "datetime"),
-    Field(name = "closed_date", type = "datetime"),
-    Field(name = "agency", type = "string"),
-    Field(name = "agency_name", type = "string"),
-    Field(name = "complaint_type", type = "string"),
-    Field(name = "descriptor", type = "string"),
-    Field(name = "location_type", type = "string"),
-    Field(name = "incident_zip", type = "string"),
-    Field(name = "city", type = "string"),
-    Field(name = "status", type = "string"),
-    Field(name = "resolution_action_updated_date", type = "datetime"),
-    Field(name = "borough", type = "string"),
-    Field(name = "latitude", type = "number"),
-    Field(name = "longitude", type = "number"),
-])
+
+
+# Function to validate extracted rows against the frictionless schema
+def validate_schema(df: pl.DataFrame):
+    from frictionless import Resource, Schema, Field
+    schema = Schema(fields = [Field(name = name, type = field_type) for name, field_type in schema_fields.items()])
+    return Resource(data = df.to_dicts(), schema = schema).validate()
 
 
 # Function for downloading by chunks from Socrata API via URL (Faster i/o)
-def download_chunk(offset, latest_date):
+# Ordering by the row id keeps offset paging stable while the dataset is being updated
+# The socket timeout is the request deadline, so an attempt left behind by a hedge or the deadline does not hang
+def request_chunk(offset, where_clause, select_columns = columns):
     soql = f"""
-        SELECT {', '.join(columns)}
-        WHERE created_date > '{latest_date}'
+        SELECT {', '.join(select_columns)}
+        WHERE {where_clause}
+        ORDER BY :id
         LIMIT {chunk_size} OFFSET {offset}
     """
     encoded_query = urllib.parse.quote(soql, safe='')
     url = f"{base_url}?$query={encoded_query}"
 
     try:
-        df_chunk = pl.read_csv(url, columns=columns, dtypes={"incident_zip": pl.Utf8})
+        with urllib.request.urlopen(url, timeout=request_deadline) as response:
+            df_chunk = pl.read_csv(response.read(), columns=select_columns, dtypes={"incident_zip": pl.Utf8})
         if df_chunk.height == 0:
             return None
-        return df_chunk
+        return to_compact(df_chunk)
     except Exception as e:
-        extract_logger.error(f"Error at offset {offset}: {e}")
-        return None
+        extract_logger.error(f"Error at offset {offset}: {e}", extra={"stage": "download_chunk", "offset": offset})
+        raise
 
 
+# Function to download a chunk with the Socrata deadline and hedging, measured as one stage however many attempts
+# the hedging made
+@instrument_stage(labels = ["offset"])
+def download_chunk(offset, where_clause, select_columns = columns):
+    return socrata_hedging.call(request_chunk, offset, where_clause, select_columns)
 
-def extract_311():
-    # Determining latest date in metadata extraction files
-    metadata_folder.mkdir(parents = True, exist_ok = True)
-    metadata_file = metadata_folder / "last_date.json"
 
-    if metadata_file.exists():
-        with open(metadata_file) as f:
-            report_json = json.load(f)
-            latest_date = report_json.get("last_date")
-            extract_logger.info(f"Using latest_date from metadata: {latest_date}")
-    else:
-        latest_date = "2025-09-25T01:44:42"  # default start date
-        extract_logger.info(f"No metadata found, using default start date: {latest_date}")
-    
+
+
+# Function to leave the :updated_at system field out of a profiled chunk, it is only selected to move the change
+# capture mark
+def profiled(chunk):
+    return chunk.drop(updated_at_field, strict = False) if chunk is not None else None
+
+
+# Function to page through every row matching a SoQL where clause with parallel chunk downloads
+# Each completed offset is staged and recorded in the manifest, so a retry only downloads the missing ones
+# A profile passed in is updated with every chunk as it arrives, and with the slices a resumed run staged before
+def download_all(where_clause, manifest, select_columns = columns, profile = None):
     offset = 0
-    all_chunks = []
     finished = False
+    if manifest.slices:
+        extract_logger.info(f"Resuming {manifest.name} with {len(manifest.slices)} completed slices")
+        if profile is not None:
+            for slice_id in manifest.slices:
+                profile.update(profiled(manifest.load_slice(slice_id)))
     
     while not finished:
         offsets = [offset + i * chunk_size for i in range(max_workers)]
-        results = []
+        pending = [o for o in offsets if not manifest.is_done(o)]
+        failed = []
         
         with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            futures = {executor.submit(download_chunk, o, latest_date): o for o in offsets}
+            futures = {executor.submit(download_chunk, o, where_clause, select_columns): o for o in pending}
             for future in as_completed(futures):
-                df_chunk = future.result()
-                if df_chunk is not None and df_chunk.height > 0:
-                    results.append(df_chunk)
+                try:
+                    chunk = future.result()
+                    manifest.record(futures[future], chunk)
+                    if profile is not None:
+                        profile.update(profiled(chunk))
+                except (FutureTimeoutError, TimeoutError) as e:
+                    extract_logger.error(f"Timeout at offset {futures[future]}: {e}", extra={"stage": "download_chunk", "offset": futures[future]})
+                    failed.append(futures[future])
+                except Exception:
+                    failed.append(futures[future])
 
-        if not results:  # Stopping if all chunks are empty
+        if failed:
+            socrata_hedging.log_report(extract_logger)
+            raise RuntimeError(f"Failed to download offsets {sorted(failed)}, completed slices are checkpointed")
+        if all(manifest.rows(o) == 0 for o in offsets):  # Stopping if all chunks are empty
             finished = True
         else:
-            all_chunks.extend(results)
             offset += max_workers * chunk_size
 
-    if not all_chunks:
+    socrata_hedging.log_report(extract_logger)
+    return manifest.load_all()
+
+
+
+
+# Function to add a content hash over the tracked SCD columns of each row
+# The hash is stable across Polars versions, since it is stored with the master dataset and in the key index
+def add_row_hash(df: pl.DataFrame) -> pl.DataFrame:
+    return df.with_columns(hash_rows(df, slowly_changing_dimensions, seed = row_hash_seed).alias("row_hash"))
+
+
+
+
+# Function to merge extracted rows into the master dataset
+# Existing rows only get their SCD columns overwritten, and only when their row hash changed
+@instrument_stage()
+@shared_categories()
+def merge_into_master(df_main: pl.DataFrame, new_data: pl.DataFrame, append_new = True) -> pl.DataFrame:
+    if "row_hash" not in df_main.columns:
+        df_main = add_row_hash(df_main)
+    
+    # Finding existing rows whose SCD columns changed by comparing row hashes only
+    df_update = new_data.select(["unique_key", "row_hash"] + slowly_changing_dimensions).join(
+        df_main.select(["unique_key", pl.col("row_hash").alias("stored_hash")]), on="unique_key", how="inner"
+    ).filter(pl.col("row_hash") != pl.col("stored_hash")).drop(["row_hash", "stored_hash"]).unique(subset="unique_key", keep="last")
+    
+    if df_update.height > 0:
+        # Overwriting SCD columns if new value exists, only on the changed rows
+        patched = df_main.join(df_update, on="unique_key", how="inner")
+        for col in slowly_changing_dimensions:
+            right_col = f"{col}_right"
+            patched = patched.with_columns(
+                pl.when(pl.col(right_col).is_not_null())
+                .then(pl.col(right_col))
+                .otherwise(pl.col(col))
+                .alias(col)
+            ).drop(right_col)
+        patched = add_row_hash(patched).select(df_main.columns)
+        df_main = pl.concat([
+            df_main.join(df_update.select("unique_key"), on="unique_key", how="anti"),
+            patched
+        ], rechunk=True)
+    extract_logger.info(f"{df_update.height} existing records changed and flagged for reload")
+    
+    # Adding new rows that do not exist
+    if append_new:
+        new_rows = new_data.join(df_main, on="unique_key", how="anti")
+        if new_rows.height > 0:
+            df_main = pl.concat([df_main, new_rows.select(df_main.columns)], rechunk=True)
+    
+    return df_main
+
+
+
+
+# Function to read a high-water mark from its metadata file, falling back to a default
+def read_high_water_mark(metadata_file, default):
+    if metadata_file.exists():
+        with open(metadata_file) as f:
+            value = json.load(f).get("last_date")
+        extract_logger.info(f"Using {metadata_file.stem} from metadata: {value}")
+        return value
+    extract_logger.info(f"No {metadata_file.stem} metadata found, using default: {default}")
+    return default
+
+
+
+
+# Main function for 311 extraction
+# With change_capture, complaints modified since the last run (closures, resolution updates) are pulled
+# through the Socrata :updated_at field and routed into the SCD overwrite of the master dataset
+# The new rows are pulled with their :updated_at too, so the mark moves past every modification already extracted
+# and the next run only pulls the rows modified since, the first run included
+@instrument_stage()
+@shared_categories()
+def extract_311(change_capture = False):
+    extract_logger.info("Starting 311 data extraction")
+    # Determining latest date in metadata extraction files
+    metadata_folder.mkdir(parents = True, exist_ok = True)
+    metadata_file = metadata_folder / "last_date.json"
+    updated_at_file = metadata_folder / "updated_at_last_date.json"
+
+    latest_date = read_high_water_mark(metadata_file, "2025-09-25T01:44:42")  # default start date
+    created_where = f"created_date > '{latest_date}'"
+    manifests = [SliceManifest("extract_311_created", created_where)]
+    profiles = MonthlyProfiles()
+    created_columns = columns + [updated_at_field] if change_capture else columns
+    new_data = download_all(created_where, manifests[0], created_columns, profile = profiles)
+
+    changed_data = None
+    last_updated_at = None
+    if change_capture:
+        last_updated_at = read_high_water_mark(updated_at_file, latest_date)
+        updated_where = f"{updated_at_field} > '{last_updated_at}' AND created_date <= '{latest_date}'"
+        manifests.append(SliceManifest("extract_311_updated", updated_where))
+        changed_data = download_all(updated_where, manifests[1], columns + [updated_at_field])
+        marks = [
+            data[updated_at_field].max() for data in [new_data, changed_data]
+            if data is not None and updated_at_field in data.columns
+        ]
+        last_updated_at = max([mark for mark in marks if mark is not None] + [last_updated_at])
+    if new_data is not None:
+        new_data = new_data.drop(updated_at_field, strict = False)
+
+    if new_data is None and changed_data is None:
         extract_logger.info("No new 311 data to extract.")
+        for manifest in manifests:
+            manifest.clear()
         return None
     
-    # Concatenating data
-    new_data = pl.concat(all_chunks, rechunk=True)
-    
     # Schema Validation
-    try:
-        resource = Resource(data = new_data.to_dicts(), schema = schema)
-        validation_report = resource.validate()
-        if validation_report.valid:
-            extract_logger.info("Extracted data matches schema.")
-        else:
-            extract_logger.warning("Schema validation failed. Check extracted data.")
-    except Exception as e:
-        extract_logger.error(f"Schema validation failed: {e}")
+    if new_data is not None:
+        try:
+            validation_report = validate_schema(new_data)
+            if validation_report.valid:
+                extract_logger.info("Extracted data matches schema.")
+            else:
+                extract_logger.warning("Schema validation failed. Check extracted data.")
+        except Exception as e:
+            extract_logger.error(f"Schema validation failed: {e}")
 
     # Merging with main dataset with incremental updatation
     if main_parquet.exists():
-        df_main = pl.read_parquet(main_parquet)
-        
-        # Joining on SCD columns
-        df_update = new_data.select(["unique_key"] + slowly_changing_dimensions)
-        df_main = df_main.join(df_update, on="unique_key", how="left")
-        
-        # Overwriting SCD columns if new value exists
-        for col in slowly_changing_dimensions:
-            right_col = f"{col}_right"
-            if right_col in df_main.columns:
-                df_main = df_main.with_columns(
-                    pl.when(pl.col(right_col).is_not_null())
-                    .then(pl.col(right_col))
-                    .otherwise(pl.col(col))
-                    .alias(col)
-                ).drop(right_col)
-                
-        # Adding new rows that do not exist
-        new_rows = new_data.join(df_main, on="unique_key", how="anti")
-        if new_rows.height > 0:
-            df_main = pl.concat([df_main, new_rows], rechunk=True)
-            
-        combined = df_main
+        combined = read_cached(main_parquet)
     else:
-        combined = new_data
+        combined = None
+    if changed_data is not None:
+        changed_data = add_row_hash(changed_data.drop(updated_at_field))
+        if combined is not None:
+            combined = merge_into_master(combined, changed_data, append_new = False)
+        extract_logger.info(f"Change capture returned {changed_data.height} modified records")
+    if new_data is not None:
+        new_data = add_row_hash(new_data)
+        combined = merge_into_master(combined, new_data) if combined is not None else new_data
+    if combined is None:
+        extract_logger.info("No master dataset to apply changed 311 records to.")
+        for manifest in manifests:
+            manifest.clear()
+        return None
         
-    # Updating metadata files
-    last_date = new_data.select(pl.col("created_date").max()).item()
-    with open(metadata_file, "w") as f:
-        json.dump({"last_date": last_date}, f)
+    # Saving updated dataset before moving the high-water marks, so a failure in between resumes from staging
+    write_profiled_parquet(combined, main_parquet)
+    refresh_ipc_cache(combined, main_parquet)
         
-    # Saving updated dataset
-    combined.write_parquet(main_parquet)
+    # Updating metadata files
+    if new_data is not None:
+        last_date = new_data.select(pl.col("created_date").max()).item()
+        with open(metadata_file, "w") as f:
+            json.dump({"last_date": last_date}, f)
+    if change_capture:
+        with open(updated_at_file, "w") as f:
+            json.dump({"last_date": last_updated_at}, f)
+
+    # Storing the quality profile of the new rows once they are committed, so a retried run does not count them twice
+    store_profiles(profiles)
+    
+    # Releasing the staged slices of this run
+    for manifest in manifests:
+        manifest.clear()
     extract_logger.info(f"Extraction completed. Total records: {combined.height}")
     
     return combined
 
 
+# Function to store the quality profiles of extracted rows, a failure is logged without failing the extraction
+def store_profiles(profiles):
+    if not profiles:
+        return []
+    try:
+        return publish_profiles(profiles)
+    except Exception as e:
+        extract_logger.error(f"Storing the quality profile failed: {e}")
+        return []
+
+
+
+
+# Function to get the folder holding the staged partitions of one extraction window
+def window_folder(start, end) -> Path:
+    return partition_folder / f"{start:%Y%m%d}_{end:%Y%m%d}"
+
+
+
+
+# Function to build the SoQL filter for the rows created in [start, end) in one borough partition
+# With change_capture, rows created before the window but modified inside it are included as well
+def partition_where(start, end, borough = None, change_capture = False):
+    start_ts, end_ts = f"{start:%Y-%m-%dT%H:%M:%S}", f"{end:%Y-%m-%dT%H:%M:%S}"
+    window = f"created_date >= '{start_ts}' AND created_date < '{end_ts}'"
+    if change_capture:
+        window = (
+            f"(({window}) OR ({updated_at_field} >= '{start_ts}' AND {updated_at_field} < '{end_ts}'"
+            f" AND created_date < '{start_ts}'))"
+        )
+    if borough is None:
+        known = ", ".join(f"'{name}'" for name in partition_boroughs)
+        return f"{window} AND (borough IS NULL OR borough NOT IN ({known}))"
+    return f"{window} AND borough = '{borough}'"
+
+
+
+
+# Function to extract one (window, borough) partition to Parquet, without reading or moving any high-water mark
+# Returns the staged file, None when the partition is empty
+@instrument_stage(labels = ["start", "end", "borough"])
+@shared_categories()
+def extract_311_partition(start, end, borough = None, change_capture = False):
+    where_clause = partition_where(start, end, borough, change_capture)
+    partition_name = borough.lower().replace(" ", "_") if borough else "other"
+    manifest = SliceManifest(f"extract_311_{start:%Y%m%d}_{end:%Y%m%d}_{partition_name}", where_clause)
+    profiles = MonthlyProfiles()
+    df = download_all(where_clause, manifest, profile = profiles)
+
+    output = None
+    if df is not None:
+        output = window_folder(start, end) / f"311_{partition_name}.parquet"
+        write_profiled_parquet(add_row_hash(df), output)
+    store_profiles(profiles)
+    manifest.clear()
+    extract_logger.info(
+        f"Extracted {0 if df is None else df.height} records for {partition_name} from {start} to {end}",
+        extra={"stage": "extract_311_partition", "borough": borough, "rows": 0 if df is None else df.height}
+    )
+    return str(output) if output else None
+
+
+
+
+# Context manager holding an exclusive lock on the master dataset, so concurrent runs merge one at a time
+@contextmanager
+def master_lock():
+    master_lock_file.parent.mkdir(parents = True, exist_ok = True)
+    with open(master_lock_file, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+
+
+# Function to merge staged partitions into the master dataset, returning the rows they contained
+@instrument_stage()
+@shared_categories()
+def merge_partitions(paths):
+    paths = [path for path in paths if path]
+    if not paths:
+        extract_logger.info("No partitions to merge.")
+        return None
+    new_data = to_compact(pl.concat([pl.read_parquet(path) for path in paths], how = "diagonal_relaxed", rechunk = True))
+
+    with master_lock():
+        if main_parquet.exists():
+            combined = merge_into_master(read_cached(main_parquet), new_data)
+        else:
+            combined = new_data
+        write_profiled_parquet(combined, main_parquet)
+        refresh_ipc_cache(combined, main_parquet)
+    extract_logger.info(f"Merged {new_data.height} records from {len(paths)} partitions. Total records: {combined.height}")
+
+    return new_data
+
+
 # Entry point for the extraction function
 if __name__ == "__main__":
-    extract_311()
\ No newline at end of file
+    extract_311(change_capture = "--change-capture" in sys.argv)
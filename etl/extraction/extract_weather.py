@@ -1,29 +1,26 @@
 import polars as pl
+import numpy as np
+import os
 from datetime import datetime, timedelta
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeoutError
 import requests
 import json
 from pathlib import Path
 from logger.etl_logger import ETLLogger
+from logger.stage_metrics import instrument_stage
+from etl.extraction.checkpoint import SliceManifest
+from etl.extraction.hedging import HedgingPolicy, request_deadline
+from etl.transformation.nearest_weather import WeatherGridIndex
+from etl.compact_schema import to_compact, shared_categories
 
 # Logger settings
 extract_logger = ETLLogger("extract_weather").get()
-extract_logger.info("Starting weather data extraction")
 
 # Settings for file path locations
 project_root = Path(__file__).resolve().parents[2]
 metadata_folder = project_root / "metadata"
-metadata_folder.mkdir(parents=True, exist_ok=True)
 metadata_file = metadata_folder / "weather_last_date.json"
-
-if metadata_file.exists():
-    with open(metadata_file) as f:
-        metadata = json.load(f)
-    last_date = datetime.fromisoformat(metadata.get("last_date"))
-    extract_logger.info(f"Using last_date from metadata: {last_date.date()}")
-else:
-    last_date = datetime(2010, 1, 1)
-    extract_logger.info(f"No metadata found. Starting from default date: {last_date.date()}")
+default_last_date = datetime(2010, 1, 1)
 
 
 
@@ -65,6 +62,42 @@ borough_coords = {
     "Staten Island": (40.5795, -74.1502)
 }
 
+# Settings for the weather grid, a step of 0 keeps one point per borough centroid
+# A step in degrees (e.g. 0.02) fetches a regular lat/lon grid over the NYC bounding box instead
+grid_step = float(os.environ.get("WEATHER_GRID_STEP", 0))
+nyc_bounds = {"min_lat": 40.49, "max_lat": 40.92, "min_lon": -74.26, "max_lon": -73.69}
+grid_batch_size = 50  # Coordinates per multi-location Open-Meteo request
+
+# Hedging of the Open-Meteo requests, a window still loading after the recent p95 request latency is requested again
+open_meteo_hedging = HedgingPolicy("open_meteo")
+
+
+
+
+# Function to build the weather grid points, each labelled with the borough of its nearest centroid
+def weather_grid(step = grid_step) -> pl.DataFrame:
+    centroids = pl.DataFrame({
+        "grid_id": list(range(1, len(borough_coords) + 1)),
+        "borough": list(borough_coords),
+        "latitude": [lat for lat, _ in borough_coords.values()],
+        "longitude": [lon for _, lon in borough_coords.values()]
+    })
+    if not step:
+        return centroids
+
+    lats = np.arange(nyc_bounds["min_lat"], nyc_bounds["max_lat"] + step / 2, step)
+    lons = np.arange(nyc_bounds["min_lon"], nyc_bounds["max_lon"] + step / 2, step)
+    lat_grid, lon_grid = np.meshgrid(lats, lons, indexing = "ij")
+    grid = pl.DataFrame({
+        "grid_id": np.arange(1, lat_grid.size + 1),
+        "latitude": lat_grid.ravel().round(4),
+        "longitude": lon_grid.ravel().round(4)
+    })
+    nearest_centroid, _ = WeatherGridIndex(centroids).query(grid["latitude"].to_numpy(), grid["longitude"].to_numpy())
+    return grid.with_columns(
+        pl.Series("borough", centroids["borough"].to_numpy()[nearest_centroid - 1])
+    ).select(["grid_id", "borough", "latitude", "longitude"])
+
 
 
 
@@ -79,73 +112,127 @@ def daterange_chunks(start, end, days_per_chunk = 30):
 
 
 
-# Function to help pull lat/lon borough centroid data
-def fetch_weather(borough, lat, lon, start, end):
+# Function to pull a batch of grid points with a single multi-coordinate request
+def request_weather(points: pl.DataFrame, start, end):
     params = {
-        "latitude": lat,
-        "longitude": lon,
+        "latitude": ",".join(str(lat) for lat in points["latitude"]),
+        "longitude": ",".join(str(lon) for lon in points["longitude"]),
         "start_date": start.strftime("%Y-%m-%d"),
         "end_date": end.strftime("%Y-%m-%d"),
         "daily": ",".join(variables),
         "timezone": "America/New_York"
     }
     try:
-        resp = requests.get(base_url, params=params, timeout=60)
+        resp = requests.get(base_url, params=params, timeout=request_deadline)
         resp.raise_for_status()
         data = resp.json()
-        if "daily" not in data:
-            extract_logger.warning(f"No daily data for {borough} {start.date()} to {end.date()}")
-            return None
-        df = pl.DataFrame(data["daily"])
-        df = df.with_columns([
-            pl.lit(borough).alias("borough"),
-            pl.lit(lat).alias("latitude"),
-            pl.lit(lon).alias("longitude")
-        ])
-        return df
+        # Open-Meteo returns a list of locations for several coordinates, and a single object for one
+        locations = data if isinstance(data, list) else [data]
+        dfs = []
+        for point, location in zip(points.iter_rows(named = True), locations):
+            if "daily" not in location:
+                extract_logger.warning(f"No daily data for grid point {point['grid_id']} {start.date()} to {end.date()}")
+                continue
+            df = pl.DataFrame(location["daily"])
+            df = df.with_columns([
+                pl.lit(point["grid_id"]).alias("grid_id"),
+                pl.lit(point["borough"]).alias("borough"),
+                pl.lit(point["latitude"]).alias("latitude"),
+                pl.lit(point["longitude"]).alias("longitude")
+            ])
+            dfs.append(df)
+        return to_compact(pl.concat(dfs, rechunk=True)) if dfs else None
     except Exception as e:
-        extract_logger.error(f"Error fetching {borough} {start.date()} to {end.date()}: {e}")
-        return None
+        extract_logger.error(f"Error fetching grid points {points['grid_id'].to_list()} {start.date()} to {end.date()}: {e}")
+        raise
 
 
+# Function to pull a batch of grid points with the Open-Meteo deadline and hedging, measured as one stage however
+# many attempts the hedging made. Its rows are the daily rows returned, the grid points are not counted as input
+@instrument_stage(labels = ["start", "end"], count_input = False)
+def fetch_weather(points: pl.DataFrame, start, end):
+    return open_meteo_hedging.call(request_weather, points, start, end)
 
 
-# Main function for weather extraction
-def extract_weather():
-    current_max_date = last_date
-    all_chunks = []
+
+
+# Function to fetch every grid point for the days from start_date to end_date (inclusive)
+# Every (grid batch, window) slice is staged and recorded in the manifest, so a retry resumes from the first incomplete one
+def fetch_weather_window(start_date, end_date, manifest):
+    grid = weather_grid()
+    batches = [grid.slice(i, grid_batch_size) for i in range(0, grid.height, grid_batch_size)]
+    if manifest.slices:
+        extract_logger.info(f"Resuming weather extraction with {len(manifest.slices)} completed slices")
     
-    for chunk_start, chunk_end in daterange_chunks(last_date + timedelta(days = 1), end_date, chunk_days):
-        extract_logger.info(f"Fetching data from {chunk_start.date()} to {chunk_end.date()}")
-        dfs = []
+    for chunk_start, chunk_end in daterange_chunks(start_date, end_date, chunk_days):
+        pending = [i for i in range(len(batches)) if not manifest.is_done(f"{i}/{chunk_start.date()}")]
+        if not pending:
+            continue
+        extract_logger.info(
+            f"Fetching data from {chunk_start.date()} to {chunk_end.date()} for {grid.height} grid points",
+            extra={"stage": "fetch_weather", "start": chunk_start.date(), "end": chunk_end.date(), "batches": len(pending)}
+        )
+        failed = []
         
         with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            futures = {executor.submit(fetch_weather, b, *borough_coords[b], chunk_start, chunk_end): b
-                    for b in borough_coords}
+            futures = {executor.submit(fetch_weather, batches[i], chunk_start, chunk_end): i for i in pending}
             for future in as_completed(futures):
-                result = future.result()
-                if result is not None:
-                    dfs.append(result)
+                batch_index = futures[future]
+                try:
+                    manifest.record(f"{batch_index}/{chunk_start.date()}", future.result())
+                except (FutureTimeoutError, TimeoutError) as e:
+                    extract_logger.error(f"Timeout fetching grid batch {batch_index} {chunk_start.date()} to {chunk_end.date()}: {e}")
+                    failed.append(batch_index)
+                except Exception:
+                    failed.append(batch_index)
                     
-        if dfs:
-            chunk_df = pl.concat(dfs, rechunk=True)
-            all_chunks.append(chunk_df)
-            
-            max_chunk_date = max(chunk_df["time"].to_list())
-            if isinstance(max_chunk_date, str):
-                max_chunk_date = datetime.fromisoformat(max_chunk_date)
-            if max_chunk_date > current_max_date:
-                current_max_date = max_chunk_date
+        if failed:
+            open_meteo_hedging.log_report(extract_logger)
+            raise RuntimeError(
+                f"Failed to fetch grid batches {sorted(failed)} from {chunk_start.date()} to {chunk_end.date()}, completed slices are checkpointed"
+            )
                 
-    if not all_chunks:
+    open_meteo_hedging.log_report(extract_logger)
+    return manifest.load_all()
+
+
+
+
+# Function to read the last extracted date from the metadata file, read on each call rather than at import
+def read_last_date():
+    if metadata_file.exists():
+        with open(metadata_file) as f:
+            metadata = json.load(f)
+        last_date = datetime.fromisoformat(metadata.get("last_date"))
+        extract_logger.info(f"Using last_date from metadata: {last_date.date()}")
+        return last_date
+    extract_logger.info(f"No metadata found. Starting from default date: {default_last_date.date()}")
+    return default_last_date
+
+
+
+
+# Main function for weather extraction, continuing from the last_date high-water mark
+@instrument_stage()
+@shared_categories()
+def extract_weather():
+    extract_logger.info("Starting weather data extraction")
+    last_date = read_last_date()
+    start_date = last_date + timedelta(days = 1)
+    manifest = SliceManifest("extract_weather", f"{start_date.date()}:{end_date.date()}:{grid_step}")
+    combined_df = fetch_weather_window(start_date, end_date, manifest)
+    if combined_df is None:
         extract_logger.info("No new weather data to extract.")
+        manifest.clear()
         return None
     
-    combined_df = pl.concat(all_chunks, rechunk=True)
+    current_max_date = max(last_date, datetime.fromisoformat(str(combined_df["time"].max())))
     
     # Updating metadata files
+    metadata_folder.mkdir(parents=True, exist_ok=True)
     with open(metadata_file, "w") as f:
         json.dump({"last_date": current_max_date.isoformat()}, f)
+    manifest.clear()
     extract_logger.info(f"Weather extraction complete. last_date updated to {current_max_date.date()}")
     
     return combined_df
@@ -153,6 +240,28 @@ def extract_weather():
 
 
 
+# Function to extract the weather of the days in [start, end) to Parquet, without reading or moving the high-water mark
+# Returns the staged file, None when no data was returned
+@instrument_stage(labels = ["start", "end"])
+@shared_categories()
+def extract_weather_window(start, end, output_folder):
+    start_date = datetime(start.year, start.month, start.day)
+    last_day = datetime(end.year, end.month, end.day) - timedelta(days = 1)
+    manifest = SliceManifest(f"extract_weather_{start_date:%Y%m%d}_{last_day:%Y%m%d}", f"{start_date.date()}:{last_day.date()}:{grid_step}")
+    df = fetch_weather_window(start_date, last_day, manifest)
+
+    output = None
+    if df is not None:
+        output = Path(output_folder) / "weather.parquet"
+        output.parent.mkdir(parents = True, exist_ok = True)
+        df.write_parquet(output)
+    manifest.clear()
+    extract_logger.info(f"Extracted {0 if df is None else df.height} weather rows from {start_date.date()} to {last_day.date()}")
+    return str(output) if output else None
+
+
+
+
 # Entry point for weather extraction function
 if __name__ == "__main__":
     weather_df = extract_weather()
\ No newline at end of file
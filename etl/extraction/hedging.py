@@ -0,0 +1,178 @@
+# Hedged requests with per-request deadlines, so a single slow Socrata page or Open-Meteo window does not stall its batch
+# A request that has not answered after the recent p95 latency of its endpoint gets a duplicate, and whichever attempt
+# finishes first is returned. Hedges are limited to a share of the requests (the budget), so a slow endpoint never
+# gets more than that much extra load, and a request that has not answered by its deadline raises
+# concurrent.futures.TimeoutError, which is not the builtin TimeoutError before Python 3.11
+# Only idempotent GET requests are hedged, the loser's answer is dropped
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, FIRST_COMPLETED, TimeoutError as FutureTimeoutError, wait
+import numpy as np
+
+
+# Settings for hedging, disabled with ETL_HEDGING=0 (deadlines still apply)
+hedging_enabled = os.environ.get("ETL_HEDGING", "1") != "0"
+request_deadline = float(os.environ.get("ETL_REQUEST_DEADLINE", 60))  # seconds a request may take, hedge included
+hedge_quantile = 0.95
+hedge_budget = float(os.environ.get("ETL_HEDGE_BUDGET", 0.10))  # hedges per request at most
+hedge_burst = 2  # hedges allowed above the budget, so the first stragglers of a run can be hedged
+min_samples = 20  # latencies needed before the hedge delay is trusted, no hedging before
+latency_window = 500  # latencies the hedge delay is estimated from
+
+
+
+# Function to run fn on a daemon thread, returning its future
+# Attempts left behind by a deadline or a winning hedge keep running until their own timeout, and must not hold
+# up the exit of the process the way the workers of a ThreadPoolExecutor do
+def run_attempt(fn, args, kwargs) -> Future:
+    future = Future()
+
+    def target():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target = target, daemon = True).start()
+    return future
+
+
+# Function to get a quantile of a list of latencies, None without any
+def latency_quantile(latencies, quantile):
+    return float(np.quantile(latencies, quantile)) if len(latencies) else None
+
+
+
+
+# Hedging policy of one endpoint, shared by every request to it so the hedge delay follows its recent latency
+class HedgingPolicy:
+    def __init__(self, name, deadline = None, budget = None, quantile = hedge_quantile):
+        self.name = name
+        self.deadline = deadline
+        self.budget = budget
+        self.quantile = quantile
+        self.latencies = deque(maxlen = latency_window)
+        self.lock = threading.Lock()
+        self.last_report = None
+        self.clear_report()
+
+    # Function to get the delay after which a request is hedged, None until enough latencies are known
+    def hedge_delay(self):
+        with self.lock:
+            if len(self.latencies) < min_samples:
+                return None
+            return latency_quantile(list(self.latencies), self.quantile)
+
+    # Function to take a hedge from the budget, False once the hedges reach the budget share of the requests
+    def take_hedge(self):
+        budget = hedge_budget if self.budget is None else self.budget
+        with self.lock:
+            if self.hedges + 1 > budget * self.requests + hedge_burst:
+                self.denied += 1
+                return False
+            self.hedges += 1
+            return True
+
+    # Function to record the latency of an attempt once it finishes, including attempts that lost or were abandoned
+    # Leaving those out would bias the hedge delay towards the fast requests
+    def observe(self, future, started, hedge = False):
+        def record(done):
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                if done.exception() is None:
+                    self.latencies.append(elapsed)
+                if not hedge:
+                    self.primary_latencies.append(elapsed)
+        future.add_done_callback(record)
+
+    # Function to call fn(*args, **kwargs) with the endpoint's deadline and hedging
+    def call(self, fn, *args, **kwargs):
+        deadline = request_deadline if self.deadline is None else self.deadline
+        started = time.perf_counter()
+        with self.lock:
+            self.requests += 1
+        primary = run_attempt(fn, args, kwargs)
+        self.observe(primary, started)
+        attempts = [primary]
+
+        delay = self.hedge_delay() if hedging_enabled else None
+        if delay is not None and delay < deadline:
+            done, _ = wait(attempts, timeout = delay)
+            # A primary that failed before the hedge delay is not hedged, retrying is up to the caller
+            if not done and self.take_hedge():
+                hedge = run_attempt(fn, args, kwargs)
+                self.observe(hedge, time.perf_counter(), hedge = True)
+                attempts.append(hedge)
+
+        # The first attempt to succeed wins, an attempt failing while another one is still running is not final
+        pending = set(attempts)
+        error = None
+        while pending:
+            remaining = deadline - (time.perf_counter() - started)
+            done, pending = wait(pending, timeout = max(remaining, 0), return_when = FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    return self.finish(started, hedge_won = future is not primary, result = future.result())
+                error = error or future.exception()
+        if error is not None and not pending:
+            self.finish(started)
+            raise error
+        self.finish(started, timed_out = True)
+        raise FutureTimeoutError(f"{self.name} request did not answer within its {deadline:.0f} s deadline")
+
+    def finish(self, started, hedge_won = False, timed_out = False, result = None):
+        with self.lock:
+            self.returned_latencies.append(time.perf_counter() - started)
+            self.hedge_wins += hedge_won
+            self.timeouts += timed_out
+        return result
+
+    # Function to reset the counters reported since the last clear, the latencies of the hedge delay are kept
+    def clear_report(self):
+        with self.lock:
+            self.requests, self.hedges, self.hedge_wins, self.denied, self.timeouts = 0, 0, 0, 0, 0
+            self.returned_latencies, self.primary_latencies = [], []
+
+    # Function to report hedging since the last clear: hedge rate, and the tail latency of the requests against
+    # the latency their first attempt alone took. First attempts still running at the report are left out, which
+    # understates the latency saved. A cleared report is kept as last_report
+    def report(self, clear = True):
+        with self.lock:
+            returned, primary = list(self.returned_latencies), list(self.primary_latencies)
+            report = {
+                "endpoint": self.name,
+                "requests": self.requests,
+                "hedges": self.hedges,
+                "hedge_rate": round(self.hedges / self.requests, 4) if self.requests else 0.0,
+                "hedge_wins": self.hedge_wins,
+                "hedges_denied": self.denied,
+                "timeouts": self.timeouts,
+            }
+        for quantile in [0.5, 0.95, 0.99]:
+            label = f"p{round(quantile * 100)}"
+            report[f"{label}_s"] = latency_quantile(returned, quantile)
+            report[f"{label}_unhedged_s"] = latency_quantile(primary, quantile)
+        if report["p99_s"] is not None and report["p99_unhedged_s"] is not None:
+            report["p99_saved_s"] = max(report["p99_unhedged_s"] - report["p99_s"], 0.0)
+        if clear:
+            self.last_report = report
+            self.clear_report()
+        return report
+
+    # Function to log the report since the last clear, nothing when no request was made
+    def log_report(self, logger):
+        report = self.report()
+        if report["requests"] > 0:
+            logger.info(
+                f"{report['requests']} {self.name} requests, {report['hedges']} hedged ({report['hedge_rate']:.1%}), "
+                f"{report['hedge_wins']} won by the hedge, {report['timeouts']} timed out, "
+                f"p99 {report['p99_s'] or 0:.2f} s against {report['p99_unhedged_s'] or 0:.2f} s unhedged",
+                extra = {"stage": "hedging", **report}
+            )
+        return report
@@ -0,0 +1,53 @@
+# Optional hot cache of the preprocessed 311 dataset as uncompressed Arrow IPC, opened memory-mapped
+# Every process reading it shares the OS page cache instead of decoding the Parquet file into its own heap
+import polars as pl
+import os
+from pathlib import Path
+from etl.compact_schema import to_compact
+
+
+# Settings for the cache, disabled with ETL_IPC_CACHE=0
+use_ipc_cache = os.environ.get("ETL_IPC_CACHE", "1") != "0"
+
+
+
+# Function to get the cache file kept next to a Parquet file
+def ipc_cache_path(parquet_path) -> Path:
+    return Path(parquet_path).with_suffix(".arrow")
+
+
+
+
+# Function to rewrite the cache from a frame that was just written to parquet_path
+# The cache holds the compact schema, so callers get categoricals without casting the mapped frame: only the codes of
+# the categorical columns are copied on open (re-coded against the string cache), text and numbers stay mapped
+def refresh_ipc_cache(df: pl.DataFrame, parquet_path):
+    if not use_ipc_cache:
+        return
+    cache_path = ipc_cache_path(parquet_path)
+    tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+    to_compact(df).write_ipc(tmp_path, compression = "uncompressed")
+    os.replace(tmp_path, cache_path)
+
+
+
+
+# Function to check the cache exists and was written after the Parquet file it mirrors
+def ipc_cache_is_fresh(parquet_path) -> bool:
+    cache_path = ipc_cache_path(parquet_path)
+    return (
+        use_ipc_cache and cache_path.exists()
+        and cache_path.stat().st_mtime >= Path(parquet_path).stat().st_mtime
+    )
+
+
+
+
+# Function to read a dataset through its memory-mapped cache, rebuilding the cache from Parquet when stale
+# The frame comes back in the compact schema either way, to_compact only casts a cache written with decoded text
+def read_cached(parquet_path) -> pl.DataFrame:
+    if ipc_cache_is_fresh(parquet_path):
+        return to_compact(pl.read_ipc(ipc_cache_path(parquet_path), memory_map = True))
+    df = to_compact(pl.read_parquet(parquet_path))
+    refresh_ipc_cache(df, parquet_path)
+    return df
@@ -1,67 +1,100 @@
 from google.cloud import bigquery
 from google.oauth2 import service_account
 import polars as pl
+from functools import lru_cache
 from pathlib import Path
-from logger.etl_logger import ETLLogger
+from logger.stage_metrics import instrument_stage
+from etl.loading.loaded_key_index import LoadedKeyIndex
+from etl.loading.schema_manager import migrate
+from etl.loading import warehouse_sink
+from etl.loading.warehouse_sink import WarehouseSink, load_tables, load_logger
 
-# Initializing logger
-load_logger = ETLLogger("load").get()
-load_logger.info("Starting data loading")
-
-# BigQuery client setup
+# BigQuery client settings
 script_dir = Path(__file__).parent
 credentials_path = script_dir.parent / "credentials" / "bigquery_nyc_weather_etl_credentials.json"
-credentials = service_account.Credentials.from_service_account_file(credentials_path)
-client = bigquery.Client(project="nyc-311-weather-etl", credentials=credentials)
+project_id = "nyc-311-weather-etl"
 dataset_id = "nyc_311_weather"
 
-def load_to_bigquery(df_dict, chunk_size = 10_000):
-    for table_name, df in df_dict.items():
-        if df is None or df.height == 0:
-            load_logger.info(f"No data for table {table_name}, skipping...")
-            continue
-        load_logger.info(f"Starting load for table {table_name} ({df.height} rows)")
-        table_ref = f"{client.project}.{dataset_id}.{table_name}"
-        # Check if table exists
+
+
+# Function to get the BigQuery client, created on first use so importing this module needs no credentials
+@lru_cache(maxsize=None)
+def get_client():
+    credentials = service_account.Credentials.from_service_account_file(credentials_path)
+    return bigquery.Client(project=project_id, credentials=credentials)
+
+
+
+
+# BigQuery backend of the warehouse sink, appending pandas chunks through load jobs
+class BigQuerySink(WarehouseSink):
+    name = "bigquery"
+    chunk_size = 10_000
+
+    def __init__(self, client = None):
+        self.client = client or get_client()
+
+    def table_ref(self, table_name):
+        return f"{self.client.project}.{dataset_id}.{table_name}"
+
+    def table_exists(self, table_name):
         try:
-            table = client.get_table(table_ref)
-            table_exists = True
+            self.client.get_table(self.table_ref(table_name))
+            return True
         except Exception:
-            table_exists = False
-            load_logger.info(f"Table {table_name} does not exist. Will create new table automatically.")
-        # Convert Polars to pandas for BigQuery
-        df_pd = df.to_pandas()
-        
-        if table_name.startswith("dim_") and table_exists:
-            # For dimension tables, remove duplicates based on primary key
-            pk_field = table.schema[0].name
-            # Load existing primary keys
-            existing_df = client.list_rows(table).to_dataframe()
-            df_pd = df_pd.merge(existing_df[[pk_field]], on=pk_field, how="left", indicator=True)
-            df_pd = df_pd[df_pd["_merge"] == "left_only"].drop(columns=["_merge"])
-            load_logger.info(f"{len(df_pd)} new rows detected for {table_name}")
-        
-        if len(df_pd) == 0:
-            load_logger.info(f"No new rows to load for {table_name}")
-            continue
-        
-        # Loading in chunks
-        for start in range(0, len(df_pd), chunk_size):
-            end = start + chunk_size
-            chunk_df = df_pd.iloc[start:end]
-
-            try:
-                job = client.load_table_from_dataframe(
-                    chunk_df,
-                    table_ref,
-                    job_config=bigquery.LoadJobConfig(write_disposition="WRITE_APPEND")
-                )
-                job.result()  # Wait for completion
-                load_logger.info(f"Loaded rows {start} to {end} into {table_name}")
-            except Exception as e:
-                load_logger.error(f"Error loading rows {start} to {end} into {table_name}: {e}")
-
-        load_logger.info(f"Finished loading table {table_name}")
+            return False
+
+    def existing_keys(self, table_name, key_col):
+        table = self.client.get_table(self.table_ref(table_name))
+        fields = [field for field in table.schema if field.name == key_col]
+        return pl.from_pandas(self.client.list_rows(table, selected_fields=fields).to_dataframe())
+
+    # Function to delete already loaded rows that are about to be replaced by a changed version
+    def delete_keys(self, table_name, key_col, keys, batch_size = 10_000):
+        for start in range(0, len(keys), batch_size):
+            batch = [int(k) for k in keys[start:start + batch_size]]
+            job_config = bigquery.QueryJobConfig(
+                query_parameters=[bigquery.ArrayQueryParameter("keys", "INT64", batch)]
+            )
+            self.client.query(
+                f"DELETE FROM `{self.table_ref(table_name)}` WHERE {key_col} IN UNNEST(@keys)", job_config=job_config
+            ).result()
+
+    # Chunks are converted to pandas only right before sending
+    def append(self, table_name, df):
+        job = self.client.load_table_from_dataframe(
+            df.to_pandas(),
+            self.table_ref(table_name),
+            job_config=bigquery.LoadJobConfig(write_disposition="WRITE_APPEND")
+        )
+        job.result()  # Wait for completion
+
+    def replace_table(self, table_name, df):
+        job = self.client.load_table_from_dataframe(
+            df.to_pandas(),
+            self.table_ref(table_name),
+            job_config=bigquery.LoadJobConfig(write_disposition="WRITE_TRUNCATE")
+        )
+        job.result()
+
+    # The BigQuery key index keeps the file name it had before there were several sinks
+    # The folder is read from warehouse_sink on every call, so a run pointing it elsewhere moves this index too
+    def key_index(self, table_name = "fact_incidents"):
+        if table_name == "fact_incidents":
+            return LoadedKeyIndex(warehouse_sink.key_index_folder / "loaded_unique_keys.npy")
+        return super().key_index(table_name)
+
+
+
+
+@instrument_stage()
+def load_to_bigquery(df_dict, chunk_size = 10_000):
+    load_logger.info("Starting data loading")
+    sink = BigQuerySink()
+    # Missing tables are created partitioned and clustered before the first load job, which would otherwise create
+    # them without either
+    migrate(sink.client, dataset_id)
+    load_tables(df_dict, sink, chunk_size)
 
 if __name__ == "__main__":
-    load_to_bigquery()
\ No newline at end of file
+    load_to_bigquery()
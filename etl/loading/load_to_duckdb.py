@@ -0,0 +1,102 @@
+# Local DuckDB warehouse with the same star schema as BigQuery, for full pipeline runs and load benchmarks
+# Chunks are handed to DuckDB as Arrow tables, which it scans in place instead of converting row by row
+# DuckDB has no partitions, so fact chunks are stored sorted by partition date and clustering columns instead: the
+# zone maps DuckDB keeps per row group then skip the same data BigQuery's partition and cluster pruning does
+import duckdb
+import os
+import polars as pl
+from pathlib import Path
+from logger.stage_metrics import instrument_stage
+from etl.loading.warehouse_schema import warehouse_schema, duckdb_types, table_partitioning, table_clustering
+from etl.loading.warehouse_sink import WarehouseSink, load_tables, load_logger
+
+
+# Settings for the database file
+project_root = Path(__file__).resolve().parents[2]
+duckdb_path = Path(os.environ.get("ETL_DUCKDB_PATH", project_root / "data" / "warehouse.duckdb"))
+
+
+
+# Function to build the CREATE TABLE statement of a warehouse table, REQUIRED columns being NOT NULL
+def create_table_sql(table_name) -> str:
+    columns = [
+        f"{name} {duckdb_types[field_type]}{' NOT NULL' if mode == 'REQUIRED' else ''}"
+        for name, field_type, mode in warehouse_schema[table_name]
+    ]
+    return f"CREATE TABLE IF NOT EXISTS {table_name} ({', '.join(columns)})"
+
+
+
+
+# Function to build the statements adding the schema columns a table is missing, as the BigQuery schema manager
+# does; partition dates of the rows already stored are filled in from their date key
+def add_columns_sql(table_name, existing_columns) -> list:
+    statements = [
+        f"ALTER TABLE {table_name} ADD COLUMN {name} {duckdb_types[field_type]}"
+        for name, field_type, _ in warehouse_schema[table_name] if name not in existing_columns
+    ]
+    partitioning = table_partitioning.get(table_name)
+    if statements and partitioning and partitioning["column"] not in existing_columns:
+        statements.append(
+            f"UPDATE {table_name} SET {partitioning['column']} = "
+            f"try_strptime(CAST({partitioning['date_key']} AS VARCHAR), '%Y%m%d')::DATE"
+        )
+    return statements
+
+
+
+
+# DuckDB backend of the warehouse sink, every table of the schema is created when the database is opened
+class DuckDBSink(WarehouseSink):
+    name = "duckdb"
+
+    def __init__(self, path = duckdb_path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents = True, exist_ok = True)
+        self.connection = duckdb.connect(str(self.path))
+        for table_name in warehouse_schema:
+            self.connection.execute(create_table_sql(table_name))
+            existing_columns = {row[0] for row in self.connection.execute(f"DESCRIBE {table_name}").fetchall()}
+            for statement in add_columns_sql(table_name, existing_columns):
+                self.connection.execute(statement)
+
+    # Tables always exist, so a table counts as existing once it holds rows
+    def table_exists(self, table_name):
+        return self.connection.execute(f"SELECT count(*) FROM (SELECT 1 FROM {table_name} LIMIT 1)").fetchone()[0] > 0
+
+    def existing_keys(self, table_name, key_col):
+        return pl.from_arrow(self.connection.execute(f"SELECT DISTINCT {key_col} FROM {table_name}").arrow())
+
+    def delete_keys(self, table_name, key_col, keys):
+        self.connection.register("deleted_keys", pl.DataFrame({key_col: keys}).to_arrow())
+        self.connection.execute(f"DELETE FROM {table_name} WHERE {key_col} IN (SELECT {key_col} FROM deleted_keys)")
+        self.connection.unregister("deleted_keys")
+
+    def append(self, table_name, df):
+        if table_name in table_partitioning:
+            # Rows are ordered the way BigQuery stores them: by monthly partition, then by clustering columns
+            month = pl.col(table_partitioning[table_name]["column"]).dt.truncate("1mo")
+            df = df.sort([month, *table_clustering[table_name]], nulls_last = True)
+        self.connection.register("chunk", df.to_arrow())
+        self.connection.execute(f"INSERT INTO {table_name} BY NAME SELECT * FROM chunk")
+        self.connection.unregister("chunk")
+
+    def replace_table(self, table_name, df):
+        self.connection.register("replacement", df.to_arrow())
+        self.connection.execute(f"CREATE OR REPLACE TABLE {table_name} AS SELECT * FROM replacement")
+        self.connection.unregister("replacement")
+
+    def close(self):
+        self.connection.close()
+
+
+
+
+@instrument_stage()
+def load_to_duckdb(df_dict, path = duckdb_path):
+    load_logger.info(f"Starting data loading into {path}")
+    sink = DuckDBSink(path)
+    try:
+        load_tables(df_dict, sink)
+    finally:
+        sink.close()
@@ -0,0 +1,93 @@
+# Local Parquet lake holding the star schema as Hive-partitioned Parquet datasets, one folder per table
+# Fact tables are partitioned by month (<table>/month=YYYYMM/part-*.parquet), dimensions are a single folder
+# The layout is the one BigQuery load jobs read with hive partitioning, so the lake can be copied to a bucket and
+# ingested with a single bulk load per table
+# Rows of each month are sorted by the table's clustering columns, so Parquet row-group statistics prune the way
+# BigQuery's clustering does
+import os
+import uuid
+import polars as pl
+import pyarrow.parquet as pq
+from pathlib import Path
+from logger.stage_metrics import instrument_stage
+from etl.loading.warehouse_schema import warehouse_schema, polars_types, table_clustering
+from etl.loading.warehouse_sink import WarehouseSink, load_tables, load_logger
+
+
+# Settings for the lake folder
+project_root = Path(__file__).resolve().parents[2]
+lake_folder = Path(os.environ.get("ETL_LAKE_DIR", project_root / "data" / "lake"))
+
+# Date key each fact table is partitioned by, the partition value is its YYYYMM month
+partition_keys = {"fact_incidents": "created_date_id", "fact_weather": "date_id", "fact_daily_summary": "date_id"}
+partition_column = "month"
+
+
+
+# Parquet lake backend of the warehouse sink, each append writes new files and never rewrites existing ones
+class ParquetLakeSink(WarehouseSink):
+    name = "lake"
+
+    def __init__(self, root = lake_folder):
+        self.root = Path(root)
+
+    def files(self, table_name):
+        return sorted((self.root / table_name).rglob("*.parquet"))
+
+    def table_exists(self, table_name):
+        return len(self.files(table_name)) > 0
+
+    def existing_keys(self, table_name, key_col):
+        return pl.scan_parquet(self.files(table_name)).select(key_col).unique().collect()
+
+    # Deleting rows rewrites only the files holding any of the keys
+    def delete_keys(self, table_name, key_col, keys):
+        keys = pl.Series(key_col, keys).cast(pl.Int64)
+        for path in self.files(table_name):
+            df = pl.read_parquet(path)
+            remaining = df.filter(~pl.col(key_col).is_in(keys))
+            if remaining.height == df.height:
+                continue
+            if remaining.height == 0:
+                path.unlink()
+                continue
+            tmp_path = path.with_name(path.name + ".tmp")
+            pq.write_table(remaining.to_arrow().cast(self.arrow_schema(table_name)), tmp_path)
+            os.replace(tmp_path, path)
+
+    # Arrow schema of a table's files, kept identical across files so the dataset reads as one table
+    def arrow_schema(self, table_name):
+        empty = pl.DataFrame(schema = {name: polars_types[field_type] for name, field_type, _ in warehouse_schema[table_name]})
+        return empty.to_arrow().schema
+
+    def append(self, table_name, df):
+        if table_name in table_clustering:
+            df = df.sort(table_clustering[table_name], nulls_last = True)
+        table = df.to_arrow().cast(self.arrow_schema(table_name))
+        basename = f"part-{uuid.uuid4().hex}-{{i}}.parquet"
+        if table_name in partition_keys:
+            # The month is only a folder name, the files keep the schema columns alone
+            month = pl.col(partition_keys[table_name]) // 100
+            table = table.append_column(partition_column, df.select(month.fill_null(0).cast(pl.Int64)).to_series().to_arrow())
+            pq.write_to_dataset(
+                table, self.root / table_name, partition_cols = [partition_column],
+                basename_template = basename
+            )
+        else:
+            pq.write_to_dataset(table, self.root / table_name, basename_template = basename)
+
+    # Derived tables are a single file, swapped in with a rename
+    def replace_table(self, table_name, df):
+        path = self.root / table_name / "data.parquet"
+        path.parent.mkdir(parents = True, exist_ok = True)
+        tmp_path = path.with_name(path.name + ".tmp")
+        pq.write_table(df.to_arrow(), tmp_path)
+        os.replace(tmp_path, path)
+
+
+
+
+@instrument_stage()
+def load_to_lake(df_dict, root = lake_folder):
+    load_logger.info(f"Starting data loading into {root}")
+    load_tables(df_dict, ParquetLakeSink(root))
@@ -0,0 +1,83 @@
+# Persistent index of every unique_key already loaded, used to dedupe facts across runs
+import numpy as np
+import polars as pl
+import os
+from pathlib import Path
+
+
+# Settings for file path locations
+project_root = Path(__file__).resolve().parents[2]
+key_index_file = project_root / "metadata" / "loaded_unique_keys.npy"
+
+
+
+# Class wrapping a sorted int64 array of keys and the row hash each key was loaded with
+# Both are the two rows of a single (2, n) int64 .npy file, the hashes stored by their bits, so one rename replaces
+# them together. The file is memory-mapped and each row is contiguous, so lookups never load it into the heap
+class LoadedKeyIndex:
+    def __init__(self, path = key_index_file):
+        self.path = Path(path)
+        self.keys, self.hashes = self._open()
+
+    def _open(self):
+        if not self.path.exists():
+            return np.empty(0, dtype = np.int64), np.empty(0, dtype = np.uint64)
+        stored = np.load(self.path, mmap_mode = "r")
+        return stored[0], stored[1].view(np.uint64)
+
+    def __len__(self):
+        return len(self.keys)
+
+    # Vectorized binary search returning which keys are stored and their positions in the index
+    def lookup(self, keys):
+        keys = np.asarray(keys, dtype = np.int64)
+        if len(self.keys) == 0:
+            return np.zeros(len(keys), dtype = bool), np.zeros(len(keys), dtype = np.int64)
+        positions = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return self.keys[positions] == keys, positions
+
+    def contains(self, keys) -> np.ndarray:
+        return self.lookup(keys)[0]
+
+    # Function to keep only the rows whose key has not been loaded before
+    def filter_new(self, df: pl.DataFrame, key_col: str) -> pl.DataFrame:
+        keys = df[key_col].fill_null(-1).cast(pl.Int64).to_numpy()
+        return df.filter(pl.Series(~self.contains(keys)))
+
+    # Function to keep new rows plus rows whose hash differs from the one they were loaded with
+    # Returns the rows to load and the keys among them that replace an already loaded row
+    def select_for_load(self, df: pl.DataFrame, key_col: str, hash_col: str):
+        if hash_col not in df.columns:
+            return self.filter_new(df, key_col), np.empty(0, dtype = np.int64)
+
+        keys = df[key_col].fill_null(-1).cast(pl.Int64).to_numpy()
+        hashes = df[hash_col].fill_null(0).cast(pl.UInt64).to_numpy()
+        found, positions = self.lookup(keys)
+        stored = np.where(found, self.hashes[positions] if len(self.hashes) else 0, 0)
+        changed = found & (stored != 0) & (stored != hashes)
+        return df.filter(pl.Series(~found | changed)), keys[changed]
+
+    # Function to upsert keys (and their row hashes) and atomically replace the file on disk
+    def add(self, keys, hashes = None):
+        keys = np.asarray(keys, dtype = np.int64)
+        hashes = np.zeros(len(keys), dtype = np.uint64) if hashes is None else np.asarray(hashes, dtype = np.uint64)
+        keys, first = np.unique(keys, return_index = True)
+        hashes = hashes[first]
+        if len(keys) == 0:
+            return 0
+
+        found, positions = self.lookup(keys)
+        merged_hashes = np.array(self.hashes, dtype = np.uint64)
+        known = found & (hashes != 0)
+        merged_hashes[positions[known]] = hashes[known]
+
+        insert_at = np.searchsorted(self.keys, keys[~found])
+        merged_keys = np.insert(self.keys, insert_at, keys[~found])
+        merged_hashes = np.insert(merged_hashes, insert_at, hashes[~found])
+
+        self.path.parent.mkdir(parents = True, exist_ok = True)
+        tmp_path = self.path.with_name(self.path.stem + ".tmp.npy")
+        np.save(tmp_path, np.stack([merged_keys, merged_hashes.view(np.int64)]))
+        os.replace(tmp_path, self.path)
+        self.keys, self.hashes = self._open()
+        return int((~found).sum())
@@ -0,0 +1,210 @@
+# Incrementally maintained rollups of fact_incidents, the aggregates the dashboards read instead of the fact table
+# Each rollup is declared as a grain (group-by columns) and additive measures:
+#   count        rows of the group
+#   sum          sum of an expression, e.g. incidents resolved the same day
+#   min, max     extremes of an expression
+# Every load merges the facts it loaded into the persisted rollups instead of aggregating the whole history again
+# A reloaded fact (changed row hash) first retracts the version it replaces, which the store finds in its ledger:
+# the grain and measure inputs of every fact loaded so far, one Parquet file per created month (which a reload does
+# not change), so an update only rewrites the months its facts belong to. Counts and sums stay exact under
+# retractions; min and max are only kept exact for inputs a reload does not change (such as the created date), since
+# a retraction never narrows them
+import os
+import polars as pl
+from pathlib import Path
+from etl.loading.warehouse_schema import date_from_key
+
+
+# Source fact table of the rollups and its key
+rollup_source = "fact_incidents"
+rollup_key = "incident_id"
+
+# Rollup definitions, the grain and measure expressions read the fact_incidents frame of the transformation
+# Agencies and complaint categories are grouped by name, their ids being assigned per run
+rollup_definitions = {
+    "rollup_daily_borough": {
+        "grain": {"date_id": pl.col("created_date_id"), "borough_id": pl.col("borough_id")},
+        "measures": {
+            "incidents": ("count", None),
+            "resolved_same_day": ("sum", pl.col("is_resolved_same_day")),
+            "open_incidents": ("sum", pl.col("closed_date_id").is_null().cast(pl.Int64)),
+        },
+    },
+    "rollup_monthly_borough_category": {
+        "grain": {
+            "month_id": pl.col("created_date_id") // 100,
+            "borough_id": pl.col("borough_id"),
+            "complaint_category": pl.col("complaint_category"),
+        },
+        "measures": {
+            "incidents": ("count", None),
+            "resolved_same_day": ("sum", pl.col("is_resolved_same_day")),
+            "open_incidents": ("sum", pl.col("closed_date_id").is_null().cast(pl.Int64)),
+            "first_date_id": ("min", pl.col("created_date_id")),
+            "last_date_id": ("max", pl.col("created_date_id")),
+        },
+    },
+    "rollup_weekly_agency": {
+        "grain": {
+            # Monday of the created date, as a YYYYMMDD date key
+            "week_start_id": date_from_key("created_date_id").dt.truncate("1w").dt.strftime("%Y%m%d").cast(pl.Int64),
+            "agency": pl.col("agency"),
+        },
+        "measures": {
+            "incidents": ("count", None),
+            "resolved_same_day": ("sum", pl.col("is_resolved_same_day")),
+            "open_incidents": ("sum", pl.col("closed_date_id").is_null().cast(pl.Int64)),
+            "first_date_id": ("min", pl.col("created_date_id")),
+            "last_date_id": ("max", pl.col("created_date_id")),
+        },
+    },
+}
+
+# Temporary column holding the created month each fact's ledger file is keyed by
+ledger_month = "ledger_month"
+
+
+
+# Function to list the source columns a set of rollup definitions reads, which is what the ledger keeps per fact
+def source_columns(definitions = rollup_definitions, key_col = rollup_key) -> list:
+    columns = {key_col, "created_date_id"}
+    for definition in definitions.values():
+        expressions = list(definition["grain"].values()) + [expr for _, expr in definition["measures"].values() if expr is not None]
+        for expr in expressions:
+            columns.update(expr.meta.root_names())
+    return sorted(columns)
+
+
+# Function to get the name of the count measure of a definition, a group whose count drops to 0 is removed
+def count_measure(definition) -> str:
+    return next(name for name, (kind, _) in definition["measures"].items() if kind == "count")
+
+
+
+
+# Function to aggregate facts at the grain of a rollup, sign -1 aggregating facts being retracted
+# Retracted facts leave min and max untouched, their partial aggregates are null
+def aggregate(df: pl.DataFrame, definition, sign = 1, key_col = rollup_key) -> pl.DataFrame:
+    aggregations = []
+    for name, (kind, expr) in definition["measures"].items():
+        if kind == "count":
+            aggregations.append((pl.col(key_col).len().cast(pl.Int64) * sign).alias(name))
+        elif kind == "sum":
+            aggregations.append((expr.cast(pl.Int64).sum() * sign).alias(name))
+        elif sign > 0:
+            aggregations.append((expr.min() if kind == "min" else expr.max()).alias(name))
+        else:
+            aggregations.append(pl.lit(None).cast(pl.Int64).alias(name))
+    grain = [expr.alias(name) for name, expr in definition["grain"].items()]
+    return df.group_by(grain).agg(aggregations)
+
+
+# Function to merge partial aggregates into a rollup, dropping the groups left without any fact
+def merge(parts, definition) -> pl.DataFrame:
+    combine = {"count": pl.Expr.sum, "sum": pl.Expr.sum, "min": pl.Expr.min, "max": pl.Expr.max}
+    merged = pl.concat([part for part in parts if part is not None], how = "vertical_relaxed").group_by(list(definition["grain"])).agg([
+        combine[kind](pl.col(name)).alias(name) for name, (kind, _) in definition["measures"].items()
+    ])
+    return merged.filter(pl.col(count_measure(definition)) > 0).sort(list(definition["grain"]), nulls_last = True)
+
+
+# Function to compute every rollup from the full set of facts, the reference the incremental rollups are checked
+# against
+def recompute_rollups(facts: pl.DataFrame, definitions = rollup_definitions, key_col = rollup_key) -> dict:
+    facts = facts.unique(subset = [key_col], keep = "last")
+    return {name: merge([aggregate(facts, definition, key_col = key_col)], definition) for name, definition in definitions.items()}
+
+
+# Function to compare two versions of a rollup, returning the number of groups that differ
+# Rollups are small enough to be compared as sets of rows
+def rollup_differences(left: pl.DataFrame, right: pl.DataFrame, definition) -> int:
+    columns = list(definition["grain"]) + list(definition["measures"])
+    left_rows, right_rows = set(left.select(columns).rows()), set(right.select(columns).rows())
+    grain_size = len(definition["grain"])
+    return len({row[:grain_size] for row in left_rows ^ right_rows})
+
+
+
+
+# Persistent store of the rollups and their ledger, one per warehouse sink
+class RollupStore:
+    def __init__(self, folder, definitions = rollup_definitions, key_col = rollup_key):
+        self.folder = Path(folder)
+        self.definitions = definitions
+        self.key_col = key_col
+        self.columns = source_columns(definitions, key_col)
+
+    def rollup_path(self, name):
+        return self.folder / f"{name}.parquet"
+
+    def ledger_path(self, month):
+        return self.folder / "ledger" / f"month={month}.parquet"
+
+    # Function to read a rollup, None before the first update
+    def read(self, name):
+        path = self.rollup_path(name)
+        return pl.read_parquet(path) if path.exists() else None
+
+    # Function to merge newly loaded facts into the rollups, returning the updated rollups
+    # Facts whose key is already in the ledger replace the version they were aggregated with
+    def update(self, facts: pl.DataFrame) -> dict:
+        facts = facts.select(self.columns).unique(subset = [self.key_col], keep = "last")
+        retracted_parts, ledgers = [], {}
+        for month, month_facts in self.by_month(facts):
+            path = self.ledger_path(month)
+            if path.exists():
+                ledger = pl.read_parquet(path)
+                keys = month_facts.select(self.key_col)
+                retracted_parts.append(ledger.join(keys, on = self.key_col, how = "semi"))
+                ledger = pl.concat([ledger.join(keys, on = self.key_col, how = "anti"), month_facts], how = "vertical_relaxed")
+            else:
+                ledger = month_facts
+            ledgers[path] = ledger
+        retracted = pl.concat(retracted_parts, how = "vertical_relaxed") if retracted_parts else None
+
+        rollups = {}
+        for name, definition in self.definitions.items():
+            parts = [self.read(name), aggregate(facts, definition, key_col = self.key_col)]
+            if retracted is not None and retracted.height > 0:
+                parts.append(aggregate(retracted, definition, sign = -1, key_col = self.key_col))
+            rollups[name] = merge(parts, definition)
+
+        # Every file is written in full before any is replaced, keeping the window where rollups and ledger
+        # disagree down to a few renames
+        self.write_all({**{self.rollup_path(name): df for name, df in rollups.items()}, **ledgers})
+        return rollups
+
+    # Function to rebuild the rollups and the ledger from the full set of facts, e.g. after a lost update
+    def rebuild(self, facts: pl.DataFrame) -> dict:
+        facts = facts.select(self.columns).unique(subset = [self.key_col], keep = "last")
+        rollups = recompute_rollups(facts, self.definitions, self.key_col)
+        ledgers = {self.ledger_path(month): month_facts for month, month_facts in self.by_month(facts)}
+        for path in (self.folder / "ledger").glob("*.parquet"):
+            if path not in ledgers:
+                path.unlink()
+        self.write_all({**{self.rollup_path(name): df for name, df in rollups.items()}, **ledgers})
+        return rollups
+
+    # Function to check the rollups against a full recomputation from the facts, returning the differing groups
+    def verify(self, facts: pl.DataFrame) -> dict:
+        expected = recompute_rollups(facts.select(self.columns), self.definitions, self.key_col)
+        differences = {}
+        for name, definition in self.definitions.items():
+            stored = self.read(name)
+            differences[name] = expected[name].height if stored is None else rollup_differences(stored, expected[name], definition)
+        return differences
+
+    # Function to split facts by the created month their ledger file is keyed by, 0 for facts without a date
+    def by_month(self, facts):
+        facts = facts.with_columns((pl.col("created_date_id") // 100).fill_null(0).cast(pl.Int64).alias(ledger_month))
+        for month_facts in facts.partition_by(ledger_month, maintain_order = False):
+            yield month_facts[ledger_month][0], month_facts.drop(ledger_month)
+
+    def write_all(self, frames):
+        tmp_paths = {}
+        for path, df in frames.items():
+            path.parent.mkdir(parents = True, exist_ok = True)
+            tmp_paths[path] = path.with_name(path.name + ".tmp")
+            df.write_parquet(tmp_paths[path])
+        for path, tmp_path in tmp_paths.items():
+            os.replace(tmp_path, path)
@@ -0,0 +1,193 @@
+# Non-destructive schema manager for the BigQuery warehouse
+# The desired tables (etl/loading/warehouse_schema.py) are diffed against the tables of the dataset, and only
+# migrations that keep every stored row are applied:
+#   create    missing tables, with their partitioning and clustering
+#   add       missing columns, appended as NULLABLE, partition dates backfilled from their date key
+#   relax     REQUIRED columns the schema now declares NULLABLE
+#   rebuild   tables whose partitioning or clustering differs, copied into a new table which then takes the old
+#             table's name; the old table is kept under a backup name. Only applied when asked for explicitly
+# Type changes are reported and never applied, and columns the schema no longer has are left in place
+# Every migration is plain DDL sent through client.query, so a client that records queries sees the full plan
+from datetime import date
+from etl.loading.warehouse_schema import warehouse_schema, table_partitioning, table_clustering
+from etl.loading.warehouse_sink import load_logger
+
+
+# Type names used in BigQuery DDL for each schema type
+ddl_types = {"INT64": "INT64", "FLOAT": "FLOAT64", "STRING": "STRING", "DATE": "DATE"}
+
+# Type names the BigQuery API (legacy names) and Arrow use for each schema type
+type_aliases = {
+    "INTEGER": "INT64", "FLOAT64": "FLOAT", "NUMERIC": "FLOAT", "BIGNUMERIC": "FLOAT",
+    "INT": "INT64", "DOUBLE": "FLOAT", "LARGE_STRING": "STRING", "DATE32[DAY]": "DATE",
+}
+
+
+
+# Function to normalize a column type reported by BigQuery to the type names of the warehouse schema
+def normalize_type(field_type) -> str:
+    field_type = str(field_type).upper()
+    return type_aliases.get(field_type, field_type)
+
+
+
+
+# Function to build the PARTITION BY and CLUSTER BY clauses of a table, empty for tables that have neither
+def layout_clauses(table_name) -> str:
+    clauses = []
+    partitioning = table_partitioning.get(table_name)
+    if partitioning:
+        clauses.append(f"PARTITION BY DATE_TRUNC({partitioning['column']}, {partitioning['granularity']})")
+    if table_clustering.get(table_name):
+        clauses.append(f"CLUSTER BY {', '.join(table_clustering[table_name])}")
+    return " ".join(clauses)
+
+
+# Function to build the CREATE TABLE statement of a warehouse table
+def create_table_ddl(table_ref, table_name) -> str:
+    columns = [
+        f"{name} {ddl_types[field_type]}{' NOT NULL' if mode == 'REQUIRED' else ''}"
+        for name, field_type, mode in warehouse_schema[table_name]
+    ]
+    statement = f"CREATE TABLE IF NOT EXISTS `{table_ref}` ({', '.join(columns)})"
+    return f"{statement} {layout_clauses(table_name)}".rstrip()
+
+
+# Function to get the SQL expression of a partition date from its YYYYMMDD date key
+def partition_date_sql(table_name) -> str:
+    return f"SAFE.PARSE_DATE('%Y%m%d', CAST({table_partitioning[table_name]['date_key']} AS STRING))"
+
+
+
+
+# Function to read the partitioning and clustering of an existing table, as (partition column, granularity, clustering)
+def existing_layout(table):
+    partitioning = getattr(table, "time_partitioning", None)
+    clustering = list(getattr(table, "clustering_fields", None) or [])
+    if partitioning is None:
+        return None, None, clustering
+    return partitioning.field, partitioning.type_, clustering
+
+
+# Function to read the partitioning and clustering a table should have, in the shape of existing_layout
+def desired_layout(table_name):
+    partitioning = table_partitioning.get(table_name)
+    if partitioning is None:
+        return None, None, list(table_clustering.get(table_name, []))
+    return partitioning["column"], partitioning["granularity"], list(table_clustering.get(table_name, []))
+
+
+
+
+# Function to diff one existing table against its desired schema and list the migrations it needs
+def diff_table(table_ref, table_name, table):
+    migrations = []
+    existing = {field.name: (normalize_type(field.field_type), field.mode or "NULLABLE") for field in table.schema}
+    desired = warehouse_schema[table_name]
+
+    changed = [
+        f"{name} {existing[name][0]} -> {field_type}" for name, field_type, _ in desired
+        if name in existing and existing[name][0] != field_type
+    ]
+    if changed:
+        migrations.append({
+            "table": table_name, "action": "incompatible", "statements": [],
+            "reason": f"column types changed ({', '.join(changed)}), needs a manual migration"
+        })
+
+    missing = [(name, field_type) for name, field_type, _ in desired if name not in existing]
+    if missing:
+        statements = [
+            f"ALTER TABLE `{table_ref}` ADD COLUMN IF NOT EXISTS {name} {ddl_types[field_type]}" for name, field_type in missing
+        ]
+        # Partition dates of the rows already stored are filled in from their date key
+        partitioning = table_partitioning.get(table_name)
+        if partitioning and partitioning["column"] in dict(missing):
+            statements.append(
+                f"UPDATE `{table_ref}` SET {partitioning['column']} = {partition_date_sql(table_name)} "
+                f"WHERE {partitioning['column']} IS NULL"
+            )
+        migrations.append({
+            "table": table_name, "action": "add", "statements": statements,
+            "reason": f"missing columns {', '.join(name for name, _ in missing)}"
+        })
+
+    relaxed = [name for name, _, mode in desired if name in existing and existing[name][1] == "REQUIRED" and mode != "REQUIRED"]
+    if relaxed:
+        migrations.append({
+            "table": table_name, "action": "relax",
+            "statements": [f"ALTER TABLE `{table_ref}` ALTER COLUMN {name} DROP NOT NULL" for name in relaxed],
+            "reason": f"columns now nullable {', '.join(relaxed)}"
+        })
+
+    extra = [name for name in existing if name not in {name for name, _, _ in desired}]
+    if extra:
+        load_logger.info(f"Table {table_name} keeps columns the schema no longer has: {', '.join(extra)}")
+
+    if existing_layout(table) != desired_layout(table_name):
+        # Partitioning cannot be changed in place, the table is copied into a new partitioned and clustered table
+        # and the original is kept under a backup name
+        suffix = date.today().strftime("%Y%m%d")
+        staging_ref = f"{table_ref}__migrating"
+        migrations.append({
+            "table": table_name, "action": "rebuild",
+            "statements": [
+                f"CREATE TABLE `{staging_ref}` {layout_clauses(table_name)} AS SELECT * FROM `{table_ref}`",
+                f"ALTER TABLE `{table_ref}` RENAME TO {table_name}__backup_{suffix}",
+                f"ALTER TABLE `{staging_ref}` RENAME TO {table_name}",
+            ],
+            "reason": f"layout {existing_layout(table)} differs from {desired_layout(table_name)}"
+        })
+    return migrations
+
+
+
+
+# Function to plan the migrations of every warehouse table of a dataset, in the order they have to be applied
+# Tables the client cannot find are created, any error from get_table is read as a missing table
+def plan_migrations(client, dataset_id):
+    migrations = []
+    for table_name in warehouse_schema:
+        table_ref = f"{client.project}.{dataset_id}.{table_name}"
+        try:
+            table = client.get_table(table_ref)
+        except Exception:
+            migrations.append({
+                "table": table_name, "action": "create",
+                "statements": [create_table_ddl(table_ref, table_name)], "reason": "table does not exist"
+            })
+            continue
+        migrations.extend(diff_table(table_ref, table_name, table))
+    return migrations
+
+
+
+
+# Function to apply planned migrations, returning the ones applied
+# Rebuilds copy the whole table and are skipped unless allow_rebuild is set, incompatible changes are only logged
+def apply_migrations(client, migrations, allow_rebuild = False):
+    applied = []
+    for migration in migrations:
+        if migration["action"] == "incompatible":
+            load_logger.warning(f"Not migrating {migration['table']}: {migration['reason']}")
+            continue
+        if migration["action"] == "rebuild" and not allow_rebuild:
+            load_logger.warning(f"Table {migration['table']} needs a rebuild, skipped: {migration['reason']}")
+            continue
+        for statement in migration["statements"]:
+            client.query(statement).result()
+        load_logger.info(f"Applied {migration['action']} migration to {migration['table']}: {migration['reason']}")
+        applied.append(migration)
+    return applied
+
+
+
+
+# Function to bring the dataset to the warehouse schema, the entry point of scripts/bigquery_table_creation.py
+def migrate(client, dataset_id, allow_rebuild = False, dry_run = False):
+    migrations = plan_migrations(client, dataset_id)
+    if not migrations:
+        load_logger.info(f"Dataset {dataset_id} is up to date")
+    if dry_run:
+        return migrations
+    return apply_migrations(client, migrations, allow_rebuild)
@@ -0,0 +1,179 @@
+# Star schema of the warehouse, shared by every sink and by the schema manager (etl/loading/schema_manager.py)
+# Each table is a list of (column, BigQuery type, mode), the first column being the table's key
+# Columns are only ever appended to a table, so that existing tables can be migrated by adding columns
+import polars as pl
+from etl.compact_schema import to_warehouse
+
+
+warehouse_schema = {
+    ## Dimension Tables
+    "dim_date": [
+        ("date_id", "INT64", "REQUIRED"),
+        ("date", "DATE", "REQUIRED"),
+        ("day", "INT64", "NULLABLE"),
+        ("month", "INT64", "NULLABLE"),
+        ("year", "INT64", "NULLABLE"),
+        ("weekday", "INT64", "NULLABLE"),
+        ("weekday_name", "STRING", "NULLABLE"),
+    ],
+    "dim_borough": [
+        ("borough_id", "INT64", "REQUIRED"),
+        ("borough_name", "STRING", "NULLABLE"),
+    ],
+    "dim_location": [
+        ("location_id", "INT64", "REQUIRED"),
+        ("incident_zip", "STRING", "NULLABLE"),
+        ("borough", "STRING", "NULLABLE"),
+        ("city", "STRING", "NULLABLE"),
+        ("location_type", "STRING", "NULLABLE"),
+        ("latitude", "FLOAT", "NULLABLE"),
+        ("longitude", "FLOAT", "NULLABLE"),
+        ("incident_modzcta", "STRING", "NULLABLE"),
+    ],
+    "dim_complaint_type": [
+        ("complaint_type_id", "INT64", "REQUIRED"),
+        ("complaint_type", "STRING", "NULLABLE"),
+        ("complaint_category", "STRING", "NULLABLE"),
+        ("complaint_descriptor", "STRING", "NULLABLE"),
+    ],
+    "dim_agency": [
+        ("agency_id", "INT64", "REQUIRED"),
+        ("agency", "STRING", "NULLABLE"),
+        ("agency_name", "STRING", "NULLABLE"),
+    ],
+
+    ## Fact Tables
+    "fact_incidents": [
+        ("incident_id", "INT64", "REQUIRED"),
+        ("date_id", "INT64", "NULLABLE"),
+        ("location_id", "INT64", "NULLABLE"),
+        ("weather_grid_id", "INT64", "NULLABLE"),
+        ("agency_id", "INT64", "NULLABLE"),
+        ("complaint_type_id", "INT64", "NULLABLE"),
+        ("created_date_id", "INT64", "NULLABLE"),
+        ("closed_date_id", "INT64", "NULLABLE"),
+        ("resolution_status", "STRING", "NULLABLE"),
+        ("time_to_resolve_interval", "STRING", "NULLABLE"),
+        ("is_resolved_same_day", "INT64", "NULLABLE"),
+        ("complaint_count", "INT64", "NULLABLE"),
+        ("borough_id", "INT64", "NULLABLE"),
+        ("created_date", "DATE", "NULLABLE"),
+    ],
+    "fact_weather": [
+        ("weather_id", "INT64", "REQUIRED"),
+        ("date_id", "INT64", "NULLABLE"),
+        ("borough_id", "INT64", "NULLABLE"),
+        ("grid_id", "INT64", "NULLABLE"),
+        ("temperature_max", "FLOAT", "NULLABLE"),
+        ("temperature_min", "FLOAT", "NULLABLE"),
+        ("precipitation_total", "FLOAT", "NULLABLE"),
+        ("precipitation_hours", "INT64", "NULLABLE"),
+        ("rain_total", "FLOAT", "NULLABLE"),
+        ("showers_total", "FLOAT", "NULLABLE"),
+        ("snowfall_total", "FLOAT", "NULLABLE"),
+        ("windspeed_max", "FLOAT", "NULLABLE"),
+        ("windgust_max", "FLOAT", "NULLABLE"),
+        ("rain_flag", "INT64", "NULLABLE"),
+        ("showers_flag", "INT64", "NULLABLE"),
+        ("snow_flag", "INT64", "NULLABLE"),
+        ("high_wind_flag", "INT64", "NULLABLE"),
+        ("date", "DATE", "NULLABLE"),
+    ],
+    "fact_daily_summary": [
+        ("date_id", "INT64", "NULLABLE"),
+        ("borough_id", "INT64", "NULLABLE"),
+        ("total_incidents", "INT64", "NULLABLE"),
+        ("percent_resolved_same_day", "FLOAT", "NULLABLE"),
+        ("temperature_avg", "FLOAT", "NULLABLE"),
+        ("temperature_max", "FLOAT", "NULLABLE"),
+        ("temperature_min", "FLOAT", "NULLABLE"),
+        ("precipitation_total", "FLOAT", "NULLABLE"),
+        ("precipitation_per_hour", "FLOAT", "NULLABLE"),
+        ("rain_total", "FLOAT", "NULLABLE"),
+        ("showers_total", "FLOAT", "NULLABLE"),
+        ("windspeed_max", "FLOAT", "NULLABLE"),
+        ("windgust_max", "FLOAT", "NULLABLE"),
+        ("resolved_same_day_flag", "INT64", "NULLABLE"),
+        ("rain_flag", "INT64", "NULLABLE"),
+        ("showers_flag", "INT64", "NULLABLE"),
+        ("snow_flag", "INT64", "NULLABLE"),
+        ("high_wind_flag", "INT64", "NULLABLE"),
+        ("date", "DATE", "NULLABLE"),
+    ],
+    # Rolling and lagged weather of each borough day (etl/transformation/weather_features.py), feature_id being
+    # date_id * 100 + borough_id
+    "fact_weather_features": [
+        ("feature_id", "INT64", "REQUIRED"),
+        ("date_id", "INT64", "NULLABLE"),
+        ("borough_id", "INT64", "NULLABLE"),
+        ("rain_total_3d", "FLOAT", "NULLABLE"),
+        ("precipitation_total_7d", "FLOAT", "NULLABLE"),
+        ("snowfall_total_7d", "FLOAT", "NULLABLE"),
+        ("temperature_max_avg_7d", "FLOAT", "NULLABLE"),
+        ("temperature_min_min_3d", "FLOAT", "NULLABLE"),
+        ("windgust_max_3d", "FLOAT", "NULLABLE"),
+        ("freeze_thaw_days_7d", "INT64", "NULLABLE"),
+        ("wet_days_7d", "INT64", "NULLABLE"),
+        ("rain_total_lag_1d", "FLOAT", "NULLABLE"),
+        ("temperature_max_lag_1d", "FLOAT", "NULLABLE"),
+        ("temperature_min_lag_1d", "FLOAT", "NULLABLE"),
+        ("date", "DATE", "NULLABLE"),
+    ],
+}
+
+# Partitioning and clustering of the fact tables
+# Each fact table is partitioned by month on a DATE column derived from its YYYYMMDD date key, since BigQuery can
+# only partition on a DATE/TIMESTAMP column, and daily partitions of the full history would exceed 4,000 partitions
+# Clustering columns are the filters of the dashboard queries, the one filtered on most often first
+table_partitioning = {
+    "fact_incidents": {"column": "created_date", "date_key": "created_date_id", "granularity": "MONTH"},
+    "fact_weather": {"column": "date", "date_key": "date_id", "granularity": "MONTH"},
+    "fact_daily_summary": {"column": "date", "date_key": "date_id", "granularity": "MONTH"},
+    "fact_weather_features": {"column": "date", "date_key": "date_id", "granularity": "MONTH"},
+}
+table_clustering = {
+    "fact_incidents": ["borough_id", "complaint_type_id", "agency_id"],
+    "fact_weather": ["borough_id"],
+    "fact_daily_summary": ["borough_id"],
+    "fact_weather_features": ["borough_id"],
+}
+
+# Column types of each BigQuery type in Polars and DuckDB
+polars_types = {"INT64": pl.Int64, "FLOAT": pl.Float64, "STRING": pl.Utf8, "DATE": pl.Date}
+duckdb_types = {"INT64": "BIGINT", "FLOAT": "DOUBLE", "STRING": "VARCHAR", "DATE": "DATE"}
+
+
+
+# Function to get the key column of a table, the first column of its schema
+def key_column(table_name) -> str:
+    return warehouse_schema[table_name][0][0]
+
+
+
+
+# Function to get the expression of a partition DATE column from its YYYYMMDD date key
+def date_from_key(date_key) -> pl.Expr:
+    return pl.col(date_key).cast(pl.Utf8).str.strptime(pl.Date, "%Y%m%d", strict = False)
+
+
+
+
+# Function to shape a frame to the warehouse schema of a table: its columns in order, each cast to the column type
+# Partition dates are always derived from the date key, other columns the transformation does not produce are left
+# null, and columns the schema does not have are dropped
+def conform(df: pl.DataFrame, table_name) -> pl.DataFrame:
+    df = to_warehouse(df.select([name for name, _, _ in warehouse_schema[table_name] if name in df.columns]))
+    partitioning = table_partitioning.get(table_name)
+    columns = []
+    for name, field_type, _ in warehouse_schema[table_name]:
+        if partitioning and name == partitioning["column"]:
+            key = partitioning["date_key"]
+            columns.append((date_from_key(key) if key in df.columns else pl.lit(None).cast(pl.Date)).alias(name))
+        elif name not in df.columns:
+            columns.append(pl.lit(None).cast(polars_types[field_type]).alias(name))
+        elif df.schema[name] == pl.Duration and field_type == "STRING":
+            # Resolution intervals are whole days, as the dates they are computed from
+            columns.append((pl.col(name).dt.total_days().cast(pl.Utf8) + " days").alias(name))
+        else:
+            columns.append(pl.col(name).cast(polars_types[field_type], strict = False))
+    return df.select(columns)
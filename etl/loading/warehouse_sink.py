@@ -0,0 +1,192 @@
+# Sink interface shared by the warehouse backends, and the load loop every backend goes through
+# A sink only stores and reads rows; deduplication against earlier runs, reloading of changed facts and chunking
+# are done once in load_tables, so BigQuery, DuckDB and the Parquet lake end up with the same rows
+import os
+import numpy as np
+import polars as pl
+from pathlib import Path
+from logger.etl_logger import ETLLogger
+from logger.stage_metrics import stage
+from etl.loading.loaded_key_index import LoadedKeyIndex
+from etl.loading.rollups import RollupStore, rollup_source
+from etl.loading.warehouse_schema import conform, key_column
+from etl.compact_schema import shared_categories
+
+
+# Initializing logger
+load_logger = ETLLogger("load").get()
+
+# Settings for the key index of each sink, each warehouse keeps track of the facts it already holds
+project_root = Path(__file__).resolve().parents[2]
+key_index_folder = project_root / "metadata"
+
+# Warehouse the pipeline loads into unless told otherwise: bigquery, duckdb or lake
+default_warehouse = os.environ.get("ETL_WAREHOUSE", "bigquery")
+
+# Fact tables deduplicated across runs against the persistent key index, with their key column
+keyed_fact_tables = {"fact_incidents": "incident_id", "fact_weather_features": "feature_id"}
+
+# Column carrying the content hash of each fact row, used for change detection and never sent to the warehouse
+row_hash_col = "row_hash"
+
+# Rollups maintained on every load (etl/loading/rollups.py), turned off with ETL_ROLLUPS=0
+update_rollups = os.environ.get("ETL_ROLLUPS", "1") != "0"
+
+
+
+# Base class for a warehouse backend, tables follow etl.loading.warehouse_schema
+class WarehouseSink:
+    name = None
+    chunk_size = 1_000_000  # rows per append
+
+    def table_exists(self, table_name) -> bool:
+        raise NotImplementedError
+
+    # Function to read the keys already stored in a table, as a single-column frame
+    def existing_keys(self, table_name, key_col) -> pl.DataFrame:
+        raise NotImplementedError
+
+    def delete_keys(self, table_name, key_col, keys):
+        raise NotImplementedError
+
+    # Function to append rows already conformed to the warehouse schema of the table
+    def append(self, table_name, df: pl.DataFrame):
+        raise NotImplementedError
+
+    # Function to replace the whole content of a small derived table, such as a rollup
+    def replace_table(self, table_name, df: pl.DataFrame):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    # Each keyed table has its own index, fact_incidents keeping the file name it had before there were several
+    def key_index(self, table_name = "fact_incidents") -> LoadedKeyIndex:
+        if table_name == "fact_incidents":
+            return LoadedKeyIndex(key_index_folder / f"loaded_unique_keys_{self.name}.npy")
+        return LoadedKeyIndex(key_index_folder / f"loaded_keys_{table_name}_{self.name}.npy")
+
+    def rollup_store(self) -> RollupStore:
+        return RollupStore(key_index_folder / f"rollups_{self.name}")
+
+
+
+
+# Function to merge the facts a load stored into the sink's rollups, and to replace the rollup tables in the sink
+def refresh_rollups(facts: pl.DataFrame, sink: WarehouseSink):
+    store = sink.rollup_store()
+    missing = [name for name in store.columns if name not in facts.columns]
+    if missing:
+        load_logger.warning(f"Rollups not updated, {rollup_source} has no column {', '.join(missing)}")
+        return
+    with stage("update_rollups", rows_in = facts, sink = sink.name):
+        rollups = store.update(facts)
+        for table_name, df in rollups.items():
+            sink.replace_table(table_name, df)
+            load_logger.info(f"Replaced {table_name} ({df.height} rows) in {sink.name}")
+
+
+
+
+# Function to load the star schema tables into a sink
+# Facts loaded by a previous run are skipped unless their row hash changed, in which case the stored rows are
+# replaced; dimension rows whose key is already stored are skipped
+# The facts stored by the load are then merged into the rollups
+@shared_categories()
+def load_tables(df_dict, sink: WarehouseSink, chunk_size = None):
+    chunk_size = chunk_size or sink.chunk_size
+    key_indexes = {table_name: sink.key_index(table_name) for table_name in keyed_fact_tables}
+    loaded_facts = []
+    for table_name, df in df_dict.items():
+        if df is None or df.height == 0:
+            load_logger.info(f"No data for table {table_name}, skipping...")
+            continue
+        key_col = keyed_fact_tables.get(table_name)
+        key_index = key_indexes.get(table_name)
+        changed_keys = []
+        if key_col:
+            # Dropping facts already loaded by a previous run unless their row hash changed since
+            before = df.height
+            df, changed_keys = key_index.select_for_load(df, key_col, row_hash_col)
+            load_logger.info(
+                f"{before - df.height} unchanged rows skipped, {len(changed_keys)} changed rows reloaded for {table_name}"
+            )
+        load_logger.info(f"Starting load for table {table_name} ({df.height} rows) into {sink.name}")
+        table_exists = sink.table_exists(table_name)
+        if not table_exists:
+            load_logger.info(f"Table {table_name} does not exist. Will create new table automatically.")
+        if table_name.startswith("dim_") and table_exists:
+            # For dimension tables, remove duplicates based on primary key
+            pk_field = key_column(table_name)
+            existing_keys = sink.existing_keys(table_name, pk_field)
+            df = df.join(existing_keys.select(pl.col(pk_field).cast(df.schema[pk_field])), on=pk_field, how="anti")
+            load_logger.info(f"{df.height} new rows detected for {table_name}")
+
+        if df.height == 0:
+            load_logger.info(f"No new rows to load for {table_name}")
+            continue
+
+        # Rows of each chunk that replace a loaded row, deleted right before the chunk is appended so a failed load
+        # leaves at most one chunk of them missing, which the next run reloads since the key index still holds their
+        # old row hash
+        replaced = np.zeros(df.height, dtype = bool)
+        if table_exists and len(changed_keys) > 0:
+            replaced = np.isin(df[key_col].fill_null(-1).cast(pl.Int64).to_numpy(), changed_keys)
+
+        # Loading in chunks, each chunk shaped to the warehouse schema only right before sending
+        # The key index is rewritten once per table with the keys of every loaded chunk, also when a chunk fails,
+        # since rewriting it per chunk copies the whole index each time
+        loaded_rows = 0
+        try:
+            for start in range(0, df.height, chunk_size):
+                end = start + chunk_size
+                chunk_df = df.slice(start, chunk_size)
+
+                try:
+                    with stage("load_chunk", rows_in=chunk_df, table=table_name, offset=start, sink=sink.name):
+                        chunk_replaced = replaced[start:end]
+                        if chunk_replaced.any():
+                            sink.delete_keys(table_name, key_col, chunk_df.filter(pl.Series(chunk_replaced))[key_col].to_numpy())
+                        sink.append(table_name, conform(chunk_df, table_name))
+                    loaded_rows += chunk_df.height
+                    if table_name == rollup_source:
+                        loaded_facts.append(chunk_df)
+                    load_logger.info(
+                        f"Loaded rows {start} to {end} into {table_name}",
+                        extra={"stage": "load_chunk", "table": table_name, "offset": start, "rows": chunk_df.height}
+                    )
+                except Exception as e:
+                    # The load stops at the first failed chunk, the chunks before it are in the sink and in the key index
+                    load_logger.error(
+                        f"Error loading rows {start} to {end} into {table_name}: {e}",
+                        extra={"stage": "load_chunk", "table": table_name, "offset": start, "rows": chunk_df.height}
+                    )
+                    raise
+        finally:
+            if key_col and loaded_rows > 0:
+                loaded = df.slice(0, loaded_rows).drop_nulls(subset=[key_col])
+                key_index.add(
+                    loaded[key_col].to_numpy(),
+                    loaded[row_hash_col].to_numpy() if row_hash_col in loaded.columns else None
+                )
+
+        load_logger.info(f"Finished loading table {table_name}")
+
+    if update_rollups and loaded_facts:
+        refresh_rollups(pl.concat(loaded_facts, how="diagonal_relaxed"), sink)
+
+
+
+
+# Function to load the star schema tables into the warehouse chosen with ETL_WAREHOUSE (or the warehouse argument)
+def load_to_warehouse(df_dict, warehouse = default_warehouse):
+    if warehouse == "bigquery":
+        from etl.loading.load_to_bigquery import load_to_bigquery
+        return load_to_bigquery(df_dict)
+    if warehouse == "duckdb":
+        from etl.loading.load_to_duckdb import load_to_duckdb
+        return load_to_duckdb(df_dict)
+    if warehouse == "lake":
+        from etl.loading.load_to_lake import load_to_lake
+        return load_to_lake(df_dict)
+    raise ValueError(f"Unknown warehouse {warehouse}, expected bigquery, duckdb or lake")
@@ -0,0 +1,79 @@
+# Writer profile for the master and staging Parquet datasets, tuned so re-reads can skip most of the file
+import polars as pl
+import pyarrow.parquet as pq
+import os
+from pathlib import Path
+
+
+# Sort order of the written rows, so date and borough predicates prune whole row groups through their statistics
+sort_columns = ["created_date", "borough"]
+
+# Settings for the Parquet writer
+parquet_profile = {
+    "compression": "zstd",
+    "compression_level": 3,
+    "row_group_size": 131_072,   # Rows per row group, about 3 days of 311 data
+    "write_statistics": True,
+    "write_page_index": True,    # Page-level min/max so readers can also skip pages inside a row group
+}
+
+# Columns with a bloom filter, answering "does key X exist" without decoding the column
+bloom_filter_columns = {"unique_key": {"fpp": 0.01}}
+
+
+
+# Function to write a frame with the Parquet profile, atomically replacing the file at path
+def write_profiled_parquet(df: pl.DataFrame, path, profile = parquet_profile, sort = True):
+    path = Path(path)
+    sort_by = [col for col in sort_columns if col in df.columns] if sort else []
+    if sort_by:
+        df = df.sort(sort_by, nulls_last = True)
+    table = df.to_arrow()
+
+    options = dict(profile)
+    if sort_by:
+        options["sorting_columns"] = [
+            pq.SortingColumn(table.schema.get_field_index(col), nulls_first = False) for col in sort_by
+        ]
+    bloom_filters = {
+        col: {"ndv": min(df.height, options["row_group_size"]) or 1, **settings}
+        for col, settings in bloom_filter_columns.items() if col in df.columns
+    }
+
+    path.parent.mkdir(parents = True, exist_ok = True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    try:
+        pq.write_table(table, tmp_path, bloom_filter_options = bloom_filters, **options)
+    except TypeError:
+        # pyarrow releases without bloom filter support still get the sorted, zstd, statistics layout
+        pq.write_table(table, tmp_path, **options)
+    os.replace(tmp_path, path)
+
+
+
+
+# Function to lazily scan a profiled file, with predicates pushed down to the row group statistics
+def scan_profiled_parquet(path, start = None, end = None, borough = None) -> pl.LazyFrame:
+    lf = pl.scan_parquet(path)
+    if start is not None:
+        lf = lf.filter(pl.col("created_date") >= start)
+    if end is not None:
+        lf = lf.filter(pl.col("created_date") < end)
+    if borough is not None:
+        lf = lf.filter(pl.col("borough") == borough)
+    return lf
+
+
+
+
+# Function to check whether a unique_key exists in a profiled file
+# Queried with DuckDB, which checks the bloom filter of each row group before reading it; Polars and pyarrow.dataset
+# only prune with min/max statistics, which every row group's key range passes. The key is inlined as a literal,
+# since a bound parameter is not pushed down to the bloom filters
+def key_exists(path, key) -> bool:
+    import duckdb
+
+    with duckdb.connect() as connection:
+        return connection.execute(
+            f"SELECT count(*) > 0 FROM read_parquet(?) WHERE unique_key = {int(key)}", [str(path)]
+        ).fetchone()[0]
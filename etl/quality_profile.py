@@ -0,0 +1,485 @@
+# Data-quality profiles of the extracted 311 rows, built in one streaming pass over the downloaded chunks
+# A profile holds mergeable sketches, so the profiles of two batches combine into the profile of both without the
+# raw rows, and monthly profiles combine into yearly ones:
+#   null counts      per column
+#   HyperLogLog      distinct counts per column (registers merge by max)
+#   Misra-Gries      top values of the categorical columns (counters merge by sum, then shrink)
+#   DDSketch         quantiles of the resolution time, within a relative accuracy (buckets merge by sum)
+#   histogram        quantiles of the coordinates, within a fixed width in degrees (buckets merge by sum)
+# Profiles are stored per created month, and every run's batch is compared with the months before it for drift
+# alerts (null rates, new or unmapped values, distinct counts, quantile shifts), computed from the sketches alone
+import base64
+import fcntl
+import json
+import math
+import os
+import sys
+import numpy as np
+import polars as pl
+from contextlib import contextmanager
+from pathlib import Path
+from logger.etl_logger import ETLLogger
+from logger.stage_metrics import instrument_stage
+from etl.compact_schema import categorical_columns
+from etl.stable_hash import fnv_hashes
+
+
+# Settings for the profiles
+project_root = Path(__file__).resolve().parents[1]
+profile_folder = Path(os.environ.get("ETL_QUALITY_DIR", project_root / "metadata" / "quality"))
+mapping_folder = project_root / "mappings"
+quality_logger = ETLLogger("quality").get()
+
+# Settings for the sketches
+# Distinct counts hash the bytes of the values' text with the stable FNV-1a of etl/stable_hash.py, so profiles made
+# with any Polars version merge
+hll_precision = 12  # 4,096 registers, about 1.6% standard error
+hll_seed = 4401
+top_k_capacity = 256  # counters kept per column, a value's count is underestimated by at most rows / 257
+top_k_reported = 10
+relative_accuracy = 0.01  # of the resolution time quantiles
+coordinate_bin_width = 0.001  # degrees, about 100 m at NYC latitudes
+
+# Columns with a quantile sketch, as (kind, parameter)
+quantile_columns = {
+    "resolution_hours": ("relative", relative_accuracy),
+    "latitude": ("width", coordinate_bin_width),
+    "longitude": ("width", coordinate_bin_width),
+}
+
+# Raw timestamp format of the Socrata extraction
+timestamp_format = "%Y-%m-%dT%H:%M:%S%.f"
+
+# Columns checked against their mapping for unmapped values, as in transform_311
+mapped_columns = {
+    "complaint_type": "complaint_mapping",
+    "agency": "agency_mapping",
+    "city": "city_mapping",
+    "borough": "borough_mapping",
+    "location_type": "location_type_mapping",
+}
+
+# Settings for the drift alerts, checked only for batches and baselines large enough for shares to mean anything
+min_batch_rows = 1_000
+min_baseline_rows = 10_000
+null_rate_tolerance = 0.05  # absolute increase of a column's null rate
+new_value_share = 0.01  # share of the batch a value must reach to be reported as new
+spike_factor = 5.0  # growth of a value's share over the baseline reported as a spike
+distinct_growth = 0.25  # growth of a categorical column's distinct count over the whole baseline, above the long tail
+quantile_shift = 0.5  # move of the median or p95, in baseline interquartile ranges
+baseline_months = 3
+
+
+
+# HyperLogLog distinct counter over the 64-bit hashes of a column's values
+class HyperLogLog:
+    def __init__(self, precision = hll_precision, registers = None):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype = np.uint8) if registers is None else registers
+
+    # Function to add a series' non-null values
+    def update(self, series: pl.Series):
+        series = series.drop_nulls()
+        if series.len() == 0:
+            return
+        hashes = fnv_hashes(series, seed = hll_seed)
+        p = np.uint64(self.precision)
+        index = (hashes >> (np.uint64(64) - p)).astype(np.int64)
+        # A guard bit below the remaining bits bounds the rank at 64 - precision + 1
+        remaining = (hashes << p) | (np.uint64(1) << (p - np.uint64(1)))
+        np.maximum.at(self.registers, index, (leading_zeros(remaining) + 1).astype(np.uint8))
+
+    def merge(self, other):
+        return HyperLogLog(self.precision, np.maximum(self.registers, other.registers))
+
+    def count(self):
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros > 0:
+            estimate = m * math.log(m / zeros)  # linear counting for small cardinalities
+        return int(round(estimate))
+
+    def to_dict(self):
+        return {"precision": self.precision, "registers": base64.b64encode(self.registers.tobytes()).decode()}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["precision"], np.frombuffer(base64.b64decode(data["registers"]), dtype = np.uint8).copy())
+
+
+# Function to count the leading zero bits of non-zero 64-bit integers, by halving the width checked each step
+def leading_zeros(values: np.ndarray) -> np.ndarray:
+    count = np.zeros(len(values), dtype = np.int64)
+    for shift in [32, 16, 8, 4, 2, 1]:
+        empty = (values >> np.uint64(64 - shift)) == 0
+        count += np.where(empty, shift, 0)
+        values = np.where(empty, values << np.uint64(shift), values)
+    return count
+
+
+
+
+# Misra-Gries summary of a column's most frequent values, merged as in Agarwal et al., "Mergeable summaries"
+# Each kept count underestimates the value's true count by at most error
+class TopValues:
+    def __init__(self, capacity = top_k_capacity, counts = None, total = 0, error = 0):
+        self.capacity = capacity
+        self.counts = counts or {}
+        self.total = total
+        self.error = error
+
+    # Function to add a series' non-null values, counted exactly within the chunk
+    def update(self, series: pl.Series):
+        counts = series.drop_nulls().cast(pl.Utf8).value_counts(sort = False)
+        chunk = TopValues(self.capacity, dict(zip(counts.to_series(0).to_list(), counts.to_series(1).to_list())), counts.to_series(1).sum() or 0)
+        merged = self.merge(chunk)
+        self.counts, self.total, self.error = merged.counts, merged.total, merged.error
+
+    # Function to merge two summaries: counters are added, and when more than capacity remain, the (capacity + 1)th
+    # largest count is taken off every counter
+    def merge(self, other):
+        counts = dict(self.counts)
+        for value, count in other.counts.items():
+            counts[value] = counts.get(value, 0) + count
+        error = self.error + other.error
+        if len(counts) > self.capacity:
+            cut = sorted(counts.values(), reverse = True)[self.capacity]
+            counts = {value: count - cut for value, count in counts.items() if count > cut}
+            error += cut
+        return TopValues(self.capacity, counts, self.total + other.total, error)
+
+    # Function to get the largest values with their estimated count and share
+    def top(self, k = top_k_reported):
+        ranked = sorted(self.counts.items(), key = lambda item: (-item[1], item[0]))[:k]
+        return [{"value": value, "count": count, "share": count / self.total if self.total else 0.0} for value, count in ranked]
+
+    # Function to get an upper bound of a value's share, the bound a drop from the summary leaves
+    def max_share(self, value):
+        return (self.counts.get(value, 0) + self.error) / self.total if self.total else 0.0
+
+    def to_dict(self):
+        return {"capacity": self.capacity, "counts": self.counts, "total": self.total, "error": self.error}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["capacity"], data["counts"], data["total"], data["error"])
+
+
+
+
+# Quantile sketch counting values in buckets, which merge by adding their counts
+# A relative sketch (DDSketch) has logarithmic buckets, returning quantiles within the relative accuracy; a width
+# sketch has buckets of a fixed width, for values like coordinates whose spread is small next to their size
+class QuantileSketch:
+    def __init__(self, kind, parameter, buckets = None, count = 0, zeros = 0):
+        self.kind = kind
+        self.parameter = parameter
+        self.buckets = buckets or {}  # bucket key -> count, keys of negative values of a relative sketch start with "-"
+        self.count = count
+        self.zeros = zeros
+        self.gamma = (1 + parameter) / (1 - parameter) if kind == "relative" else None
+
+    # Function to add a series' finite values
+    def update(self, series: pl.Series):
+        values = series.drop_nulls().cast(pl.Float64).to_numpy()
+        values = values[np.isfinite(values)]
+        self.count += len(values)
+        if self.kind == "relative":
+            self.zeros += int(np.count_nonzero(values == 0))
+            values = values[values != 0]
+            # Negative values are counted apart, under their index times 2 plus 1 until the keys are named
+            indexes = np.ceil(np.log(np.abs(values)) / math.log(self.gamma)).astype(np.int64) * 2 + (values < 0)
+        else:
+            indexes = np.floor(values / self.parameter).astype(np.int64)
+        for index, count in zip(*np.unique(indexes, return_counts = True)):
+            key = str(index) if self.kind == "width" else f"{'-' if index % 2 else ''}{index // 2}"
+            self.buckets[key] = self.buckets.get(key, 0) + int(count)
+
+    def merge(self, other):
+        buckets = dict(self.buckets)
+        for key, count in other.buckets.items():
+            buckets[key] = buckets.get(key, 0) + count
+        return QuantileSketch(self.kind, self.parameter, buckets, self.count + other.count, self.zeros + other.zeros)
+
+    # Function to get the representative value of a bucket
+    def bucket_value(self, key):
+        if self.kind == "width":
+            return (int(key) + 0.5) * self.parameter
+        index = int(key.lstrip("-"))
+        value = 2 * self.gamma ** index / (self.gamma + 1)
+        return -value if key.startswith("-") else value
+
+    # Function to get a quantile, None for an empty sketch
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        entries = [(self.bucket_value(key), count) for key, count in self.buckets.items()] + [(0.0, self.zeros)]
+        entries.sort()
+        rank, seen = q * (self.count - 1), 0
+        for value, count in entries:
+            seen += count
+            if seen > rank:
+                return value
+        return entries[-1][0]
+
+    def to_dict(self):
+        return {"kind": self.kind, "parameter": self.parameter, "buckets": self.buckets, "count": self.count, "zeros": self.zeros}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["kind"], data["parameter"], data["buckets"], data["count"], data["zeros"])
+
+
+
+
+# Profile of a batch of 311 rows, updated chunk by chunk and merged with the profiles of other batches
+class QualityProfile:
+    def __init__(self):
+        self.rows = 0
+        self.nulls = {}
+        self.distinct = {}
+        self.top_values = {}
+        self.quantiles = {}
+
+    # Function to add a chunk of raw extracted rows
+    def update(self, chunk: pl.DataFrame):
+        self.rows += chunk.height
+        for name in chunk.columns:
+            self.nulls[name] = self.nulls.get(name, 0) + chunk[name].null_count()
+            self.distinct.setdefault(name, HyperLogLog()).update(chunk[name])
+            if name in categorical_columns:
+                self.top_values.setdefault(name, TopValues()).update(chunk[name])
+        for name, values in measures(chunk).items():
+            self.quantiles.setdefault(name, QuantileSketch(*quantile_columns[name])).update(values)
+
+    # Function to merge another profile into this one, returning this profile
+    def merge(self, other):
+        self.rows += other.rows
+        for name, count in other.nulls.items():
+            self.nulls[name] = self.nulls.get(name, 0) + count
+        for sketches, other_sketches in [
+            (self.distinct, other.distinct), (self.top_values, other.top_values), (self.quantiles, other.quantiles)
+        ]:
+            for name, sketch in other_sketches.items():
+                # Sketches taken from the other profile are copied, updates of this profile must not change them
+                sketches[name] = sketches[name].merge(sketch) if name in sketches else type(sketch).from_dict(sketch.to_dict())
+        return self
+
+    # Function to summarize the profile: null rates, distinct counts, top values and quantiles
+    def summary(self):
+        return {
+            "rows": self.rows,
+            "null_rates": {name: count / self.rows if self.rows else 0.0 for name, count in self.nulls.items()},
+            "distinct": {name: sketch.count() for name, sketch in self.distinct.items()},
+            "top_values": {name: sketch.top() for name, sketch in self.top_values.items()},
+            "quantiles": {
+                name: {f"p{round(q * 100)}": sketch.quantile(q) for q in [0.05, 0.25, 0.5, 0.75, 0.95]}
+                for name, sketch in self.quantiles.items()
+            },
+        }
+
+    def to_dict(self):
+        return {
+            "rows": self.rows,
+            "nulls": self.nulls,
+            "distinct": {name: sketch.to_dict() for name, sketch in self.distinct.items()},
+            "top_values": {name: sketch.to_dict() for name, sketch in self.top_values.items()},
+            "quantiles": {name: sketch.to_dict() for name, sketch in self.quantiles.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        profile = cls()
+        profile.rows = data["rows"]
+        profile.nulls = data["nulls"]
+        profile.distinct = {name: HyperLogLog.from_dict(sketch) for name, sketch in data["distinct"].items()}
+        profile.top_values = {name: TopValues.from_dict(sketch) for name, sketch in data["top_values"].items()}
+        profile.quantiles = {name: QuantileSketch.from_dict(sketch) for name, sketch in data["quantiles"].items()}
+        return profile
+
+
+# Function to get the measures with a quantile sketch from a chunk: resolution time in hours and coordinates
+def measures(chunk: pl.DataFrame) -> dict:
+    values = {name: chunk[name] for name in ["latitude", "longitude"] if name in chunk.columns}
+    if "created_date" in chunk.columns and "closed_date" in chunk.columns:
+        dates = chunk.select([as_datetime(chunk, name) for name in ["created_date", "closed_date"]])
+        # Durations are in microseconds
+        values["resolution_hours"] = (dates["closed_date"] - dates["created_date"]).cast(pl.Int64) / 3.6e9
+    return values
+
+
+# Function to read a timestamp column as a datetime, raw extracted columns hold Socrata timestamp strings
+def as_datetime(chunk: pl.DataFrame, name):
+    if chunk.schema[name] in (pl.Utf8, pl.Categorical):
+        return pl.col(name).cast(pl.Utf8).str.strptime(pl.Datetime("us"), timestamp_format, strict = False)
+    return pl.col(name).cast(pl.Datetime("us"))
+
+
+
+
+# Profiles of a batch split by created month, the unit the profiles are stored and compared in
+class MonthlyProfiles(dict):
+    def update(self, chunk: pl.DataFrame):
+        if chunk is None or chunk.height == 0:
+            return
+        month = pl.lit("unknown")
+        if "created_date" in chunk.columns:
+            month = as_datetime(chunk, "created_date").dt.strftime("%Y%m").fill_null("unknown")
+        chunk = chunk.with_columns(month.alias("profile_month"))
+        for part in chunk.partition_by("profile_month", maintain_order = False):
+            self.setdefault(part["profile_month"][0], QualityProfile()).update(part.drop("profile_month"))
+
+    @property
+    def rows(self):
+        return sum(profile.rows for profile in self.values())
+
+
+
+
+# Store of the monthly profiles, one JSON file per created month that every batch of the month is merged into
+class ProfileStore:
+    def __init__(self, folder = None):
+        self.folder = Path(folder or profile_folder)
+
+    def path(self, month):
+        return self.folder / f"month={month}.json"
+
+    def months(self):
+        return sorted(path.stem.split("=", 1)[1] for path in self.folder.glob("month=*.json"))
+
+    def read(self, month):
+        path = self.path(month)
+        if not path.exists():
+            return None
+        with open(path) as f:
+            return QualityProfile.from_dict(json.load(f))
+
+    # Context manager holding an exclusive lock on the store, so concurrent extractions merge one at a time
+    @contextmanager
+    def lock(self):
+        self.folder.mkdir(parents = True, exist_ok = True)
+        with open(self.folder / "profiles.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    # Function to merge the monthly profiles of a batch into the stored ones
+    def add(self, profiles: MonthlyProfiles):
+        with self.lock():
+            for month, profile in profiles.items():
+                stored = self.read(month)
+                merged = stored.merge(profile) if stored is not None else profile
+                tmp_path = self.path(month).with_name(self.path(month).name + ".tmp")
+                with open(tmp_path, "w") as f:
+                    json.dump(merged.to_dict(), f)
+                os.replace(tmp_path, self.path(month))
+
+    # Function to combine the stored profiles of some months, e.g. the twelve of a year, None without any
+    def combine(self, months):
+        combined = None
+        for month in months:
+            profile = self.read(month)
+            if profile is not None:
+                combined = profile if combined is None else combined.merge(profile)
+        return combined
+
+    # Function to combine the stored months before a month, the baseline its batches are compared with
+    def baseline(self, month, lookback = baseline_months):
+        return self.combine([stored for stored in self.months() if stored < month][-lookback:])
+
+
+
+
+# Function to read the mappings of the mapped columns, values are unmapped when neither a key nor a value
+def read_mapped_values(folder = None) -> dict:
+    folder = Path(folder or mapping_folder)
+    mapped = {}
+    for column, mapping_name in mapped_columns.items():
+        path = folder / f"{mapping_name}.json"
+        if path.exists():
+            with open(path) as f:
+                mapping = json.load(f)
+            mapped[column] = {normalize(value) for value in list(mapping) + list(mapping.values())}
+    return mapped
+
+
+# Function to normalize a value the way transform_311 cleans it before mapping
+def normalize(value) -> str:
+    return " ".join(str(value).split()).upper()
+
+
+
+
+# Function to compute the drift alerts of a batch against a baseline profile, from the sketches alone
+# mapped_values holds the known values of the mapped columns, so a new value can be reported as unmapped
+def drift_alerts(current: QualityProfile, baseline: QualityProfile, mapped_values = None) -> list:
+    if baseline is None or baseline.rows < min_baseline_rows or current.rows < min_batch_rows:
+        return []
+    mapped_values = mapped_values or {}
+    alerts = []
+
+    for name, nulls in current.nulls.items():
+        rate, baseline_rate = nulls / current.rows, baseline.nulls.get(name, 0) / baseline.rows
+        if rate - baseline_rate > null_rate_tolerance:
+            alerts.append({"kind": "null_rate", "column": name, "value": round(rate, 4), "baseline": round(baseline_rate, 4)})
+
+    for name, sketch in current.top_values.items():
+        baseline_sketch = baseline.top_values.get(name)
+        for entry in sketch.top(sketch.capacity):
+            if entry["share"] < new_value_share:
+                break
+            baseline_share = baseline_sketch.max_share(entry["value"]) if baseline_sketch else 0.0
+            if entry["share"] >= spike_factor * baseline_share:
+                unmapped = name in mapped_values and normalize(entry["value"]) not in mapped_values[name]
+                alerts.append({
+                    "kind": "unmapped_value" if unmapped else "new_value", "column": name, "value": entry["value"],
+                    "share": round(entry["share"], 4), "baseline": round(baseline_share, 4)
+                })
+
+        if name in baseline.distinct:
+            # The distinct values of the baseline and the batch together, against the baseline's own
+            distinct, baseline_distinct = baseline.distinct[name].merge(current.distinct[name]).count(), baseline.distinct[name].count()
+            if distinct > (1 + distinct_growth) * baseline_distinct:
+                alerts.append({"kind": "distinct_count", "column": name, "value": distinct, "baseline": baseline_distinct})
+
+    for name, sketch in current.quantiles.items():
+        baseline_sketch = baseline.quantiles.get(name)
+        if baseline_sketch is None or baseline_sketch.count == 0 or sketch.count == 0:
+            continue
+        spread = baseline_sketch.quantile(0.75) - baseline_sketch.quantile(0.25)
+        for q in [0.5, 0.95]:
+            value, baseline_value = sketch.quantile(q), baseline_sketch.quantile(q)
+            if abs(value - baseline_value) > quantile_shift * max(spread, sketch.parameter):
+                alerts.append({"kind": "quantile_shift", "column": name, "quantile": q, "value": value, "baseline": baseline_value})
+    return alerts
+
+
+
+
+# Function to store the monthly profiles of an extracted batch and log the drift alerts of each month
+# Returns the alerts, each labelled with its month
+@instrument_stage()
+def publish_profiles(profiles: MonthlyProfiles, store = None):
+    store = store or ProfileStore()
+    mapped_values = read_mapped_values()
+    alerts = []
+    for month, profile in sorted(profiles.items()):
+        for alert in drift_alerts(profile, store.baseline(month), mapped_values):
+            alerts.append({"month": month, **alert})
+            quality_logger.warning(f"Data quality drift in {month}: {alert}", extra = {"stage": "publish_profiles", "month": month, **alert})
+    store.add(profiles)
+    quality_logger.info(f"Profiled {profiles.rows} rows over {len(profiles)} months with {len(alerts)} drift alerts")
+    return alerts
+
+
+
+
+# Entry point printing the summary of the stored months starting with a prefix, e.g. 2025 for the year
+if __name__ == "__main__":
+    store = ProfileStore()
+    prefix = sys.argv[1] if len(sys.argv) > 1 else ""
+    profile = store.combine([month for month in store.months() if month.startswith(prefix)])
+    print(json.dumps(profile.summary() if profile else {}, indent = 2, default = str))
@@ -0,0 +1,78 @@
+# Stable 64-bit hashes of values and rows, for hashes that are stored and compared across runs
+# The Polars hash functions are only stable within one Polars version, so the row hashes kept in the master dataset,
+# the key index and the warehouse, and the distinct-count sketches of the quality profiles, hash the bytes of the
+# values' text with FNV-1a instead, vectorized over the values and finished with the SplitMix64 mixer
+import numpy as np
+import polars as pl
+
+
+# Text standing in for a null and separating the columns of a row, neither occurs in the data
+null_marker = "\x00"
+column_separator = "\x1f"
+
+# FNV-1a 64-bit parameters
+fnv_offset = np.uint64(0xcbf29ce484222325)
+fnv_prime = np.uint64(0x100000001b3)
+
+
+
+# Function to hash each value of a series to a stable 64-bit integer, nulls included
+# Values are hashed by their text, so a categorical column hashes the same as the strings it was built from
+# A column of repeated values (a borough, a status) has each distinct value hashed once and looked up
+def hash_values(series: pl.Series, seed = 0) -> pl.Series:
+    if series.len() == 0:
+        return pl.Series(series.name, [], dtype = pl.UInt64)
+    values = series.cast(pl.Utf8).fill_null(null_marker)
+    distinct = values.unique()
+    if 2 * distinct.len() > values.len():
+        return pl.Series(series.name, fnv_hashes(values, seed), dtype = pl.UInt64)
+    hashes = pl.Series(fnv_hashes(distinct, seed), dtype = pl.UInt64)
+    return values.replace_strict(distinct, hashes, return_dtype = pl.UInt64).alias(series.name)
+
+
+# Expression of the canonical text of a row over some columns, each value as text and nulls marked
+def row_text(columns) -> pl.Expr:
+    return pl.concat_str([pl.col(col).cast(pl.Utf8).fill_null(null_marker) for col in columns], separator = column_separator)
+
+
+# Function to hash the values of some columns of each row to a stable 64-bit integer
+def hash_rows(df: pl.DataFrame, columns, seed = 0) -> pl.Series:
+    return hash_values(df.select(row_text(columns)).to_series(), seed)
+
+
+
+
+# Function to finish 64-bit hashes with the SplitMix64 mixer, so every output bit depends on every input bit
+def mix64(hashes: np.ndarray) -> np.ndarray:
+    with np.errstate(over = "ignore"):
+        hashes = (hashes ^ (hashes >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+        hashes = (hashes ^ (hashes >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return hashes ^ (hashes >> np.uint64(31))
+
+
+# Function to hash the text of each value of a series with FNV-1a, as a numpy array of stable 64-bit hashes
+# Values are processed byte position by byte position, longest first, so each step is one operation over all the
+# values still that long
+def fnv_hashes(series: pl.Series, seed = 0) -> np.ndarray:
+    import pyarrow as pa
+
+    values = series.cast(pl.Utf8).fill_null(null_marker).to_arrow()
+    values = values.combine_chunks() if isinstance(values, pa.ChunkedArray) else values
+    values = values.cast(pa.large_string())
+    _, offsets, data = values.buffers()
+    offsets = np.frombuffer(offsets, dtype = np.int64)[values.offset:values.offset + len(values) + 1]
+    data = np.frombuffer(data, dtype = np.uint8) if data is not None else np.empty(0, dtype = np.uint8)
+
+    lengths = np.diff(offsets)
+    order = np.argsort(-lengths, kind = "stable")
+    starts, lengths = offsets[:-1][order], lengths[order]
+    hashes = np.full(len(order), fnv_offset ^ mix64(np.uint64(seed)), dtype = np.uint64)
+    with np.errstate(over = "ignore"):
+        for position in range(int(lengths[0]) if len(lengths) else 0):
+            active = int(np.searchsorted(-lengths, -position, side = "left"))
+            hashes[:active] ^= data[starts[:active] + position]
+            hashes[:active] *= fnv_prime
+    hashes = mix64(hashes)
+    result = np.empty_like(hashes)
+    result[order] = hashes
+    return result
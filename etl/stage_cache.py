@@ -0,0 +1,225 @@
+# Content-addressed cache of stage outputs, so a stage called again on identical inputs returns its stored result
+# The key of a call hashes the stage name, every argument (frames by content, files by their bytes), the mapping
+# bundle (every file under mappings/, hashed again only when one changed) and the code version (every source file of
+# the etl package and the Polars version). Retries, manual re-runs and overlapping catch-up runs of an unchanged month therefore skip the work,
+# while any change to the data, the mappings or the code is a miss
+# Outputs (a frame or a dict of frames) are stored as Parquet under <cache folder>/<stage>/<key>/, and the least
+# recently used entries are evicted once the cache grows over its size limit
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+import polars as pl
+from functools import lru_cache, wraps
+from pathlib import Path
+from logger.etl_logger import ETLLogger
+
+
+# Settings for the cache, disabled with ETL_STAGE_CACHE=0
+project_root = Path(__file__).resolve().parents[1]
+cache_enabled = os.environ.get("ETL_STAGE_CACHE", "1") != "0"
+cache_folder = Path(os.environ.get("ETL_STAGE_CACHE_DIR", project_root / "cache" / "stages"))
+max_cache_bytes = int(os.environ.get("ETL_STAGE_CACHE_MAX_BYTES", 5 * 1024 ** 3))
+mapping_folder = project_root / "mappings"
+code_folder = project_root / "etl"
+
+cache_logger = ETLLogger("stage_cache").get()
+
+# Name of the file describing an entry, its modification time is the entry's last use
+manifest_name = "manifest.json"
+
+
+
+# Function to hash a file by its bytes
+def file_digest(path) -> str:
+    digest = hashlib.blake2b(digest_size = 16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Function to hash every file under a folder, with their relative paths so renames change the hash
+def folder_digest(folder, pattern = "*") -> str:
+    digest = hashlib.blake2b(digest_size = 16)
+    for path in sorted(Path(folder).rglob(pattern)):
+        if path.is_file():
+            digest.update(str(path.relative_to(folder)).encode())
+            digest.update(file_digest(path).encode())
+    return digest.hexdigest()
+
+
+# Function to list every file under a folder with its modification time and size, a cheap signature of its content
+def folder_stats(folder) -> tuple:
+    stats = []
+    for path in sorted(Path(folder).rglob("*")):
+        if path.is_file():
+            stat = path.stat()
+            stats.append((str(path.relative_to(folder)), stat.st_mtime_ns, stat.st_size))
+    return tuple(stats)
+
+
+# Function to hash a folder once per signature of its files, so unchanged files are not read again
+@lru_cache(maxsize = 8)
+def signed_folder_digest(folder, stats) -> str:
+    return folder_digest(folder)
+
+
+# Function to hash the mapping bundle, boundary files included since they change the imputed values
+# Mappings can be edited between runs, so the files are listed on every call and only hashed again when one changed
+def mapping_bundle_digest(folder = None) -> str:
+    folder = Path(folder or mapping_folder)
+    return signed_folder_digest(folder, folder_stats(folder)) if folder.exists() else "no-mappings"
+
+
+# Function to hash the code version, the source files cannot change within a process
+@lru_cache(maxsize = None)
+def code_version() -> str:
+    return f"{folder_digest(code_folder, '*.py')}-polars-{pl.__version__}"
+
+
+# Function to hash a frame by its schema and content, categoricals by their values rather than their physical codes
+# Row order is left out: the deduplication and unique steps of the stages do not keep it, so the same rows come
+# out of transform_311 in a different order on every run, and transform_combined must still hit on them
+def frame_digest(df: pl.DataFrame) -> str:
+    digest = hashlib.blake2b(digest_size = 16)
+    digest.update(str(df.schema).encode())
+    digest.update(str(df.height).encode())
+    if df.width > 0 and df.height > 0:
+        hashed = df.with_columns(pl.col(pl.Categorical).cast(pl.Utf8)).hash_rows(seed = 0)
+        digest.update(hashed.sort().to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+# Function to hash a value nested in a list or dict argument, raising for values the cache cannot key on
+def nested_digest(value):
+    digest = argument_digest(value)
+    if digest is None:
+        raise TypeError(f"Cannot hash {type(value).__name__}")
+    return digest
+
+
+# Function to hash a stage argument, returning None for arguments the cache cannot key on
+def argument_digest(value):
+    if isinstance(value, pl.DataFrame):
+        return frame_digest(value)
+    if isinstance(value, Path) or (isinstance(value, str) and len(value) < 4096 and os.path.isfile(value)):
+        return f"file:{file_digest(value)}"
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return repr(value)
+    if isinstance(value, (list, tuple, dict)):
+        try:
+            return hashlib.blake2b(json.dumps(value, sort_keys = True, default = nested_digest).encode(), digest_size = 16).hexdigest()
+        except (TypeError, ValueError):
+            return None
+    return None
+
+
+
+
+# Function to build the cache key of a stage call, None when an argument cannot be hashed
+def cache_key(stage_name, args, kwargs):
+    parts = [stage_name, code_version(), mapping_bundle_digest()]
+    for value in list(args) + [kwargs[name] for name in sorted(kwargs)]:
+        digest = argument_digest(value)
+        if digest is None:
+            return None
+        parts.append(digest)
+    parts += sorted(kwargs)
+    return hashlib.blake2b("|".join(parts).encode(), digest_size = 16).hexdigest()
+
+
+# Function to read a cached output, None on a miss or an entry evicted while being read
+def read_entry(entry):
+    manifest_path = entry / manifest_name
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        frames = {name: pl.read_parquet(entry / f"{index}.parquet") for index, name in enumerate(manifest["frames"])}
+        os.utime(manifest_path)  # marks the entry as recently used
+    except Exception:
+        return None
+    return frames[None] if manifest["kind"] == "frame" else frames
+
+
+# Function to store an output, written to a temporary folder that is renamed into place
+# Outputs other than a frame or a dict of frames are not cached
+def write_entry(entry, output):
+    if isinstance(output, pl.DataFrame):
+        kind, frames = "frame", {None: output}
+    elif isinstance(output, dict) and output and all(isinstance(df, pl.DataFrame) for df in output.values()):
+        kind, frames = "dict", output
+    else:
+        return False
+
+    tmp_entry = entry.with_name(f"{entry.name}.{uuid.uuid4().hex}.tmp")
+    tmp_entry.mkdir(parents = True)
+    size = 0
+    for index, df in enumerate(frames.values()):
+        path = tmp_entry / f"{index}.parquet"
+        df.write_parquet(path, compression = "lz4")
+        size += path.stat().st_size
+    with open(tmp_entry / manifest_name, "w") as f:
+        json.dump({"kind": kind, "frames": list(frames), "bytes": size, "created": time.time()}, f)
+    try:
+        os.replace(tmp_entry, entry)
+    except OSError:
+        # Another process stored the same entry first
+        shutil.rmtree(tmp_entry, ignore_errors = True)
+    return True
+
+
+# Function to evict the least recently used entries until the cache fits in its size limit
+def evict(folder = None, max_bytes = None):
+    folder = Path(folder or cache_folder)
+    max_bytes = max_cache_bytes if max_bytes is None else max_bytes
+    entries = []
+    for manifest_path in folder.glob(f"*/*/{manifest_name}"):
+        try:
+            with open(manifest_path) as f:
+                entries.append((manifest_path.stat().st_mtime, json.load(f)["bytes"], manifest_path.parent))
+        except (OSError, ValueError, KeyError):
+            continue
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry, ignore_errors = True)
+        total -= size
+        cache_logger.info(f"Evicted {entry.parent.name}/{entry.name} ({size / 1e6:.1f} MB) from the stage cache")
+    return total
+
+
+
+
+# Decorator caching a stage's output by the content of its inputs, the mapping bundle and the code version
+# Calls with an argument the cache cannot hash simply run the stage
+def memoize_stage(stage_name = None):
+    def decorator(fn):
+        name = stage_name or fn.__name__
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not cache_enabled:
+                return fn(*args, **kwargs)
+            key = cache_key(name, args, kwargs)
+            if key is None:
+                cache_logger.info(f"Stage {name} called with arguments the cache cannot hash, running it uncached")
+                return fn(*args, **kwargs)
+
+            entry = cache_folder / name / key
+            if entry.exists():
+                output = read_entry(entry)
+                if output is not None:
+                    cache_logger.info(f"Stage cache hit for {name} ({key})", extra = {"stage": name, "cache_key": key})
+                    return output
+
+            output = fn(*args, **kwargs)
+            if write_entry(entry, output):
+                cache_logger.info(f"Stage cache stored {name} ({key})", extra = {"stage": name, "cache_key": key})
+                evict()
+            return output
+        return wrapper
+    return decorator
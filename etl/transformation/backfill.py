@@ -0,0 +1,135 @@
+# Parallel backfill of the master 311 dataset, partitioned by the month of created_date
+# A pool of worker processes runs transform_311 and the per-row preparation of transform_combined on one month each,
+# reading its partition from Parquet and writing the prepared rows back to Parquet
+# Only the dimension key assignment and the daily summary are built centrally, from the prepared partitions
+import polars as pl
+import multiprocessing
+import os
+import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from logger.etl_logger import ETLLogger
+from logger.stage_metrics import instrument_stage
+from etl.parquet_layout import write_profiled_parquet, scan_profiled_parquet
+from etl.transformation.transform_311 import transform_311, dedupe, get_mappings
+from etl.transformation.transform_combined import prepare_weather, prepare_cases, build_star_schema
+from etl.transformation.weather_cube import update_weather_cube
+from etl.transformation.weather_features import add_weather_features
+from etl.compact_schema import shared_categories
+
+
+# Logger settings
+backfill_logger = ETLLogger("backfill").get()
+
+# Settings for file path locations
+project_root = Path(__file__).resolve().parents[2]
+main_parquet = project_root / "data" / "nyc_311_full_preprocessed.parquet"
+weather_parquet = project_root / "data" / "nyc_open_meteo_full_weather.parquet"
+backfill_folder = project_root / "data" / "backfill"
+
+# Settings for the worker pool, one process per core unless ETL_BACKFILL_WORKERS is set
+max_workers = int(os.environ.get("ETL_BACKFILL_WORKERS", 0)) or os.cpu_count() or 1
+
+
+
+# Function to list the months present in the master dataset, as "YYYY-MM" strings
+def month_partitions(cases_path) -> list:
+    months = pl.scan_parquet(cases_path).select(
+        pl.col("created_date").str.slice(0, 7).unique().alias("month")
+    ).collect()["month"].drop_nulls()
+    return sorted(months.to_list())
+
+
+
+
+# Function to get the first day of the month after a "YYYY-MM" month, the exclusive end of its partition
+def next_month(month) -> str:
+    year, month_number = int(month[:4]), int(month[5:7])
+    return f"{year + month_number // 12:04d}-{month_number % 12 + 1:02d}"
+
+
+
+
+# Worker function: transform one month of incidents and write the prepared rows to output_dir
+# Returns the written file and its row count, None when nothing in the month survives the transformation
+@instrument_stage(labels = ["month"])
+@shared_categories()
+def transform_month(month, cases_path, grid_path, mappings, output_dir):
+    cases = scan_profiled_parquet(cases_path, start = month, end = next_month(month)).collect()
+    if cases.height == 0:
+        return None, 0
+    cases = prepare_cases(transform_311(cases, mappings), pl.read_parquet(grid_path))
+    if cases.height == 0:
+        return None, 0
+
+    path = Path(output_dir) / f"{month}.parquet"
+    write_profiled_parquet(cases, path)
+    return path, cases.height
+
+
+
+
+# Main function for the backfill, returning the same tables as transform_combined
+@instrument_stage()
+@shared_categories()
+def backfill(cases_path = main_parquet, weather_path = weather_parquet, mappings = None, workers = max_workers,
+             output_dir = backfill_folder):
+    mappings = get_mappings() if mappings is None else mappings
+    months = month_partitions(cases_path)
+    backfill_logger.info(f"Starting backfill of {len(months)} months with {workers} worker processes")
+
+    # The weather is prepared once, the workers only need its grid points to assign the nearest one
+    output_dir = Path(output_dir)
+    shutil.rmtree(output_dir, ignore_errors = True)
+    output_dir.mkdir(parents = True, exist_ok = True)
+    weather = prepare_weather(pl.read_parquet(weather_path))
+    grid_path = output_dir / "weather_grid.parquet"
+    weather.select(["grid_id", "latitude", "longitude"]).unique(subset = "grid_id").write_parquet(grid_path)
+
+    # Workers are spawned rather than forked, since forking a process with a running Polars thread pool can deadlock
+    # Each worker also gets an equal share of the cores for its own Polars threads
+    previous_threads = os.environ.get("POLARS_MAX_THREADS")
+    os.environ["POLARS_MAX_THREADS"] = str(max(1, (os.cpu_count() or 1) // workers))
+    paths, failed = [], []
+    try:
+        with ProcessPoolExecutor(max_workers = workers, mp_context = multiprocessing.get_context("spawn")) as executor:
+            futures = {
+                executor.submit(transform_month, month, cases_path, grid_path, mappings, output_dir): month
+                for month in months
+            }
+            for future in as_completed(futures):
+                month = futures[future]
+                try:
+                    path, rows = future.result()
+                except Exception as e:
+                    backfill_logger.error(f"Backfill of {month} failed: {e}")
+                    failed.append(month)
+                    continue
+                if path is not None:
+                    paths.append(path)
+                backfill_logger.info(f"Backfilled {month}: {rows} rows")
+    finally:
+        if previous_threads is None:
+            os.environ.pop("POLARS_MAX_THREADS", None)
+        else:
+            os.environ["POLARS_MAX_THREADS"] = previous_threads
+
+    if failed:
+        raise RuntimeError(f"Backfill failed for months {sorted(failed)}, completed months are in {output_dir}")
+    if not paths:
+        backfill_logger.info("No rows to backfill.")
+        return None
+
+    # Each month is already deduplicated, only keys seen in more than one month still need it
+    cases = dedupe(pl.concat([pl.read_parquet(path) for path in sorted(paths)], how = "vertical_relaxed", rechunk = True))
+    tables = update_weather_cube(add_weather_features(build_star_schema(cases, weather)))
+    backfill_logger.info(f"Backfill complete: {cases.height} incidents")
+    return tables
+
+
+
+
+# Entry point for the backfill, optionally with the number of worker processes
+if __name__ == "__main__":
+    tables = backfill(workers = int(sys.argv[1]) if len(sys.argv) > 1 else max_workers)
@@ -0,0 +1,81 @@
+# Functions for generating and caching the calendar dimension
+import polars as pl
+from datetime import date, timedelta
+from pathlib import Path
+from logger.etl_logger import ETLLogger
+
+
+# Settings for logging the calendar dimension
+dim_date_logger = ETLLogger("dim_date").get()
+
+# Settings for file path locations
+project_root = Path(__file__).resolve().parents[2]
+dim_date_parquet = project_root / "data" / "dim_date.parquet"
+
+# Earliest date of the historical weather backfill, used as the default start of the calendar
+default_start_date = date(2010, 1, 1)
+
+
+
+# Function to compute the deterministic YYYYMMDD date_id from a date column
+def date_id_expr(col) -> pl.Expr:
+    expr = pl.col(col) if isinstance(col, str) else col
+    return (
+        expr.dt.year().cast(pl.Int64) * 10_000
+        + expr.dt.month().cast(pl.Int64) * 100
+        + expr.dt.day().cast(pl.Int64)
+    )
+
+
+
+
+# Function to generate the calendar rows for every day between start and end (inclusive)
+def build_dim_date(start: date, end: date) -> pl.DataFrame:
+    dim_date = pl.DataFrame({
+        "date": pl.date_range(start, end, interval = "1d", eager = True)
+    })
+    dim_date = dim_date.with_columns([
+        date_id_expr("date").alias("date_id"),
+        pl.col("date").dt.day().cast(pl.Int64).alias("day"),
+        pl.col("date").dt.month().cast(pl.Int64).alias("month"),
+        pl.col("date").dt.year().cast(pl.Int64).alias("year"),
+        pl.col("date").dt.weekday().cast(pl.Int64).alias("weekday"),
+        pl.col("date").dt.strftime("%A").alias("weekday_name")
+    ])
+    return dim_date.select(["date_id", "date", "day", "month", "year", "weekday", "weekday_name"])
+
+
+
+
+# Function to return the cached calendar, extending it on disk only when new dates fall outside of it
+def get_dim_date(min_date: date = None, max_date: date = None, cache_path: Path = dim_date_parquet) -> pl.DataFrame:
+    min_date = min_date or default_start_date
+    max_date = max_date or min_date
+
+    if cache_path.exists():
+        dim_date = pl.read_parquet(cache_path)
+        cached_start = dim_date["date"].min()
+        cached_end = dim_date["date"].max()
+    else:
+        dim_date = None
+        cached_start = cached_end = None
+
+    # Generating only the missing days before and after the cached range
+    extensions = []
+    if cached_start is None:
+        extensions.append(build_dim_date(min(min_date, default_start_date), max_date))
+    else:
+        if min_date < cached_start:
+            extensions.append(build_dim_date(min_date, cached_start - timedelta(days = 1)))
+        if max_date > cached_end:
+            extensions.append(build_dim_date(cached_end + timedelta(days = 1), max_date))
+
+    if extensions:
+        dim_date = pl.concat(([dim_date] if dim_date is not None else []) + extensions).sort("date")
+        cache_path.parent.mkdir(parents = True, exist_ok = True)
+        dim_date.write_parquet(cache_path)
+        dim_date_logger.info(
+            f"Calendar dimension extended to {dim_date['date'].min()} - {dim_date['date'].max()} ({dim_date.height} days)"
+        )
+
+    return dim_date
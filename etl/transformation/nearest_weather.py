@@ -0,0 +1,52 @@
+# Functions for assigning each incident to its nearest weather grid point with a KD-tree
+import numpy as np
+import polars as pl
+
+
+# Kilometres per degree of latitude, and the reference latitude used to scale longitude over NYC
+km_per_degree = 111.32
+reference_latitude = 40.7
+
+
+
+# Function to project lat/lon arrays onto a local plane in km, so euclidean distance approximates ground distance
+def project_points(lat, lon) -> np.ndarray:
+    lat = np.asarray(lat, dtype = np.float64)
+    lon = np.asarray(lon, dtype = np.float64)
+    return np.column_stack([
+        lon * km_per_degree * np.cos(np.radians(reference_latitude)),
+        lat * km_per_degree
+    ])
+
+
+
+
+# Class wrapping a KD-tree built once over the weather grid points
+class WeatherGridIndex:
+    def __init__(self, grid: pl.DataFrame, id_col = "grid_id"):
+        from scipy.spatial import cKDTree  # Deferred, scipy.spatial takes about half a second to import
+        grid = grid.select([id_col, "latitude", "longitude"]).unique(subset = id_col).sort(id_col)
+        self.grid_ids = grid[id_col].to_numpy()
+        self.tree = cKDTree(project_points(grid["latitude"].to_numpy(), grid["longitude"].to_numpy()))
+
+    # Vectorized nearest-neighbour query, returning the grid id and distance in km for each point
+    # Points with a missing coordinate get an id of -1
+    def query(self, lat, lon):
+        points = project_points(lat, lon)
+        valid = np.isfinite(points).all(axis = 1)
+        ids = np.full(len(points), -1, dtype = np.int64)
+        distances = np.full(len(points), np.nan)
+        if valid.any():
+            distances[valid], positions = self.tree.query(points[valid], k = 1, workers = -1)
+            ids[valid] = self.grid_ids[positions]
+        return ids, distances
+
+    # Function to add the nearest grid id of each row as a new column
+    def assign(self, df: pl.DataFrame, alias = "weather_grid_id") -> pl.DataFrame:
+        ids, _ = self.query(
+            df["latitude"].cast(pl.Float64).fill_null(np.nan).to_numpy(),
+            df["longitude"].cast(pl.Float64).fill_null(np.nan).to_numpy()
+        )
+        return df.with_columns(pl.Series(alias, ids)).with_columns(
+            pl.when(pl.col(alias) >= 0).then(pl.col(alias)).alias(alias)
+        )
@@ -0,0 +1,234 @@
+# Functions for imputing missing boroughs and ZIP code areas from latitude/longitude with a point-in-polygon grid index
+import numpy as np
+import polars as pl
+import json
+import os
+import pickle
+from pathlib import Path
+from logger.etl_logger import ETLLogger
+from logger.stage_metrics import instrument_stage
+
+
+# Settings for logging the spatial imputation
+spatial_logger = ETLLogger("spatial_imputation").get()
+
+# Settings for file path locations, boundary GeoJSON files are kept next to the mappings
+# They are downloaded from NYC Open Data with python -m scripts.fetch_boundaries, and a layer whose file is missing
+# is skipped with a warning, leaving its values missing
+project_root = Path(__file__).resolve().parents[2]
+boundary_dir = Path(os.environ.get("ETL_BOUNDARY_DIR", project_root / "mappings" / "boundaries"))
+index_cache_dir = Path(os.environ.get("ETL_SPATIAL_INDEX_DIR", project_root / "data" / "spatial_index"))
+
+# Boundary layers used for imputation: GeoJSON file, the feature property holding the value, the column whose
+# missing values the layer stands in for and the column the values are written to
+# MODZCTAs (modified ZIP code tabulation areas) merge the ZIP codes of single buildings and PO boxes into the area
+# around them, so the MODZCTA of a point is not always its USPS ZIP code. It goes to incident_modzcta, and
+# incident_zip keeps the ZIP code as reported
+boundary_layers = {
+    "borough": {"file": "boroughs.geojson", "property": "boro_name", "missing": "borough", "column": "borough"},
+    "modzcta": {"file": "modzcta.geojson", "property": "modzcta", "missing": "incident_zip", "column": "incident_modzcta"},
+}
+
+# Grid cell size in degrees, roughly 500m over NYC
+default_cell_size = 0.005
+
+# Placeholder values treated as a missing borough
+missing_boroughs = ["unspecified", "missing"]
+
+# Loaded indexes by boundary file, built or read from the cache on first use, None for a missing file
+_indexes = {}
+
+
+
+# Function to read the polygons of a GeoJSON file as (value, [rings of lon/lat vertices]) pairs
+def load_polygons(path, value_property):
+    with open(path) as f:
+        features = json.load(f)["features"]
+    polygons = []
+    for feature in features:
+        geometry = feature["geometry"]
+        parts = geometry["coordinates"] if geometry["type"] == "MultiPolygon" else [geometry["coordinates"]]
+        rings = [np.asarray(ring, dtype = np.float64)[:, :2] for part in parts for ring in part]
+        polygons.append((str(feature["properties"][value_property]), rings))
+    return polygons
+
+
+
+
+# Function for a vectorized even-odd ray casting test of many points against one polygon
+# Holes and multipolygon parts are handled by toggling across every ring
+def points_in_polygon(x, y, rings, batch_size = 4096):
+    inside = np.zeros(len(x), dtype = bool)
+    for ring in rings:
+        x1, y1 = ring[:, 0], ring[:, 1]
+        x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+        spans = (y1 != y2)
+        x1, y1, x2, y2 = x1[spans], y1[spans], x2[spans], y2[spans]
+        for start in range(0, len(x), batch_size):
+            px = x[start:start + batch_size, None]
+            py = y[start:start + batch_size, None]
+            crosses = ((y1 > py) != (y2 > py)) & (px < (x2 - x1) * (py - y1) / (y2 - y1) + x1)
+            inside[start:start + batch_size] ^= (crosses.sum(axis = 1) % 2).astype(bool)
+    return inside
+
+
+
+
+# Class for a uniform grid over the polygons' extent
+# Cells crossed by no polygon edge are resolved once at build time, so points falling in them skip the polygon test
+class PolygonGridIndex:
+    def __init__(self, polygons, cell_size = default_cell_size):
+        self.values = np.array([value for value, _ in polygons], dtype = object)
+        self.rings = [rings for _, rings in polygons]
+        self.cell_size = cell_size
+        self.bboxes = np.array([
+            [min(r[:, 0].min() for r in rings), min(r[:, 1].min() for r in rings),
+             max(r[:, 0].max() for r in rings), max(r[:, 1].max() for r in rings)]
+            for rings in self.rings
+        ])
+        self.min_x, self.min_y = self.bboxes[:, 0].min(), self.bboxes[:, 1].min()
+        self.n_cols = int(np.ceil((self.bboxes[:, 2].max() - self.min_x) / cell_size)) + 1
+        self.n_rows = int(np.ceil((self.bboxes[:, 3].max() - self.min_y) / cell_size)) + 1
+        self.cell_owner = self._build_cells()
+
+    def _cells(self, x, y):
+        col = np.floor((x - self.min_x) / self.cell_size).astype(np.int64)
+        row = np.floor((y - self.min_y) / self.cell_size).astype(np.int64)
+        return row, col
+
+    # Function to mark boundary cells (-2), then resolve every other cell to its polygon (or -1 for none)
+    def _build_cells(self):
+        boundary = np.zeros((self.n_rows, self.n_cols), dtype = bool)
+        for rings in self.rings:
+            for ring in rings:
+                x1, y1 = ring[:, 0], ring[:, 1]
+                x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+                row0, col0 = self._cells(np.minimum(x1, x2), np.minimum(y1, y2))
+                row1, col1 = self._cells(np.maximum(x1, x2), np.maximum(y1, y2))
+                # Edges spanning at most one cell boundary are marked in bulk, longer edges one by one
+                short = ((row1 - row0) <= 1) & ((col1 - col0) <= 1)
+                for rows, cols in [(row0, col0), (row0, col1), (row1, col0), (row1, col1)]:
+                    boundary[rows[short], cols[short]] = True
+                for r0, r1, c0, c1 in zip(row0[~short], row1[~short], col0[~short], col1[~short]):
+                    boundary[r0:r1 + 1, c0:c1 + 1] = True
+
+        owner = np.where(boundary, -2, -1).astype(np.int32).ravel()
+        rows, cols = np.divmod(np.flatnonzero(~boundary.ravel()), self.n_cols)
+        centers_x = self.min_x + (cols + 0.5) * self.cell_size
+        centers_y = self.min_y + (rows + 0.5) * self.cell_size
+        resolved = np.full(len(rows), -1, dtype = np.int32)
+        for i, rings in enumerate(self.rings):
+            candidates = np.flatnonzero(self._in_bbox(centers_x, centers_y, i) & (resolved == -1))
+            hit = points_in_polygon(centers_x[candidates], centers_y[candidates], rings)
+            resolved[candidates[hit]] = i
+        owner[rows * self.n_cols + cols] = resolved
+        return owner
+
+    def _in_bbox(self, x, y, i):
+        min_x, min_y, max_x, max_y = self.bboxes[i]
+        return (x >= min_x) & (x <= max_x) & (y >= min_y) & (y <= max_y)
+
+    # Function returning the polygon index of each point (-1 outside every polygon, NaN coordinates included)
+    def lookup_index(self, x, y):
+        x = np.asarray(x, dtype = np.float64)
+        y = np.asarray(y, dtype = np.float64)
+        result = np.full(len(x), -1, dtype = np.int32)
+        row, col = self._cells(np.nan_to_num(x, nan = -1e9), np.nan_to_num(y, nan = -1e9))
+        in_grid = (row >= 0) & (row < self.n_rows) & (col >= 0) & (col < self.n_cols) & np.isfinite(x) & np.isfinite(y)
+        cell_owner = np.full(len(x), -1, dtype = np.int32)
+        cell_owner[in_grid] = self.cell_owner[row[in_grid] * self.n_cols + col[in_grid]]
+
+        # Interior cells answer directly, boundary cells fall back to the polygon test
+        result[cell_owner >= 0] = cell_owner[cell_owner >= 0]
+        pending = np.flatnonzero(cell_owner == -2)
+        for i, rings in enumerate(self.rings):
+            if len(pending) == 0:
+                break
+            candidates = pending[self._in_bbox(x[pending], y[pending], i)]
+            hit = candidates[points_in_polygon(x[candidates], y[candidates], rings)]
+            result[hit] = i
+            pending = np.setdiff1d(pending, hit, assume_unique = True)
+        return result
+
+    # Function returning the polygon value of each point, None when outside every polygon
+    def lookup(self, x, y):
+        index = self.lookup_index(x, y)
+        values = np.full(len(index), None, dtype = object)
+        values[index >= 0] = self.values[index[index >= 0]]
+        return values
+
+
+
+
+# Function to get the index of a boundary layer, rebuilding the cached copy when the GeoJSON file is newer
+# Indexes are kept per file, so pointing boundary_dir elsewhere loads that folder's boundaries
+# Returns None when the file is missing, warning once per file
+def get_index(layer):
+    settings = boundary_layers[layer]
+    source = boundary_dir / settings["file"]
+    if source in _indexes:
+        return _indexes[source]
+    if not source.exists():
+        spatial_logger.warning(
+            f"No boundary file {source}, skipping {layer} imputation. Download it with python -m scripts.fetch_boundaries"
+        )
+        _indexes[source] = None
+        return None
+
+    cache_file = index_cache_dir / f"{layer}.pkl"
+    if cache_file.exists() and cache_file.stat().st_mtime >= source.stat().st_mtime:
+        with open(cache_file, "rb") as f:
+            index = pickle.load(f)
+    else:
+        index = PolygonGridIndex(load_polygons(source, settings["property"]))
+        index_cache_dir.mkdir(parents = True, exist_ok = True)
+        with open(cache_file, "wb") as f:
+            pickle.dump(index, f)
+        spatial_logger.info(f"Built {layer} grid index with {len(index.values)} polygons")
+    _indexes[source] = index
+    return index
+
+
+
+
+# Function to fill missing boroughs, and the ZIP code area of missing ZIP codes, from coordinates in one vectorized
+# pass per layer. incident_modzcta is added whenever incident_zip is there, so the columns do not depend on the layers
+@instrument_stage()
+def impute_location(df: pl.DataFrame) -> pl.DataFrame:
+    missing = {
+        "borough": pl.col("borough").is_null() | pl.col("borough").str.to_lowercase().is_in(missing_boroughs),
+        "incident_zip": pl.col("incident_zip").is_null() | (pl.col("incident_zip").str.len_chars() < 5),
+    }
+    if "incident_zip" in df.columns and "incident_modzcta" not in df.columns:
+        df = df.with_columns(pl.lit(None, dtype = pl.Utf8).alias("incident_modzcta"))
+    for layer, settings in boundary_layers.items():
+        checked, col = settings["missing"], settings["column"]
+        if checked not in df.columns:
+            continue
+        index = get_index(layer)
+        if index is None:
+            continue
+        is_missing = missing[checked]
+        rows = df.select(
+            is_missing & pl.col("latitude").is_not_null() & pl.col("longitude").is_not_null()
+        ).to_series()
+        if not rows.any():
+            continue
+
+        targets = df.filter(rows)
+        values = np.full(df.height, None, dtype = object)
+        values[rows.to_numpy()] = index.lookup(
+            targets["longitude"].cast(pl.Float64).to_numpy(),
+            targets["latitude"].cast(pl.Float64).to_numpy()
+        )
+        imputed = pl.Series(col, values.tolist(), dtype = pl.Utf8)
+        if layer == "modzcta":
+            imputed = imputed.str.zfill(5)
+        df = df.with_columns(
+            pl.when(rows & imputed.is_not_null())
+            .then(imputed)
+            .otherwise(pl.col(col))
+            .alias(col)
+        )
+        spatial_logger.info(f"Imputed {imputed.is_not_null().sum()} {col} values for {targets.height} missing {checked} values")
+    return df
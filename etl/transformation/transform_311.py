@@ -1,35 +1,45 @@
 # Functions needed for transformation
 import polars as pl
 import json
+from functools import lru_cache
 from pathlib import Path
 from logger.etl_logger import ETLLogger
+from logger.stage_metrics import instrument_stage
 from rapidfuzz import process, fuzz
+from etl.transformation.spatial_imputation import impute_location
+from etl.compact_schema import to_compact, to_text, shared_categories
+from etl.stage_cache import memoize_stage
 
 
 # Settings for logging transformation
 transform_logger = ETLLogger("transform_311").get()
-transform_logger.info("Starting 311 data transformation")
 
 # Settings for file path locations
 project_root = Path(__file__).resolve().parents[2]
 mapping_dir = project_root / "mappings"
-metadata_folder = project_root / "metadata"
-metadata_folder.mkdir(parents=True, exist_ok=True)
 
-# Loading mappings
-mappings = {}
-for file in mapping_dir.glob("*.json"):
-    with open(file, "r") as f:
-        mappings[file.stem] = json.load(f)
+
+
+# Function to load every mapping JSON file, read once on first use rather than at import
+@lru_cache(maxsize = None)
+def get_mappings() -> dict:
+    mappings = {}
+    for file in mapping_dir.glob("*.json"):
+        with open(file, "r") as f:
+            mappings[file.stem] = json.load(f)
+    return mappings
 
 
 
 # Function to set data types for each column
+# Text columns are decoded to plain strings for the cleaning stages, and compacted again at the end of transform_311
+@instrument_stage()
 def data_type_transformer(df: pl.DataFrame) -> pl.DataFrame:
+    df = to_text(df)
     df = df.with_columns([
-        pl.col("unique_key").cast(pl.Utf8),
-        pl.col("created_date").str.strptime(pl.Datetime, fmt = r"%Y-%m-%dT%H:%M:%S", strict = False),
-        pl.col("closed_date").str.strptime(pl.Datetime, fmt = r"%Y-%m-%dT%H:%M:%S", strict = False),
+        pl.col("unique_key").cast(pl.UInt64),
+        pl.col("created_date").str.strptime(pl.Datetime, format = r"%Y-%m-%dT%H:%M:%S%.f", strict = False),
+        pl.col("closed_date").str.strptime(pl.Datetime, format = r"%Y-%m-%dT%H:%M:%S%.f", strict = False),
         pl.col("agency").cast(pl.Utf8),
         pl.col("agency_name").cast(pl.Utf8),
         pl.col("complaint_type").cast(pl.Utf8),
@@ -38,10 +48,10 @@ def data_type_transformer(df: pl.DataFrame) -> pl.DataFrame:
         pl.col("incident_zip").cast(pl.Utf8),
         pl.col("city").cast(pl.Utf8),
         pl.col("status").cast(pl.Utf8),
-        pl.col("resolution_action_updated_date").str.strptime(pl.Datetime, fmt = r"%Y-%m-%dT%H:%M:%S", strict = False),
+        pl.col("resolution_action_updated_date").str.strptime(pl.Datetime, format = r"%Y-%m-%dT%H:%M:%S%.f", strict = False),
         pl.col("borough").cast(pl.Utf8),
-        pl.col("latitude").cast(pl.Float64),
-        pl.col("longitude").cast(pl.Float64)
+        pl.col("latitude").cast(pl.Float32),
+        pl.col("longitude").cast(pl.Float32)
     ])
     transform_logger.info("Data types transformed")
     return df
@@ -50,6 +60,7 @@ def data_type_transformer(df: pl.DataFrame) -> pl.DataFrame:
 
 
 # Funciton to clean string columns before mapping them
+@instrument_stage()
 def clean_strings_before_mapping(df: pl.DataFrame, cols) -> pl.DataFrame:
     for col in cols:
         if col in df.columns:
@@ -66,6 +77,7 @@ def clean_strings_before_mapping(df: pl.DataFrame, cols) -> pl.DataFrame:
 
 
 # Function to filter newly pulled data with complaint types not relevant.
+@instrument_stage()
 def filter_relevant_complaints(df: pl.DataFrame, relevant_complaints) -> pl.DataFrame:
     df = df.filter(
         (pl.col("complaint_type").str.contains(r"^[a-zA-Z0-9\s\.,\-\(\)&]+$")) &
@@ -77,16 +89,24 @@ def filter_relevant_complaints(df: pl.DataFrame, relevant_complaints) -> pl.Data
 
 
 
-# Function to deduplicate data based duplicate "unique_key", keeping the first record
+# Function to deduplicate data based duplicate "unique_key", keeping the earliest record
+# Almost every key is seen once, so only the rows of repeated keys are sorted, and the earliest of each kept
+# (benchmarks/bench_dedupe.py: a group_by sorting every key's group took 40 times as long as this on 2M rows)
+@instrument_stage()
 def dedupe(df: pl.DataFrame) -> pl.DataFrame:
-    df = df.sort("created_date", reverse = False)
+    repeated = df["unique_key"].is_duplicated()
+    df = pl.concat([
+        df.filter(~repeated),
+        df.filter(repeated).sort(["unique_key", "created_date"]).unique(subset = "unique_key", keep = "first", maintain_order = True),
+    ])
     transform_logger.info(f"Deduplicated complaints: {df.height} rows remain")
-    return df.unique(subset = "unique_key", keep = "first")
+    return df
 
 
 
 
 # Function to clean zip codes - replacing zip codes under 4 digits to null, and replacing zip codes with over 5 to only the first 5
+@instrument_stage()
 def clean_zip_codes(df: pl.DataFrame, zip_col: str = "incident_zip") -> pl.DataFrame:
     if zip_col in df.columns:
         df = df.with_columns(
@@ -102,6 +122,7 @@ def clean_zip_codes(df: pl.DataFrame, zip_col: str = "incident_zip") -> pl.DataF
 
 
 # Function to make a select list of string columns to be title cased
+@instrument_stage()
 def title_casing(df: pl.DataFrame) -> pl.DataFrame:
     title_case_columns = [
         "descriptor", "location_type", "city", "status",
@@ -128,6 +149,7 @@ def title_casing(df: pl.DataFrame) -> pl.DataFrame:
 
 # Function to apply mappings based on JSON files in order to reduce computation for common mispellings
 # Falls back on fuzzy string matching if there are categories that do not match keys (80% similiarity score matching)
+@instrument_stage(labels = ["column"])
 def apply_mapping(df: pl.DataFrame, column, mapping, use_fuzzy = True, score_cutoff = 80) -> pl.DataFrame:
     if column not in df.columns or not mapping:
         return df
@@ -162,7 +184,13 @@ def apply_mapping(df: pl.DataFrame, column, mapping, use_fuzzy = True, score_cut
 
 
 
-def transform_311(df: pl.DataFrame, mappings: dict) -> pl.DataFrame:
+# Outputs are cached by the content of the input and the mappings, so a re-run on the same rows returns immediately
+@instrument_stage()
+@shared_categories()
+@memoize_stage()
+def transform_311(df: pl.DataFrame, mappings: dict = None) -> pl.DataFrame:
+    transform_logger.info("Starting 311 data transformation")
+    mappings = get_mappings() if mappings is None else mappings
     df = data_type_transformer(df)
     
     df = clean_strings_before_mapping(df, [
@@ -187,6 +215,8 @@ def transform_311(df: pl.DataFrame, mappings: dict) -> pl.DataFrame:
 
     df = clean_zip_codes(df)
 
+    df = impute_location(df)
+
     df = title_casing(df)
 
     str_columns = [col for col, dtype in zip(df.columns, df.dtypes) if dtype == pl.Utf8]
@@ -198,7 +228,7 @@ def transform_311(df: pl.DataFrame, mappings: dict) -> pl.DataFrame:
         for col in str_columns
     ])
 
-    return df
+    return to_compact(df)
 
 
 # Function entry point for the main 311 transformation function
@@ -1,25 +1,35 @@
 # transform/transform_311_weather.py
 import polars as pl
+from etl.transformation.dim_date import date_id_expr, get_dim_date
+from etl.transformation.nearest_weather import WeatherGridIndex
+from etl.transformation.weather_cube import WeatherCube, daily_borough_weather, weather_summary
+from etl.compact_schema import to_compact, shared_categories
+from logger.stage_metrics import instrument_stage
+from etl.stage_cache import memoize_stage
 
-def transform_combined(cases: pl.DataFrame, weather: pl.DataFrame) -> dict:
-    # Ensuring data types
-    cases = cases.with_columns([
-        pl.col("unique_key").cast(pl.Int64),
+# Function to prepare the weather rows, shared by every partition of a backfill
+@instrument_stage()
+def prepare_weather(weather: pl.DataFrame) -> pl.DataFrame:
+    return to_compact(weather).with_columns([
+        pl.col("time").str.strptime(pl.Date, "%Y-%m-%d").alias("date"),
+        pl.col("precipitation_hours").cast(pl.Int64),
+        pl.col("grid_id").cast(pl.Int64),
+    ])
+
+
+
+
+# Function for the per-row stages of the incidents, each row only depends on itself and the weather grid
+# Partitions of the incidents can therefore be prepared independently and concatenated afterwards
+@instrument_stage()
+def prepare_cases(cases: pl.DataFrame, weather: pl.DataFrame) -> pl.DataFrame:
+    # Ensuring data types, following the compact schema
+    cases = to_compact(cases).with_columns([
+        pl.col("unique_key").cast(pl.UInt64),
         pl.col("created_date").cast(pl.Date),
         pl.col("closed_date").cast(pl.Date),
         pl.col("resolution_action_updated_date").cast(pl.Date),
-        pl.col("agency").cast(pl.Utf8),
-        pl.col("agency_name").cast(pl.Utf8),
-        pl.col("complaint_type").cast(pl.Utf8),
-        pl.col("descriptor").cast(pl.Utf8),
-        pl.col("location_type").cast(pl.Utf8),
         pl.col("incident_zip").cast(pl.Utf8),
-        pl.col("city").cast(pl.Utf8),
-        pl.col("status").cast(pl.Utf8),
-        pl.col("borough").cast(pl.Utf8),
-        pl.col("latitude").cast(pl.Float64),
-        pl.col("longitude").cast(pl.Float64),
-        pl.col("complaint_category").cast(pl.Utf8),
     ])
     cases = cases.with_columns([
         pl.when(pl.col("closed_date") < pl.col("created_date"))
@@ -28,87 +38,77 @@ def transform_combined(cases: pl.DataFrame, weather: pl.DataFrame) -> dict:
         .alias("closed_date")
     ])
 
-    weather = weather.with_columns([
-        pl.col("time").str.strptime(pl.Date, "%Y-%m-%d").alias("date"),
-        pl.col("temperature_2m_max").cast(pl.Float64),
-        pl.col("temperature_2m_min").cast(pl.Float64),
-        pl.col("precipitation_sum").cast(pl.Float64),
-        pl.col("precipitation_hours").cast(pl.Int64),
-        pl.col("rain_sum").cast(pl.Float64),
-        pl.col("showers_sum").cast(pl.Float64),
-        pl.col("snowfall_sum").cast(pl.Float64),
-        pl.col("windspeed_10m_max").cast(pl.Float64),
-        pl.col("windgusts_10m_max").cast(pl.Float64),
-        pl.col("borough").cast(pl.Utf8),
-        pl.col("latitude").cast(pl.Float64),
-        pl.col("longitude").cast(pl.Float64),
+    # Assigning each incident to its nearest weather grid point
+    cases = WeatherGridIndex(weather).assign(cases)
+
+    return cases.with_columns([
+        date_id_expr("created_date").alias("created_date_id"),
+        date_id_expr("closed_date").alias("closed_date_id")
     ])
 
-    # dim_date
-    dim_date = pl.concat([
-        cases.select(["created_date", "closed_date"]).melt().select("value").rename({"value":"date"}),
-        weather.select(["time"]).rename({"time":"date"})
-    ]).unique().with_columns([
-        pl.col("date").cast(pl.Date),
-        pl.arange(1, pl.count() + 1).alias("date_id")
-    ]).sort("date")
 
-    dim_date = dim_date.with_columns([
-        pl.col("date").dt.day().alias("day"),
-        pl.col("date").dt.month().alias("month"),
-        pl.col("date").dt.year().alias("year"),
-        pl.col("date").dt.weekday().alias("weekday"),
-        pl.col("date").dt.strftime("%A").alias("weekday_name")
-    ])
+
+
+# Function to build the star schema from prepared incidents and weather, assigning the dimension keys
+@instrument_stage()
+def build_star_schema(cases: pl.DataFrame, weather: pl.DataFrame) -> dict:
+    # dim_date sliced from the cached calendar (which starts in 2010) to the span of dates in this batch
+    date_bounds = pl.concat([
+        cases.select([
+            pl.min_horizontal(pl.col("created_date").min(), pl.col("closed_date").min()).alias("min_date"),
+            pl.max_horizontal(pl.col("created_date").max(), pl.col("closed_date").max()).alias("max_date")
+        ]),
+        weather.select([
+            pl.col("date").min().alias("min_date"),
+            pl.col("date").max().alias("max_date")
+        ])
+    ]).select([pl.col("min_date").min(), pl.col("max_date").max()])
+    min_date, max_date = date_bounds["min_date"].item(), date_bounds["max_date"].item()
+    dim_date = get_dim_date(min_date, max_date).filter(pl.col("date").is_between(min_date, max_date))
     
     # dim_borough 
     dim_borough = pl.DataFrame({
         "borough_id": [1, 2, 3, 4, 5],
         "borough_name": ["Manhattan", "Brooklyn", "Queens", "Bronx", "Staten Island"]
-    })
+    }).with_columns(pl.col("borough_name").cast(pl.Categorical))
 
     # dim_location
     weather_loc = weather.select([
         pl.col("borough"),
         pl.col("latitude"),
         pl.col("longitude"),
-        pl.lit(None).cast(pl.Utf8).alias("city"),
-        pl.lit(None).cast(pl.Utf8).alias("location_type"),
+        pl.lit(None).cast(pl.Categorical).alias("city"),
+        pl.lit(None).cast(pl.Categorical).alias("location_type"),
         pl.lit(None).cast(pl.Utf8).alias("incident_zip"),
+        pl.lit(None).cast(pl.Utf8).alias("incident_modzcta"),
     ])
     dim_location = pl.concat([
-        cases.select(["borough","latitude","longitude","city","location_type","incident_zip"]),
+        cases.select(["borough","latitude","longitude","city","location_type","incident_zip","incident_modzcta"]),
         weather_loc
     ]).unique().with_columns([
-        pl.arange(1, pl.count() + 1).alias("location_id")
+        pl.int_range(1, pl.len() + 1).alias("location_id")
     ])
     dim_location = dim_location.select([
-        "location_id","incident_zip","borough","city","location_type","latitude","longitude"
+        "location_id","incident_zip","borough","city","location_type","latitude","longitude","incident_modzcta"
     ])
     
     # dim_agency
     dim_agency = cases.select(["agency","agency_name"]).unique().with_columns([
-        pl.arange(1, pl.count() + 1).alias("agency_id")
+        pl.int_range(1, pl.len() + 1).alias("agency_id")
     ])
     
     # dim_complaint_type
     dim_complaint_type = cases.select(["complaint_type","descriptor","complaint_category"]).unique().with_columns([
-        pl.arange(1, pl.count() + 1).alias("complaint_type_id")
+        pl.int_range(1, pl.len() + 1).alias("complaint_type_id")
     ])
     
     
     # fact_incidents
     fact_incidents = cases.join(
-        dim_date.rename({"date": "created_date", "date_id": "created_date_id"}), 
-        on="created_date", how="left"
-    ).join(
-        dim_date.rename({"date": "closed_date", "date_id": "closed_date_id"}), 
-        on="closed_date", how="left"
-    ).join(
         dim_location, 
         on=["borough", "latitude", "longitude"], how="left"
     ).join(
-        dim_borough, on="borough", how="left"
+        dim_borough, left_on="borough", right_on="borough_name", how="left"
     ).join(
         dim_agency, on="agency", how="left"
     ).join(
@@ -123,7 +123,7 @@ def transform_combined(cases: pl.DataFrame, weather: pl.DataFrame) -> dict:
     # Dropping unnecessary columns
     drop_cols_incidents = [
         "agency_name", "complaint_type", "descriptor", "location_type", 
-        "incident_zip", "city", "status", "resolution_action_updated_date", 
+        "incident_zip", "incident_modzcta", "city", "status", "resolution_action_updated_date", 
         "borough", "latitude", "longitude"
     ]
     fact_incidents = fact_incidents.drop([col for col in drop_cols_incidents if col in fact_incidents.columns])
@@ -140,49 +140,36 @@ def transform_combined(cases: pl.DataFrame, weather: pl.DataFrame) -> dict:
         "snowfall_sum": "snowfall_total",
         "windspeed_10m_max": "windspeed_max",
         "windgusts_10m_max": "windgust_max"
-    }).join(
-        dim_date.rename({"date": "date", "date_id": "date_id"}), on="date", how="left"
-    ).join(
-        dim_borough, on="borough", how="left"
+    }).with_columns([
+        date_id_expr("date").alias("date_id")
+    ]).join(
+        dim_borough, left_on="borough", right_on="borough_name", how="left"
     ).with_columns([
         (pl.col("rain_total") > 0).cast(pl.Int64).alias("rain_flag"),
         (pl.col("showers_total") > 0).cast(pl.Int64).alias("showers_flag"),
         (pl.col("snowfall_total") > 0).cast(pl.Int64).alias("snow_flag"),
-        ((pl.col("windspeed_max") > 15) | (pl.col("windgust_max") > 20)).cast(pl.Int64).alias("high_wind_flag")
+        ((pl.col("windspeed_max") > 15) | (pl.col("windgust_max") > 20)).cast(pl.Int64).alias("high_wind_flag"),
+        # Deterministic key of each (day, grid point) row, so a reloaded day keeps its weather_id
+        (date_id_expr("date") * 100_000 + pl.col("grid_id")).alias("weather_id")
     ])
     # Filtering cols
     fact_weather = fact_weather.select([
-        "date_id", "borough_id", "temperature_max", "temperature_min", "precipitation_total",
+        "weather_id", "date_id", "borough_id", "grid_id", "temperature_max", "temperature_min", "precipitation_total",
         "precipitation_hours", "rain_total", "showers_total", "snowfall_total", "windspeed_max",
         "windgust_max", "rain_flag", "showers_flag", "snow_flag", "high_wind_flag"
     ])
     
     # fact_daily_summary 
     daily_incidents = fact_incidents.group_by(["created_date_id","borough_id"]).agg([
-        pl.count("incident_id").alias("total_incidents"),
+        pl.col("unique_key").count().alias("total_incidents"),
         (pl.col("is_resolved_same_day").mean() * 100).alias("percent_resolved_same_day")
     ])
     
-    daily_weather = fact_weather.group_by(["date_id","borough_id"]).agg([
-        pl.col("temperature_max").mean().alias("temperature_max"),
-        pl.col("temperature_min").mean().alias("temperature_min"),
-        ((pl.col("temperature_max") + pl.col("temperature_min"))/2).mean().alias("temperature_avg"),
-        pl.col("precipitation_total").sum().alias("precipitation_total"),
-        (pl.when(pl.col("precipitation_total") > 0).then(pl.col("precipitation_total")/24).otherwise(0)).alias("precipitation_per_hour"),
-        pl.col("rain_total").sum().alias("rain_total"),
-        pl.col("showers_total").sum().alias("showers_total"),
-        pl.col("snowfall_total").sum().alias("snowfall_total"),
-        pl.col("windspeed_max").max().alias("windspeed_max"),
-        pl.col("windgust_max").max().alias("windgust_max"),
-        pl.col("rain_flag").max().alias("rain_flag"),
-        pl.col("showers_flag").max().alias("showers_flag"),
-        pl.col("snow_flag").max().alias("snow_flag"),
-        pl.col("high_wind_flag").max().alias("high_wind_flag")
-    ])
-    
-    fact_daily_summary = daily_incidents.join(
-        daily_weather, left_on=["created_date_id","borough_id"], right_on=["date_id","borough_id"], how="left"
-    )
+    # Totals are averaged over the grid points of each borough, identical to the single value with borough centroids
+    # The weather of each summary day is looked up in the cube of the batch's weather by day offset and borough,
+    # rather than joined on date and borough (etl/transformation/weather_cube.py)
+    weather_cube = WeatherCube.from_daily(daily_borough_weather(fact_weather))
+    fact_daily_summary = weather_summary(weather_cube.enrich(daily_incidents, "created_date_id", "borough_id"))
     
     # Renamung columns to match BigQuery schema
     dim_date = dim_date.rename({
@@ -204,13 +191,13 @@ def transform_combined(cases: pl.DataFrame, weather: pl.DataFrame) -> dict:
     fact_incidents = fact_incidents.rename({
         "unique_key":"incident_id","created_date_id":"created_date_id","closed_date_id":"closed_date_id",
         "agency_id":"agency_id","complaint_type_id":"complaint_type_id","date_id":"date_id",
-        "location_id":"location_id","resolution_status":"resolution_status",
+        "location_id":"location_id","weather_grid_id":"weather_grid_id","resolution_status":"resolution_status",
         "time_to_resolve_interval":"time_to_resolve_interval",
         "is_resolved_same_day":"is_resolved_same_day",
         "complaint_count":"complaint_count"
     })
     fact_weather = fact_weather.rename({
-        "date_id":"date_id","borough_id":"borough_id","temperature_max":"temperature_max",
+        "weather_id":"weather_id","date_id":"date_id","borough_id":"borough_id","grid_id":"grid_id","temperature_max":"temperature_max",
         "temperature_min":"temperature_min","precipitation_total":"precipitation_total",
         "precipitation_hours":"precipitation_hours","rain_total":"rain_total",
         "showers_total":"showers_total","snowfall_total":"snowfall_total","windspeed_max":"windspeed_max",
@@ -240,6 +227,14 @@ def transform_combined(cases: pl.DataFrame, weather: pl.DataFrame) -> dict:
         "fact_daily_summary": fact_daily_summary
     }
 
+# Outputs are cached by the content of the incidents and weather, like transform_311
+@instrument_stage()
+@shared_categories()
+@memoize_stage()
+def transform_combined(cases: pl.DataFrame, weather: pl.DataFrame) -> dict:
+    weather = prepare_weather(weather)
+    return build_star_schema(prepare_cases(cases, weather), weather)
+
 # Function entry point
 if __name__ == "__main__":
     transform_combined()
\ No newline at end of file
@@ -0,0 +1,274 @@
+# Dense weather cube of the daily weather of each borough, looked up by index arithmetic instead of joins
+# Weather is a regular grid of days x boroughs x variables, so it is kept as a float32 array of that shape: the
+# weather of (day, borough) is the row cube[day - start, borough_id - 1], and enriching rows is a gather over two
+# integer arrays rather than a hash join on date and borough
+# The cube of every day loaded so far is stored as a memory-mapped .npy file with a small JSON header (first day,
+# days used, variables), and new days are written in place. Days without weather are NaN, read back as null
+import fcntl
+import json
+import os
+import numpy as np
+import polars as pl
+from contextlib import contextmanager
+from datetime import date
+from pathlib import Path
+from logger.etl_logger import ETLLogger
+from logger.stage_metrics import instrument_stage
+
+
+# Settings for the stored cube
+project_root = Path(__file__).resolve().parents[2]
+cube_folder = Path(os.environ.get("ETL_WEATHER_CUBE_DIR", project_root / "data" / "weather_cube"))
+cube_logger = ETLLogger("weather_cube").get()
+
+# Boroughs of the cube, borough_id 1 to 5 as in dim_borough
+n_boroughs = 5
+
+# Variables of the cube, daily values of each borough over its grid points, as fact_daily_summary holds them
+# New variables go at the end, a stored cube with other variables has to be rebuilt
+cube_variables = {
+    "temperature_max": pl.col("temperature_max").mean(),
+    "temperature_min": pl.col("temperature_min").mean(),
+    "temperature_avg": ((pl.col("temperature_max") + pl.col("temperature_min")) / 2).mean(),
+    "precipitation_total": pl.col("precipitation_total").mean(),
+    "rain_total": pl.col("rain_total").mean(),
+    "showers_total": pl.col("showers_total").mean(),
+    "snowfall_total": pl.col("snowfall_total").mean(),
+    "windspeed_max": pl.col("windspeed_max").max(),
+    "windgust_max": pl.col("windgust_max").max(),
+}
+
+# Columns of fact_daily_summary derived from the cube variables. The flags of fact_weather are set when any grid
+# point of the borough has rain, showers, snow or high wind, the same as the borough mean or max being above the
+# threshold since the totals are never negative
+weather_flags = {
+    "precipitation_per_hour": pl.col("precipitation_total") / 24,
+    "rain_flag": (pl.col("rain_total") > 0).cast(pl.Int64),
+    "showers_flag": (pl.col("showers_total") > 0).cast(pl.Int64),
+    "snow_flag": (pl.col("snowfall_total") > 0).cast(pl.Int64),
+    "high_wind_flag": ((pl.col("windspeed_max") > 15) | (pl.col("windgust_max") > 20)).cast(pl.Int64),
+}
+
+# Days the stored cube grows by when a day past its end arrives, so appending a day rarely copies the file
+growth_days = 366
+
+
+
+# Function to get the days since 1970-01-01 of YYYYMMDD date keys, -1 for null or malformed keys
+def epoch_days(date_ids) -> np.ndarray:
+    ids = pl.Series(date_ids).cast(pl.Int64).fill_null(0).to_numpy()
+    year, month, day = ids // 10_000, ids // 100 % 100, ids % 100
+    valid = (month >= 1) & (month <= 12) & (day >= 1) & (day <= 31)
+    months = np.where(valid, (year - 1970) * 12 + month - 1, 0)
+    days = months.astype("datetime64[M]").astype("datetime64[D]").astype(np.int64) + day - 1
+    return np.where(valid, days, -1)
+
+
+# Function to aggregate fact_weather rows to the daily values of each borough
+def daily_borough_weather(fact_weather: pl.DataFrame) -> pl.DataFrame:
+    return fact_weather.filter(
+        pl.col("date_id").is_not_null() & pl.col("borough_id").is_not_null()
+    ).group_by(["date_id", "borough_id"]).agg([
+        expr.alias(name) for name, expr in cube_variables.items()
+    ])
+
+
+# Function to add the columns derived from the cube variables to rows enriched with them
+def weather_summary(df: pl.DataFrame) -> pl.DataFrame:
+    return df.with_columns([expr.alias(name) for name, expr in weather_flags.items()])
+
+
+
+
+# Class wrapping a cube of shape (days, boroughs, variables), in memory or memory-mapped from a stored cube
+class WeatherCube:
+    def __init__(self, values: np.ndarray, start: int, days = None):
+        self.values = values
+        self.start = start  # days since 1970-01-01 of the first day of the cube
+        self.days = len(values) if days is None else days
+        self.tables = None
+
+    # Function to build a cube in memory from daily borough weather
+    @classmethod
+    def from_daily(cls, daily: pl.DataFrame):
+        day = epoch_days(daily["date_id"])
+        borough = daily["borough_id"].cast(pl.Int64).fill_null(0).to_numpy() - 1
+        valid = (day >= 0) & (borough >= 0) & (borough < n_boroughs)
+        if not valid.any():
+            return cls(np.empty((0, n_boroughs, len(cube_variables)), dtype = np.float32), 0)
+        start = int(day[valid].min())
+        values = np.full((int(day[valid].max()) - start + 1, n_boroughs, len(cube_variables)), np.nan, dtype = np.float32)
+        weather = daily.select(list(cube_variables)).to_numpy().astype(np.float32)
+        values[day[valid] - start, borough[valid]] = weather[valid]
+        return cls(values, start)
+
+    # Function to get the YYYYMMDD date keys of the days of the cube
+    def date_ids(self) -> np.ndarray:
+        days = (self.start + np.arange(self.days)).astype("datetime64[D]")
+        months = days.astype("datetime64[M]")
+        year = days.astype("datetime64[Y]").astype(np.int64) + 1970
+        month = months.astype(np.int64) % 12 + 1
+        return year * 10_000 + month * 100 + (days - months).astype(np.int64) + 1
+
+    # Function to build the tables of the lookup, built once per cube as they only depend on its days
+    #   rows      row of the flattened cube of each (date key - first key) * boroughs + borough_id - 1, the last row
+    #             (no weather) for date keys between the cube's days that are not days of the cube
+    #   columns   each variable as a contiguous array over the rows of the flattened cube, plus that last NaN row
+    def lookup_tables(self):
+        if self.tables is None:
+            date_ids = self.date_ids()
+            first_id = int(date_ids[0]) if self.days else 0
+            span = (int(date_ids[-1]) - first_id + 1) * n_boroughs if self.days else 0
+            n_rows = self.days * n_boroughs
+            rows = np.full(span + 1, n_rows, dtype = np.int64)
+            rows[((date_ids - first_id)[:, None] * n_boroughs + np.arange(n_boroughs)).ravel()] = np.arange(n_rows)
+            columns = np.full((len(cube_variables), n_rows + 1), np.nan, dtype = np.float32)
+            columns[:, :n_rows] = np.asarray(self.values[:self.days]).reshape(n_rows, len(cube_variables)).T
+            self.tables = (first_id, rows, columns)
+        return self.tables
+
+    # Function to get the row of the flattened cube of each (date key, borough_id) pair, by index arithmetic
+    # Pairs outside the cube, with a null or malformed key or an unknown borough get the last row, which is NaN
+    def positions(self, date_ids, borough_ids) -> np.ndarray:
+        first_id, rows, _ = self.lookup_tables()
+        date_ids = pl.Series(date_ids).cast(pl.Int64).fill_null(-1).to_numpy()
+        borough = pl.Series(borough_ids).cast(pl.Int64).fill_null(0).to_numpy() - 1
+        key = date_ids - first_id
+        key *= n_boroughs
+        key += borough
+        # Negative keys and boroughs wrap around to huge unsigned values, one comparison checks both bounds
+        inside = key.view(np.uint64) < len(rows) - 1
+        inside &= borough.view(np.uint64) < n_boroughs
+        key[~inside] = len(rows) - 1
+        return rows[key]
+
+    # Function to get the weather of each (date key, borough_id) pair, one array per variable, NaN where the cube
+    # has none
+    def lookup(self, date_ids, borough_ids) -> list:
+        _, _, columns = self.lookup_tables()
+        positions = self.positions(date_ids, borough_ids)
+        return [np.take(column, positions) for column in columns]
+
+    # Function to add the weather of each row's day and borough as columns, null where the cube has none
+    def enrich(self, df: pl.DataFrame, date_col = "date_id", borough_col = "borough_id") -> pl.DataFrame:
+        weather = self.lookup(df[date_col], df[borough_col])
+        return df.with_columns([
+            pl.Series(name, values) for name, values in zip(cube_variables, weather)
+        ]).with_columns(pl.col(list(cube_variables)).fill_nan(None))
+
+
+
+
+# Stored cube, a .npy file memory-mapped on open and its JSON header
+class WeatherCubeStore:
+    def __init__(self, folder = None):
+        folder = Path(folder or cube_folder)
+        self.path = folder / "weather_cube.npy"
+        self.header_path = folder / "weather_cube.json"
+
+    def read_header(self):
+        if not self.header_path.exists():
+            return None
+        with open(self.header_path) as f:
+            header = json.load(f)
+        if header["variables"] != list(cube_variables) or header["boroughs"] != n_boroughs:
+            raise ValueError(f"Weather cube {self.path} has variables {header['variables']}, rebuild it with WeatherCubeStore.rebuild")
+        return header
+
+    # The header is replaced atomically, and only after the days it covers are written
+    def write_header(self, start, days):
+        header = {"start": date.fromordinal(start + date(1970, 1, 1).toordinal()).isoformat(), "start_day": start, "days": days,
+                  "boroughs": n_boroughs, "variables": list(cube_variables)}
+        tmp_path = self.header_path.with_name(self.header_path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(header, f)
+        os.replace(tmp_path, self.header_path)
+
+    def map(self):
+        header = self.read_header()
+        if header is None:
+            return None
+        return WeatherCube(np.load(self.path, mmap_mode = "r"), header["start_day"], header["days"])
+
+    # Function to open the stored cube memory-mapped, None before the first update
+    # The file and header are read under a shared lock, a mapped file stays valid after an update replaces it
+    def open(self):
+        with self.lock(shared = True):
+            return self.map()
+
+    # Context manager holding a lock on the store, exclusive for the runs writing their days one at a time
+    @contextmanager
+    def lock(self, shared = False):
+        self.path.parent.mkdir(parents = True, exist_ok = True)
+        with open(self.path.with_suffix(".lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    # Function to write a new file holding the days from start on, with room for capacity days, copying the cube
+    def allocate(self, cube, start, capacity):
+        tmp_path = self.path.with_name("weather_cube.tmp.npy")
+        values = np.lib.format.open_memmap(tmp_path, mode = "w+", dtype = np.float32, shape = (capacity, n_boroughs, len(cube_variables)))
+        values[:] = np.nan
+        if cube is not None and cube.days:
+            values[cube.start - start:cube.start - start + cube.days] = cube.values[:cube.days]
+        values.flush()
+        del values
+        os.replace(tmp_path, self.path)
+
+    # Function to write the daily borough weather of a batch into the stored cube, replacing the days it already has
+    # Days past the end are written in place while the file has room, the file is only copied when it grows by
+    # growth_days or a day before its first day arrives
+    def update(self, daily: pl.DataFrame):
+        batch = WeatherCube.from_daily(daily)
+        if batch.days == 0:
+            return self.open()
+        with self.lock():
+            cube = self.map()
+            start = batch.start if cube is None else min(batch.start, cube.start)
+            end = batch.start + batch.days if cube is None else max(batch.start + batch.days, cube.start + cube.days)
+            if cube is None or start < cube.start or end - start > len(cube.values):
+                self.allocate(cube, start, end - start + growth_days)
+                del cube
+
+            values = np.load(self.path, mmap_mode = "r+")
+            written = ~np.isnan(batch.values).all(axis = 2)
+            offset = batch.start - start
+            target = values[offset:offset + batch.days]
+            target[written] = batch.values[written]
+            values.flush()
+            del values
+            self.write_header(start, end - start)
+        return self.open()
+
+    # Function to rebuild the stored cube from daily borough weather, after a change to the cube variables
+    def rebuild(self, daily: pl.DataFrame):
+        with self.lock():
+            for path in [self.header_path, self.path]:
+                path.unlink(missing_ok = True)
+        return self.update(daily)
+
+
+
+
+# Function to write the weather of a batch into the stored cube, and to fill the weather of the fact_daily_summary
+# days the batch has no weather for (incidents created before the batch's weather window) from the stored cube
+# Kept out of transform_combined, whose output is cached by the content of its inputs
+@instrument_stage()
+def update_weather_cube(tables, store = None) -> dict:
+    store = store or WeatherCubeStore()
+    if tables.get("fact_weather") is None:
+        return tables
+    cube = store.update(daily_borough_weather(tables["fact_weather"]))
+    summary = tables.get("fact_daily_summary")
+    if cube is None or summary is None or summary.height == 0:
+        return tables
+
+    missing = summary["temperature_max"].is_null()
+    if missing.any():
+        filled = weather_summary(cube.enrich(summary.filter(missing), "date_id", "borough_id"))
+        tables["fact_daily_summary"] = pl.concat([summary.filter(~missing), filled.select(summary.columns)], how = "vertical_relaxed")
+        cube_logger.info(f"Filled the weather of {filled['temperature_max'].is_not_null().sum()} of {filled.height} summary days from the stored cube")
+    return tables
@@ -0,0 +1,222 @@
+# Rolling and lagged weather features of each date and borough, the companion table fact_weather_features of fact_weather
+# Analysts relate complaints to the weather of the previous days (3-day rain, 7-day snowfall, freeze-thaw cycles),
+# which on fact_weather alone takes a self-join per feature. The features are computed here instead, per borough,
+# with rolling and shift expressions over the days of each borough sorted by date
+# Computation is incremental: the daily values of every day seen so far are kept in a small store (five rows a day),
+# and a batch only recomputes its own days and the days after them whose windows reach back into the batch
+import fcntl
+import os
+import polars as pl
+from contextlib import contextmanager
+from datetime import timedelta
+from pathlib import Path
+from logger.etl_logger import ETLLogger
+from logger.stage_metrics import instrument_stage
+from etl.stable_hash import hash_rows
+from etl.transformation.dim_date import date_id_expr
+
+
+# Settings for the feature store
+project_root = Path(__file__).resolve().parents[2]
+feature_store_folder = Path(os.environ.get("ETL_WEATHER_FEATURES_DIR", project_root / "metadata" / "weather_features"))
+feature_logger = ETLLogger("weather_features").get()
+
+# Daily values of each borough the features are computed from, fact_weather columns over the borough's grid points
+daily_columns = {
+    "temperature_max": pl.col("temperature_max").mean(),
+    "temperature_min": pl.col("temperature_min").mean(),
+    "precipitation_total": pl.col("precipitation_total").mean(),
+    "rain_total": pl.col("rain_total").mean(),
+    "snowfall_total": pl.col("snowfall_total").mean(),
+    "windgust_max": pl.col("windgust_max").max(),
+}
+
+# Daily values derived from them, as 0/1 flags
+derived_columns = {
+    # Freeze-thaw day: the temperature crosses 0 °C, going below freezing and back above it
+    "freeze_thaw_day": ((pl.col("temperature_min") < 0) & (pl.col("temperature_max") > 0)).cast(pl.Int64),
+    "wet_day": (pl.col("precipitation_total") >= 1).cast(pl.Int64),
+}
+
+# Features as name -> (kind, daily value, days)
+#   sum, mean, min, max   over the day and the days - 1 days before it, null unless every one of them has weather
+#   lag                   the daily value days days before
+# New features go at the end, and at the end of fact_weather_features in etl/loading/warehouse_schema.py too
+weather_features = {
+    "rain_total_3d": ("sum", "rain_total", 3),
+    "precipitation_total_7d": ("sum", "precipitation_total", 7),
+    "snowfall_total_7d": ("sum", "snowfall_total", 7),
+    "temperature_max_avg_7d": ("mean", "temperature_max", 7),
+    "temperature_min_min_3d": ("min", "temperature_min", 3),
+    "windgust_max_3d": ("max", "windgust_max", 3),
+    "freeze_thaw_days_7d": ("sum", "freeze_thaw_day", 7),
+    "wet_days_7d": ("sum", "wet_day", 7),
+    "rain_total_lag_1d": ("lag", "rain_total", 1),
+    "temperature_max_lag_1d": ("lag", "temperature_max", 1),
+    "temperature_min_lag_1d": ("lag", "temperature_min", 1),
+}
+
+# Key of a feature row, deterministic so a recomputed day replaces the row loaded before
+# The row hash is the stable one of the 311 rows, since it is kept in the key index across runs
+feature_key = "feature_id"
+row_hash_seed = 4402
+# Decimals features are rounded to, a rolling sum started from another day differs in its last bits, and would
+# otherwise change the row hash of a day whose weather did not change
+feature_decimals = 6
+
+
+
+# Function to get the BigQuery type of a feature, counts and lags of the 0/1 flags are integers
+def feature_type(name, features = None) -> str:
+    kind, column, _ = (weather_features if features is None else features)[name]
+    return "INT64" if column in derived_columns and kind != "mean" else "FLOAT"
+
+
+# Function to get the number of days before a day its features read
+def lookback_days(features = None) -> int:
+    features = weather_features if features is None else features
+    return max([days if kind == "lag" else days - 1 for kind, _, days in features.values()] + [0])
+
+
+# Function to get the expression of a feature, over the days of one borough in date order
+def feature_expr(name, kind, column, days) -> pl.Expr:
+    if kind == "lag":
+        expr = pl.col(column).shift(days)
+    else:
+        rolling = {"sum": pl.Expr.rolling_sum, "mean": pl.Expr.rolling_mean, "min": pl.Expr.rolling_min, "max": pl.Expr.rolling_max}
+        expr = rolling[kind](pl.col(column), window_size = days, min_samples = days)
+    return expr.over("borough_id").alias(name)
+
+
+
+
+# Function to aggregate fact_weather rows to the daily values of each borough
+def daily_weather(fact_weather: pl.DataFrame) -> pl.DataFrame:
+    return fact_weather.filter(
+        pl.col("date_id").is_not_null() & pl.col("borough_id").is_not_null()
+    ).group_by(["date_id", "borough_id"]).agg([
+        expr.alias(name) for name, expr in daily_columns.items()
+    ]).with_columns([
+        pl.col("date_id").cast(pl.Utf8).str.strptime(pl.Date, "%Y%m%d", strict = False).alias("date"),
+        pl.col("borough_id").cast(pl.Int64),
+    ]).select(["date", "borough_id", *daily_columns])
+
+
+# Function to get an empty frame of features, with the columns and types compute_features returns
+def empty_features(features = None) -> pl.DataFrame:
+    features = weather_features if features is None else features
+    return pl.DataFrame(schema = {
+        feature_key: pl.Int64, "date_id": pl.Int64, "borough_id": pl.Int64,
+        **{name: pl.Int64 if feature_type(name, features) == "INT64" else pl.Float64 for name in features},
+        "row_hash": pl.UInt64,
+    })
+
+
+# Function to compute the features of the days from start to end (inclusive) from the daily values
+# Each borough's days are laid out on the full calendar first, so a window of n rows is always n days, and a
+# missing day leaves the features reading it null instead of shifting the window
+def compute_features(daily: pl.DataFrame, start, end, features = None) -> pl.DataFrame:
+    features = weather_features if features is None else features
+    first = start - timedelta(days = lookback_days(features))
+    daily = daily.filter((pl.col("date") >= first) & (pl.col("date") <= end))
+    if daily.height == 0:
+        return empty_features(features)
+    calendar = pl.DataFrame({"date": pl.date_range(first, end, "1d", eager = True)}).join(
+        daily.select("borough_id").unique(), how = "cross"
+    )
+    frame = calendar.join(
+        daily.with_columns(pl.lit(True).alias("has_weather")), on = ["date", "borough_id"], how = "left"
+    ).sort(["borough_id", "date"]).with_columns([expr.alias(name) for name, expr in derived_columns.items()])
+
+    frame = frame.with_columns([feature_expr(name, *spec) for name, spec in features.items()]).filter(
+        (pl.col("date") >= start) & pl.col("has_weather").fill_null(False)
+    )
+    frame = frame.with_columns([
+        date_id_expr("date").alias("date_id"),
+        *[
+            pl.col(name).cast(pl.Int64) if feature_type(name, features) == "INT64" else pl.col(name).cast(pl.Float64).round(feature_decimals)
+            for name in features
+        ],
+    ]).with_columns((pl.col("date_id") * 100 + pl.col("borough_id")).alias(feature_key))
+    frame = frame.with_columns(hash_rows(frame, list(features), seed = row_hash_seed).alias("row_hash"))
+    return frame.select([feature_key, "date_id", "borough_id", *features, "row_hash"])
+
+
+
+
+# Store of the daily values of every day seen so far, the state the features of new days are computed from
+# The daily values of a borough are a few dozen bytes a day, so the whole history is kept in one Parquet file
+class WeatherFeatureStore:
+    def __init__(self, folder = None, features = None):
+        self.path = Path(folder or feature_store_folder) / "daily_weather.parquet"
+        self.features = weather_features if features is None else features
+
+    def read(self):
+        return pl.read_parquet(self.path) if self.path.exists() else None
+
+    # Context manager holding an exclusive lock on the store, so concurrent runs add their batches one at a time
+    @contextmanager
+    def lock(self):
+        self.path.parent.mkdir(parents = True, exist_ok = True)
+        with open(self.path.with_suffix(".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    # The history is replaced atomically, so a run failing while writing it leaves the previous one
+    def write(self, daily: pl.DataFrame):
+        self.path.parent.mkdir(parents = True, exist_ok = True)
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        daily.write_parquet(tmp_path)
+        os.replace(tmp_path, self.path)
+
+    # Function to add a batch of daily values, returning the features of every day the batch changes: its own days,
+    # and the days after them whose windows or lags read a day of the batch, up to lookback days later
+    # Days already in the store are replaced by the batch, e.g. when a window of weather is extracted again
+    def update(self, batch: pl.DataFrame) -> pl.DataFrame:
+        if batch.height == 0:
+            return empty_features(self.features)
+        with self.lock():
+            stored = self.read()
+            history = batch if stored is None else pl.concat([
+                stored.join(batch.select(["date", "borough_id"]), on = ["date", "borough_id"], how = "anti"),
+                batch.select(stored.columns),
+            ], how = "vertical_relaxed")
+            history = history.sort(["date", "borough_id"])
+
+            start = batch["date"].min()
+            end = min(batch["date"].max() + timedelta(days = lookback_days(self.features)), history["date"].max())
+            features = compute_features(history, start, end, self.features)
+            self.write(history)
+        return features
+
+    # Function to recompute the features of every stored day, after a change to the feature definitions
+    def rebuild(self, daily: pl.DataFrame = None) -> pl.DataFrame:
+        with self.lock():
+            daily = self.read() if daily is None else daily.sort(["date", "borough_id"])
+            if daily is None or daily.height == 0:
+                return empty_features(self.features)
+            self.write(daily)
+        return compute_features(daily, daily["date"].min(), daily["date"].max(), self.features)
+
+
+
+
+# Function to compute the features of the days a batch of fact_weather rows changes, updating the feature store
+@instrument_stage()
+def transform_weather_features(fact_weather: pl.DataFrame, store = None) -> pl.DataFrame:
+    store = store or WeatherFeatureStore()
+    features = store.update(daily_weather(fact_weather))
+    feature_logger.info(f"Computed weather features of {features.height} borough days")
+    return features
+
+
+# Function to add the fact_weather_features table to the star schema tables of a batch
+# Kept out of transform_combined, whose output is cached by the content of its inputs while the features depend on
+# the weather of earlier batches too
+def add_weather_features(tables, store = None) -> dict:
+    if tables.get("fact_weather") is not None:
+        tables["fact_weather_features"] = transform_weather_features(tables["fact_weather"], store)
+    return tables
@@ -1,20 +1,80 @@
 # Importing libraries for a reusable logging function
-import logging 
+import atexit
+import logging
+import os
+import queue
+import threading
 from pathlib import Path
 
 
+# Settings for the log files, the folder is absolute so logs end up in the same place whatever the working directory
+project_root = Path(__file__).resolve().parents[1]
+log_folder_default = Path(os.environ.get("ETL_LOG_DIR", project_root / "logs")).resolve()
+log_format = os.environ.get("ETL_LOG_FORMAT", "json")  # "json" for one object per line, "text" for the plain format
+max_log_bytes = int(os.environ.get("ETL_LOG_MAX_BYTES", 10 * 1024 * 1024))
+log_backup_count = int(os.environ.get("ETL_LOG_BACKUP_COUNT", 5))
+
+
+
+# Queue shared by every logger of the process, drained by a single background thread started with the first record
+# The writer side (logger.log_writer) is only imported then, creating a logger starts no thread and opens no file
+_log_queue = queue.SimpleQueue()
+_log_files = {}  # logger name -> log file path
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def _start_listener():
+    global _listener
+    if _listener is not None:
+        return
+    with _listener_lock:
+        if _listener is None:
+            from logging.handlers import QueueListener
+            from logger.log_writer import LogFileRouter
+            _listener = QueueListener(_log_queue, LogFileRouter(_log_files))
+            _listener.start()
+            atexit.register(stop_logging)
+
+
+# Handler putting records on the queue, the queue never leaves the process so records are passed as they are:
+# only the message is merged with its arguments and the run id is captured on the calling thread, so a record keeps
+# the run it was logged in even when set_run_id is called before the writer gets to it. Formatting (JSON, tracebacks)
+# is left to the background writer
+class BackgroundQueueHandler(logging.Handler):
+    def emit(self, record):
+        try:
+            from logger.stage_metrics import get_run_id
+            record.msg = record.getMessage()
+            record.args = None
+            record.run_id = get_run_id()
+            _start_listener()
+            _log_queue.put_nowait(record)
+        except Exception:
+            self.handleError(record)
+
+
+# Function to flush every queued record to disk and stop the background writer, run at interpreter exit
+def stop_logging():
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+
+
 # Creating a reusable class in order to be able to log each part of the ETL process
+# Records are put on an in-memory queue and written by a background thread, so logging never blocks on disk I/O
 class ETLLogger:
-    def __init__(self, name, log_folder = "../logs"):
-        self.log_folder = Path(log_folder)
-        self.log_folder.mkdir(parents = True, exist_ok = True)
+    def __init__(self, name, log_folder = None):
+        self.log_folder = Path(log_folder) if log_folder is not None else log_folder_default
         self.logger = logging.getLogger(name)
         self.logger.setLevel(logging.INFO)
         if not self.logger.handlers:
-            file_handler = logging.FileHandler(self.log_folder / f"{name}.log")
-            formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
-            file_handler.setFormatter(formatter)
-            self.logger.addHandler(file_handler)
+            _log_files[name] = self.log_folder / f"{name}.log"
+            self.logger.addHandler(BackgroundQueueHandler())
 
     def get(self):
         return self.logger
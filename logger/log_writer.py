@@ -0,0 +1,103 @@
+# Writer side of the ETL logs, run by the background listener thread of logger.etl_logger
+# Kept in its own module so that creating a logger does not import logging.handlers, json and datetime
+import json
+import logging
+import multiprocessing
+import os
+from datetime import datetime, timezone
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+from logger.etl_logger import log_format, max_log_bytes, log_backup_count
+
+
+# Attributes every LogRecord has, anything else on a record was passed through extra and becomes a JSON field
+_record_attributes = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+
+
+# Formatter writing one JSON object per line with the run id, the stage and the key-value fields passed through extra
+# The run id is the one captured by BackgroundQueueHandler when the record was logged
+# e.g. logger.info("Loaded chunk", extra={"stage": "load_chunk", "table": "fact_incidents", "rows": 10_000})
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "run_id": getattr(record, "run_id", None),
+            "stage": getattr(record, "stage", record.name),
+            "message": record.getMessage(),
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in _record_attributes and key not in ("stage", "run_id")})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default = str)
+
+
+
+
+# Rotating file handler that only creates the log folder and opens its file when the first record is written
+class DelayedFileHandler(RotatingFileHandler):
+    def __init__(self, filename):
+        super().__init__(filename, maxBytes = max_log_bytes, backupCount = log_backup_count, delay = True)
+
+    def _open(self):
+        Path(self.baseFilename).parent.mkdir(parents = True, exist_ok = True)
+        return super()._open()
+
+    # Formatting each record once and checking the size with the open stream, where shouldRollover formats it
+    # a second time and stats the file on every record
+    def emit(self, record):
+        try:
+            message = self.format(record) + self.terminator
+            if self.stream is None:
+                self.stream = self._open()
+            if self.maxBytes > 0 and self.stream.tell() + len(message) >= self.maxBytes:
+                self.doRollover()
+                if self.stream is None:
+                    self.stream = self._open()
+            self.stream.write(message)
+            self.flush()
+        except Exception:
+            self.handleError(record)
+
+
+
+
+# Function to get the log file of the current process, the registered one in the main process
+def process_log_file(path):
+    if multiprocessing.parent_process() is None:
+        return path
+    return path.with_name(f"{path.stem}.{os.getpid()}{path.suffix}")
+
+
+
+
+# Handler run by the background listener, routing each record to the file registered for the logger that emitted it
+# The file handlers are created on the first record of each logger. A rotating handler cannot share its file with
+# another process (each one would rename the file under the other), so a worker process started by multiprocessing,
+# e.g. a backfill worker, writes to its own file with its pid in the name
+class LogFileRouter(logging.Handler):
+    def __init__(self, log_files):
+        super().__init__()
+        self.log_files = log_files
+        self.files = {}
+
+    def get_file(self, name):
+        if name not in self.files:
+            handler = DelayedFileHandler(process_log_file(self.log_files[name]))
+            if log_format == "json":
+                handler.setFormatter(JSONFormatter())
+            else:
+                handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+            self.files[name] = handler
+        return self.files[name]
+
+    def handle(self, record):
+        if record.name in self.log_files:
+            self.get_file(record.name).handle(record)
+
+    def close(self):
+        for handler in self.files.values():
+            handler.close()
+        super().close()
@@ -0,0 +1,186 @@
+# Opt-in profiling of pipeline stages, switched on per stage name without editing code
+#   ETL_PROFILE=transform_311,load_to_bigquery   stages to profile, "*" for every stage
+#   ETL_PROFILE_MODE=sample|cprofile              statistical stack sampler (default) or deterministic cProfile
+#   ETL_PROFILE_MEMORY=0                          turns off the tracemalloc allocation report
+# Every profiled stage call writes its files to <log folder>/profiles/<run id>/: a collapsed-stack file
+# (flamegraph.pl, speedscope) or a cProfile dump with a text summary, and the top allocation sites
+# When ETL_PROFILE is unset the only cost per stage is one set lookup
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from logger.etl_logger import ETLLogger, log_folder_default
+
+
+# Settings for profiling, read from the environment so spawned worker processes inherit them
+profile_stages = {name.strip() for name in os.environ.get("ETL_PROFILE", "").split(",") if name.strip()}
+profile_mode = os.environ.get("ETL_PROFILE_MODE", "sample")
+profile_memory = os.environ.get("ETL_PROFILE_MEMORY", "1") != "0"
+sample_interval = float(os.environ.get("ETL_PROFILE_INTERVAL", 0.005))  # seconds between stack samples
+top_allocations = int(os.environ.get("ETL_PROFILE_TOP", 25))
+tracemalloc_frames = 10
+
+profiling_logger = ETLLogger("profiling").get()
+
+# Only one stage is profiled at a time per process: stages nested in a profiled stage are already covered by it,
+# and stages running concurrently on other threads (e.g. download_chunk) are skipped while one is profiled
+_active = threading.Lock()
+_sequence = 0
+
+
+
+# Function to check whether a stage is profiled
+def is_profiled(name):
+    return bool(profile_stages) and (name in profile_stages or "*" in profile_stages)
+
+
+# Function to switch profiling on at runtime, e.g. from a DAG run conf; the environment is updated as well so
+# worker processes started afterwards profile the same stages
+def enable_profiling(stages, mode = None):
+    global profile_mode
+    if isinstance(stages, str):
+        stages = stages.split(",")
+    profile_stages.update(name.strip() for name in stages if name.strip())
+    os.environ["ETL_PROFILE"] = ",".join(sorted(profile_stages))
+    if mode:
+        profile_mode = mode
+        os.environ["ETL_PROFILE_MODE"] = mode
+
+
+# Function to get the folder holding the profiles of the current run
+def profile_folder():
+    from logger.stage_metrics import get_run_id
+    return log_folder_default / "profiles" / get_run_id()
+
+
+
+
+# Sampler thread recording the Python stack of the profiled threads every interval, counted as collapsed stacks
+# Threads that were already running when the stage started (log writer, Airflow heartbeat) are left out, except
+# the one running the stage, so thread pools started by the stage are sampled and idle background threads are not
+class StackSampler(threading.Thread):
+    def __init__(self, interval = sample_interval):
+        super().__init__(name = "etl-profiler", daemon = True)
+        self.interval = interval
+        self.stage_thread = threading.get_ident()
+        self.ignored = {thread.ident for thread in threading.enumerate()} - {self.stage_thread}
+        self.stacks = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        self.ignored.add(threading.get_ident())
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id in self.ignored:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{frame.f_code.co_name} ({Path(frame.f_code.co_filename).name})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    # Function to write the samples in the collapsed-stack format, one "frame;frame;frame count" line per stack
+    def write(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+
+
+# Function to write the top allocation sites between two tracemalloc snapshots, with the traced peak
+# tracemalloc sees Python allocations only, the buffers Polars and Arrow allocate natively are not in the report
+def write_allocations(path, before, after, peak):
+    import tracemalloc
+    ignored = [
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+    ]
+    stats = after.filter_traces(ignored).compare_to(before.filter_traces(ignored), "lineno")
+    with open(path, "w") as f:
+        f.write(f"Peak traced memory: {peak / 1e6:.1f} MB\n")
+        f.write(f"Top {top_allocations} allocation sites by size retained at the end of the stage:\n")
+        for stat in stats[:top_allocations]:
+            f.write(f"{stat}\n")
+
+
+
+
+# Context manager profiling one stage call, a no-op when another stage is being profiled
+@contextmanager
+def profile(name):
+    global _sequence
+    if not _active.acquire(blocking = False):
+        yield
+        return
+
+    try:
+        _sequence += 1
+        folder = profile_folder()
+        folder.mkdir(parents = True, exist_ok = True)
+        base = folder / f"{name}_{os.getpid()}_{_sequence:03d}"
+
+        tracing = False
+        if profile_memory:
+            import tracemalloc
+            tracing = not tracemalloc.is_tracing()
+            if tracing:
+                tracemalloc.start(tracemalloc_frames)
+            tracemalloc.reset_peak()
+            before = tracemalloc.take_snapshot()
+
+        if profile_mode == "cprofile":
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+        else:
+            profiler = StackSampler()
+            profiler.start()
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            if profile_mode == "cprofile":
+                profiler.disable()
+            else:
+                profiler.stop()
+            # The allocation snapshot is taken before any profile is written, so the report only covers the stage
+            if profile_memory:
+                import tracemalloc
+                peak = tracemalloc.get_traced_memory()[1]
+                after = tracemalloc.take_snapshot()
+                if tracing:
+                    tracemalloc.stop()
+
+            if profile_mode == "cprofile":
+                import pstats
+                profiler.dump_stats(f"{base}.prof")
+                with open(f"{base}.txt", "w") as f:
+                    pstats.Stats(profiler, stream = f).sort_stats("cumulative").print_stats(top_allocations)
+                files = [f"{base}.prof", f"{base}.txt"]
+            else:
+                profiler.write(f"{base}.collapsed")
+                files = [f"{base}.collapsed"]
+            if profile_memory:
+                write_allocations(f"{base}.allocations.txt", before, after, peak)
+                files.append(f"{base}.allocations.txt")
+            profiling_logger.info(
+                f"Profiled {name} ({elapsed:.2f} s) to {', '.join(Path(file).name for file in files)}",
+                extra = {"stage": name, "profile_folder": str(folder), "mode": profile_mode}
+            )
+    finally:
+        _active.release()
@@ -0,0 +1,280 @@
+# Per-stage instrumentation of the pipeline: wall and CPU time, row counts, bytes, throughput and peak RSS growth
+# Every stage appends one JSON line to the metrics file of the current run, and the run's totals per stage can be
+# exported as a Prometheus textfile for the node exporter textfile collector
+import inspect
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import wraps
+from pathlib import Path
+from logger.profiling import is_profiled, profile
+
+
+# Settings for the metrics, disabled with ETL_METRICS=0
+project_root = Path(__file__).resolve().parents[1]
+metrics_enabled = os.environ.get("ETL_METRICS", "1") != "0"
+metrics_folder = Path(os.environ.get("ETL_METRICS_DIR", project_root / "metrics"))
+prometheus_textfile = os.environ.get("ETL_PROMETHEUS_TEXTFILE")  # e.g. /var/lib/node_exporter/textfile/etl.prom
+rss_sample_interval = float(os.environ.get("ETL_RSS_SAMPLE_INTERVAL", 0.005))  # seconds between RSS samples
+
+# Number of stages currently open in this process, the textfile is exported whenever the outermost one closes
+# Extraction batches finish on several threads, hence the lock
+_open_stages = 0
+_lock = threading.Lock()
+
+# Peak RSS seen so far by each open stage, kept up to date by a sampler thread running while any stage is open
+_stage_peaks = {}
+_sampler = None
+_peak_lock = threading.Lock()
+
+
+
+# Function to get the id of the current run, shared with child processes through the environment
+def get_run_id():
+    if "ETL_RUN_ID" not in os.environ:
+        os.environ["ETL_RUN_ID"] = f"{datetime.now(timezone.utc):%Y%m%dT%H%M%S}_{os.getpid()}"
+    return os.environ["ETL_RUN_ID"]
+
+
+# Function to set the run id, e.g. to the Airflow run_id so every task of a DAG run writes to the same file
+def set_run_id(run_id):
+    os.environ["ETL_RUN_ID"] = str(run_id).replace(":", "_").replace("+", "_")
+
+
+# Function to get the metrics file of the current run
+def metrics_path():
+    return metrics_folder / f"{get_run_id()}.jsonl"
+
+
+
+
+# Function to read the peak resident set size of this process in bytes (ru_maxrss is in KB on Linux, bytes on macOS)
+def peak_rss():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if os.uname().sysname == "Darwin" else peak * 1024
+
+
+# Function to read the current resident set size of this process in bytes, from /proc/self/statm on Linux
+# The process peak is the fallback where /proc is not available
+def current_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return peak_rss()
+
+
+# Function run by the sampler thread, raising the peak of every open stage to the current RSS until none is open
+# The process peak (ru_maxrss) cannot be reset per stage, and the RSS at the end of a stage misses the memory it
+# allocated and freed, so the RSS is sampled while the stage runs instead
+def sample_rss():
+    global _sampler
+    while True:
+        rss = current_rss()
+        with _peak_lock:
+            if not _stage_peaks:
+                _sampler = None
+                return
+            for key, peak in _stage_peaks.items():
+                _stage_peaks[key] = max(peak, rss)
+        time.sleep(rss_sample_interval)
+
+
+# Function to start tracking the peak RSS of a stage, starting the sampler thread if it is not running
+def track_peak(key, rss):
+    global _sampler
+    with _peak_lock:
+        _stage_peaks[key] = rss
+        if _sampler is None:
+            _sampler = threading.Thread(target = sample_rss, name = "stage-rss-sampler", daemon = True)
+            _sampler.start()
+
+
+# Function to stop tracking the peak RSS of a stage, returning the peak seen during it
+def untrack_peak(key, rss):
+    with _peak_lock:
+        return max(_stage_peaks.pop(key), rss)
+
+
+# Function to count the rows and bytes of a stage input or output: a frame, or a dict, list or tuple of frames
+def frame_size(value):
+    if hasattr(value, "height") and hasattr(value, "estimated_size"):
+        return value.height, value.estimated_size()
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        sizes = [frame_size(item) for item in value]
+        sizes = [size for size in sizes if size != (None, None)]
+        if sizes:
+            return sum(rows for rows, _ in sizes), sum(size for _, size in sizes)
+    return None, None
+
+
+
+
+# Class holding the measurements of one stage, filled in by the stage context manager
+class StageRecord(dict):
+    def set_input(self, value):
+        self["rows_in"], self["bytes_in"] = frame_size(value)
+
+    def set_output(self, value):
+        self["rows_out"], self["bytes_out"] = frame_size(value)
+
+
+
+
+# Function to append a record to the run's metrics file, lines are small enough for appends from several processes
+def write_record(record):
+    line = json.dumps(record, default = str)
+    with _lock:
+        metrics_folder.mkdir(parents = True, exist_ok = True)
+        with open(metrics_path(), "a") as f:
+            f.write(line + "\n")
+
+
+
+
+# Function to total the run's metrics file per stage, covering every process of the run
+def stage_totals():
+    totals = {}
+    if not metrics_path().exists():
+        return totals
+    with open(metrics_path()) as f:
+        for line in f:
+            record = json.loads(line)
+            stage_total = totals.setdefault(record["stage"], {
+                "calls": 0, "errors": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0, "rows_in": 0, "rows_out": 0,
+                "peak_rss_delta_bytes": 0
+            })
+            stage_total["calls"] += 1
+            stage_total["errors"] += record["status"] != "ok"
+            stage_total["wall_seconds"] += record["wall_s"]
+            stage_total["cpu_seconds"] += record["cpu_s"]
+            stage_total["rows_in"] += record.get("rows_in") or 0
+            stage_total["rows_out"] += record.get("rows_out") or 0
+            stage_total["peak_rss_delta_bytes"] = max(stage_total["peak_rss_delta_bytes"], record.get("peak_rss_delta_bytes") or 0)
+    return totals
+
+
+
+
+# Function to write the run's totals in the Prometheus text format, atomically so the collector never reads half a file
+def write_prometheus_textfile(path = prometheus_textfile):
+    totals = stage_totals()
+    metrics = {
+        "calls": ("etl_stage_calls_total", "counter", "Number of times the stage ran"),
+        "errors": ("etl_stage_errors_total", "counter", "Number of times the stage raised"),
+        "wall_seconds": ("etl_stage_wall_seconds_total", "counter", "Wall time spent in the stage"),
+        "cpu_seconds": ("etl_stage_cpu_seconds_total", "counter", "CPU time of the stage, of its thread when not run on the main thread"),
+        "rows_in": ("etl_stage_rows_in_total", "counter", "Rows going into the stage"),
+        "rows_out": ("etl_stage_rows_out_total", "counter", "Rows coming out of the stage"),
+        "peak_rss_delta_bytes": ("etl_stage_peak_rss_delta_bytes", "gauge", "Largest growth of the RSS during one run of the stage"),
+    }
+    lines = []
+    for key, (name, metric_type, help_text) in metrics.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+        for stage_name, stage_total in sorted(totals.items()):
+            lines.append(f'{name}{{stage="{stage_name}",run_id="{get_run_id()}"}} {stage_total[key]}')
+
+    path = Path(path)
+    path.parent.mkdir(parents = True, exist_ok = True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, path)
+
+
+
+
+# Context manager measuring one stage, extra keyword arguments are recorded as labels (e.g. table, offset)
+# Stages named in ETL_PROFILE are also profiled, see logger.profiling
+@contextmanager
+def stage(name, rows_in = None, **labels):
+    if is_profiled(name):
+        with profile(name), measure_stage(name, rows_in, **labels) as record:
+            yield record
+    else:
+        with measure_stage(name, rows_in, **labels) as record:
+            yield record
+
+
+# CPU time is the process's for a stage on the main thread, covering the worker threads it starts, and the thread's
+# for a stage run on another thread (e.g. download_chunk in its thread pool), which would otherwise also count the
+# CPU of every other thread running at the same time
+@contextmanager
+def measure_stage(name, rows_in = None, **labels):
+    record = StageRecord(stage = name, run_id = get_run_id(), **labels)
+    if rows_in is not None:
+        record.set_input(rows_in)
+    if not metrics_enabled:
+        yield record
+        return
+
+    global _open_stages
+    with _lock:
+        _open_stages += 1
+    started_at = datetime.now(timezone.utc).isoformat()
+    rss_before = current_rss()
+    track_peak(id(record), rss_before)
+    cpu_clock = "process" if threading.current_thread() is threading.main_thread() else "thread"
+    cpu_time = time.process_time if cpu_clock == "process" else time.thread_time
+    cpu_start = cpu_time()
+    wall_start = time.perf_counter()
+    status = "ok"
+    try:
+        yield record
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        wall = time.perf_counter() - wall_start
+        rss_after = current_rss()
+        rss_peak = untrack_peak(id(record), rss_after)
+        rows = record.get("rows_in") or record.get("rows_out")
+        record.update({
+            "status": status,
+            "started_at": started_at,
+            "wall_s": round(wall, 6),
+            "cpu_s": round(cpu_time() - cpu_start, 6),
+            "cpu_clock": cpu_clock,
+            "rows_per_s": round(rows / wall, 1) if rows and wall > 0 else None,
+            "rss_before_bytes": rss_before,
+            "rss_after_bytes": rss_after,
+            "peak_rss_bytes": rss_peak,
+            "peak_rss_delta_bytes": rss_peak - rss_before,
+        })
+        write_record(record)
+        with _lock:
+            _open_stages -= 1
+            outermost = _open_stages == 0
+        if outermost and prometheus_textfile:
+            write_prometheus_textfile(prometheus_textfile)
+
+
+
+
+# Decorator measuring every call of a pipeline function as a stage, input rows are taken from the first frame argument
+# The arguments named in labels are recorded with each call, e.g. labels = ["column"] for apply_mapping
+# count_input = False leaves rows_in out for a stage whose frame argument is not its input, e.g. the grid points
+# a weather request is made for
+def instrument_stage(name = None, labels = (), count_input = True):
+    def decorator(fn):
+        stage_name = name or fn.__name__
+        signature = inspect.signature(fn)
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            inputs = None
+            if count_input:
+                inputs = next((value for value in list(args) + list(kwargs.values()) if frame_size(value) != (None, None)), None)
+            arguments = signature.bind_partial(*args, **kwargs).arguments if labels else {}
+            with stage(stage_name, rows_in = inputs, **{label: arguments.get(label) for label in labels}) as record:
+                result = fn(*args, **kwargs)
+                record.set_output(result)
+            return result
+        return wrapper
+    return decorator
@@ -28,6 +28,7 @@ class dim_location:
     location_type: str
     latitude: float
     longitude: float
+    incident_modzcta: str
 
 @dataclass
 class dim_borough:
@@ -59,6 +60,7 @@ class fact_incidents:
     incident_id: int
     date_id: dim_date
     location_id: dim_location
+    weather_grid_id: int
     borough_id: dim_borough
     agency_id: dim_agency
     complaint_type_id: dim_complaint_type
@@ -76,6 +78,7 @@ class fact_weather:
     weather_id: int
     date: dim_date
     borough_id: dim_borough
+    grid_id: int
     temperature_max: float
     temperature_min: float
     precipitation_total: float
@@ -0,0 +1,65 @@
+# Script downloading the borough and ZIP code area boundaries used by the spatial imputation of transform_311
+#   python -m scripts.fetch_boundaries
+# Each layer is exported as GeoJSON from NYC Open Data, its features keep only the property holding the value
+# (renamed to the one etl/transformation/spatial_imputation.py reads), and the file is written to the boundary folder
+# The ZIP code areas are MODZCTAs, which are not always the USPS ZIP code of a point, see spatial_imputation.py
+import json
+import os
+import urllib.request
+from etl.transformation.spatial_imputation import boundary_dir, boundary_layers
+
+
+# Settings for the NYC Open Data exports, as layer -> (URL, property holding the value in the export)
+export_url = "https://data.cityofnewyork.us/api/geospatial/{dataset}?method=export&format=GeoJSON"
+boundary_sources = {
+    "borough": (os.environ.get("ETL_BOROUGH_BOUNDARIES_URL", export_url.format(dataset = "tqmj-j8zm")), "boro_name"),
+    "modzcta": (os.environ.get("ETL_MODZCTA_BOUNDARIES_URL", export_url.format(dataset = "pri4-ifjk")), "modzcta"),
+}
+timeout = 120  # seconds
+
+
+
+# Function to download one layer and keep the property holding its value under the name the imputation reads
+def fetch_layer(layer) -> dict:
+    url, source_property = boundary_sources[layer]
+    target_property = boundary_layers[layer]["property"]
+    with urllib.request.urlopen(url, timeout = timeout) as response:
+        collection = json.load(response)
+
+    features = []
+    for feature in collection.get("features", []):
+        properties = feature.get("properties") or {}
+        if properties.get(source_property) is None or feature.get("geometry") is None:
+            continue
+        if feature["geometry"]["type"] not in ("Polygon", "MultiPolygon"):
+            continue
+        features.append({
+            "type": "Feature",
+            "properties": {target_property: str(properties[source_property])},
+            "geometry": feature["geometry"],
+        })
+    if not features:
+        raise ValueError(f"No polygon of {url} has the property {source_property}")
+    return {"type": "FeatureCollection", "features": features}
+
+
+
+
+# Function to download every layer, each file replaced atomically once its download is complete
+def fetch_boundaries(folder = None):
+    folder = folder or boundary_dir
+    folder.mkdir(parents = True, exist_ok = True)
+    for layer, settings in boundary_layers.items():
+        collection = fetch_layer(layer)
+        path = folder / settings["file"]
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(collection, f)
+        os.replace(tmp_path, path)
+        print(f"Wrote {len(collection['features'])} {layer} boundaries to {path}")
+
+
+
+
+if __name__ == "__main__":
+    fetch_boundaries()
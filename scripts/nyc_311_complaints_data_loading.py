@@ -9,6 +9,16 @@ base_url = "https://data.cityofnewyork.us/resource/erm2-nwe9.csv"
 chunk_size = 100_000
 output_parquet = "nyc_311_full.parquet"
 max_workers = 4                      # Using 4 threads (multi-threading) to load data faster
+
+# Parquet writer settings, matching the profile of the master dataset (etl/parquet_layout.py)
+# Each downloaded chunk becomes one row group, with a bloom filter on unique_key
+parquet_options = {
+    "compression": "zstd",
+    "compression_level": 3,
+    "write_statistics": True,
+    "write_page_index": True,
+    "bloom_filter_options": {"unique_key": {"ndv": chunk_size, "fpp": 0.01}},
+}
 columns = [
     "unique_key", "created_date", "closed_date", "agency", "agency_name",
     "complaint_type", "descriptor", "location_type", "incident_zip",
@@ -58,7 +68,12 @@ while True:
             off, table = result
             if first_chunk:
                 # Writing arrow to parquet
-                writer = pq.ParquetWriter(output_parquet, table.schema, compression="snappy")
+                try:
+                    writer = pq.ParquetWriter(output_parquet, table.schema, **parquet_options)
+                except TypeError:
+                    # pyarrow releases without bloom filter support still get the zstd, statistics layout
+                    options = {key: value for key, value in parquet_options.items() if key != "bloom_filter_options"}
+                    writer = pq.ParquetWriter(output_parquet, table.schema, **options)
                 first_chunk = False
             writer.write_table(table)
             print(f"Downloaded {off + table.num_rows} rows so far")
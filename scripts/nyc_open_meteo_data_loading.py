@@ -13,6 +13,14 @@ chunk_days = 30                    # Loading a month per chunk
 start_date = datetime(2010, 1, 1)
 end_date = datetime(2025, 9, 25)
 
+# Parquet writer settings, matching the profile of the master dataset (etl/parquet_layout.py)
+parquet_options = {
+    "compression": "zstd",
+    "compression_level": 3,
+    "write_statistics": True,
+    "write_page_index": True,
+}
+
 # Setting variables to pull from open-meteo
 variables = ["temperature_2m_max",
             "temperature_2m_min",
@@ -65,6 +73,7 @@ def fetch_weather(borough, lat, lon, start, end):
             return None
         df = pl.DataFrame(data["daily"])
         df = df.with_columns([
+            pl.lit(list(borough_coords).index(borough) + 1).alias("grid_id"),  # Matches the centroid grid of extract_weather
             pl.lit(borough).alias("borough"),
             pl.lit(lat).alias("latitude"),
             pl.lit(lon).alias("longitude")
@@ -96,7 +105,7 @@ for chunk_start, chunk_end in daterange_chunks(start_date, end_date, chunk_days)
         chunk_df = pl.concat(dfs)
         table = chunk_df.to_arrow()
         if first_chunk:
-            writer = pq.ParquetWriter(output_parquet, table.schema, compression = "snappy")
+            writer = pq.ParquetWriter(output_parquet, table.schema, **parquet_options)
             first_chunk = False
         writer.write_table(table)
         print(f"Saved {chunk_start.date()} to {chunk_end.date()}.")
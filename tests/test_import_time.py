@@ -0,0 +1,94 @@
+# Test of the import time and import-time side effects of the DAG file and the ETL modules
+#   python -m pytest tests/test_import_time.py
+# Each module is imported in a fresh interpreter under python -X importtime, and the test fails when a module
+# goes over its budget or creates any file (logs, metadata, data) while being imported. A module whose dependencies
+# are not installed (Airflow, google-cloud-bigquery) is skipped
+import os
+import subprocess
+import sys
+from pathlib import Path
+import pytest
+
+
+# Settings for file path locations, the DAG folder is put on sys.path the way the Airflow scheduler does
+project_root = Path(__file__).resolve().parents[1]
+dag_folder = project_root / "airflow"
+watched_folders = [project_root / "logs", project_root / "metadata", project_root / "data", project_root.parent / "logs"]
+
+# Import time budgets in ms, and the packages left out of each measurement because the importing process already has them
+budgets = {
+    "airflow_automation": (50, ["airflow"]),
+    "logger.etl_logger": (20, []),
+    "etl.extraction.extract_311": (500, []),
+    "etl.extraction.extract_weather": (600, []),
+    "etl.transformation.transform_311": (500, []),
+    "etl.transformation.transform_combined": (500, []),
+    "etl.loading.load_to_bigquery": (1500, []),
+}
+
+
+
+# Function to parse python -X importtime output into (depth, module, cumulative us) in completion order
+def parse_importtime(stderr):
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        entries.append(((len(name) - len(name.lstrip()) - 1) // 2, name.strip(), int(cumulative)))
+    return entries
+
+
+
+
+# Function to get the import time of a module in ms, minus the subtrees of the excluded packages
+def measure(entries, module, exclude):
+    target = next(i for i, (depth, name, _) in enumerate(entries) if name == module and depth == 0)
+    start = max((i for i in range(target) if entries[i][0] == 0), default = -1) + 1
+    excluded = 0
+    for i in range(start, target):
+        depth, name, cumulative = entries[i]
+        if not any(name == package or name.startswith(package + ".") for package in exclude):
+            continue
+        # Only the outermost excluded import is counted, its nested imports are part of its cumulative time
+        ancestor_depth, nested = depth, False
+        for j in range(i + 1, target):
+            if entries[j][0] < ancestor_depth:
+                ancestor_depth = entries[j][0]
+                if any(entries[j][1] == package or entries[j][1].startswith(package + ".") for package in exclude):
+                    nested = True
+                    break
+        if not nested:
+            excluded += cumulative
+    return (entries[target][2] - excluded) / 1e3
+
+
+
+
+# Function listing every file under the watched folders
+def snapshot():
+    return {path for folder in watched_folders if folder.exists() for path in folder.rglob("*")}
+
+
+
+
+@pytest.mark.parametrize("module", list(budgets))
+def test_import_time(module):
+    budget, exclude = budgets[module]
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join([str(dag_folder), str(project_root)])}
+    before = snapshot()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd = project_root, env = env, capture_output = True, text = True
+    )
+    created = sorted(str(path.relative_to(project_root.parent)) for path in snapshot() - before)
+
+    if result.returncode != 0:
+        error = result.stderr.strip().splitlines()[-1]
+        if "ModuleNotFoundError" in error:
+            pytest.skip(error)
+        pytest.fail(f"import {module} failed: {error}")
+
+    elapsed = measure(parse_importtime(result.stderr), module, exclude)
+    assert not created, f"import {module} created {', '.join(created)}"
+    assert elapsed <= budget, f"import {module} took {elapsed:.1f} ms, over its {budget} ms budget"